@@ -1,34 +1,94 @@
-from flask import Flask, jsonify, request
+from flask import Blueprint, Flask, Response, current_app, jsonify, request
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
-from datetime import datetime, timedelta
-import hashlib
-from database import get_db, init_db
+from datetime import datetime
+import database
+from database import get_db, init_db, get_pool, run_immediate, IntegrityError
+from pagination import parse_fields, parse_page, page_response
+from streaming import parse_format, stream_rows
+import timeseries
 from config import Config
-
-app = Flask(__name__)
-app.config.from_object(Config)
-CORS(app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=True)
-jwt = JWTManager(app)
+import events
+import circulation
+import conditional
+import repository
+from repository import BOOK_COLUMNS, BOOK_FACETS, LOAN_COLUMNS, ADMIN_LOAN_COLUMNS, LOAN_KEY, USER_COLUMNS, USER_KEY
+import passwords
+from catalogue_import import READERS, decode_lines, import_books
+from cache import LRUCache
+from scheduler import OverdueScheduler
+import metrics
+import ratelimit
+import related
+import replicas
+
+api = Blueprint('api', __name__)
+jwt = JWTManager()
+
+# Catalogue caches, invalidated by the handlers that change books
+book_cache = LRUCache(Config.BOOK_CACHE_SIZE, Config.BOOK_CACHE_TTL, Config.BOOK_CACHE_ENABLED)
+book_list_cache = LRUCache(Config.BOOK_LIST_CACHE_SIZE, Config.BOOK_CACHE_TTL, Config.BOOK_CACHE_ENABLED)
+
+# Profile rows for /api/auth/me, invalidated by update_user()
+user_cache = LRUCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
 
 # JWT error handlers
 @jwt.expired_token_loader
 def expired_token_callback(jwt_header, jwt_payload):
-    print(f"[JWT] Token expired: {jwt_payload}")
+    metrics.JWT_FAILURES.inc('expired')
+    current_app.logger.debug('JWT expired for subject %s', jwt_payload.get('sub'))
     return jsonify({'error': 'Token has expired'}), 401
 
 @jwt.invalid_token_loader
 def invalid_token_callback(error):
-    print(f"[JWT] Invalid token error: {error}")
+    metrics.JWT_FAILURES.inc('invalid')
+    current_app.logger.debug('Invalid JWT: %s', error)
     return jsonify({'error': 'Invalid token', 'details': str(error)}), 401
 
 @jwt.unauthorized_loader
 def unauthorized_callback(error):
-    print(f"[JWT] Unauthorized error: {error}")
+    metrics.JWT_FAILURES.inc('missing')
+    current_app.logger.debug('Missing JWT: %s', error)
     return jsonify({'error': 'Missing authorization token'}), 401
 
-# Initialize database
-init_db()
+def create_app(config=Config):
+    """Build the Flask app
+
+    Creating an app has no side effects on the database: run init_db()
+    once per deployment (``python database.py``, or serve.py, which does
+    it before starting workers) and start_background_jobs() in one
+    process only.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+    CORS(
+        app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=True,
+        expose_headers=['ETag', 'Last-Modified']
+    )
+    jwt.init_app(app)
+    database.init_app(app)
+    replicas.init_app(app)
+    metrics.init_app(app)
+    ratelimit.init_app(app)
+    app.register_blueprint(api)
+    return app
+
+def start_background_jobs(app):
+    """Start the overdue scheduler, the related-books refresher when
+    RELATED_REFRESH_INTERVAL_SECONDS is set and, for SQLite snapshot
+    replicas (DATABASE_REPLICA_URLS), the snapshot refresher; returns the
+    started jobs"""
+    jobs = []
+    if app.config['OVERDUE_SCHEDULER_ENABLED']:
+        # Mark overdue loans in the background, off the request path
+        jobs.append(OverdueScheduler(app.config['OVERDUE_INTERVAL_SECONDS'], app.config['OVERDUE_BATCH_SIZE']))
+    if replicas.REPLICAS and app.config['REPLICA_SNAPSHOT_INTERVAL_SECONDS'] > 0:
+        jobs.append(replicas.SnapshotRefresher(app.config['REPLICA_SNAPSHOT_INTERVAL_SECONDS']))
+    if app.config['RELATED_REFRESH_INTERVAL_SECONDS'] > 0:
+        jobs.append(related.RelatedBooksRefresher(app.config['RELATED_REFRESH_INTERVAL_SECONDS']))
+    for job in jobs:
+        job.start()
+    return jobs
 
 # Helper function to get current user from JWT
 def get_current_user_from_jwt():
@@ -38,17 +98,86 @@ def get_current_user_from_jwt():
     return {
         'user_id': int(user_id),
         'email': claims.get('email'),
-        'role': claims.get('role')
+        'role': claims.get('role'),
+        'full_name': claims.get('full_name')
     }
 
+def read_db():
+    """Connection for a read-only handler: a replica, or the primary while
+    the current user's own recent write may not have reached the replicas"""
+    return replicas.get_read_db(get_jwt_identity())
+
+def user_claims(user):
+    """Claims embedded in access tokens next to the user id"""
+    return {'email': user['email'], 'role': user['role'], 'full_name': user['full_name']}
+
+def load_user(user_id):
+    """Public profile of a user, served from user_cache when possible"""
+    key = f'user:{user_id}'
+    user = user_cache.get(key)
+    if user is not None:
+        return user
+
+    generation = user_cache.generation()
+    row = repository.get_user_profile(get_db(), user_id)
+    if row is None:
+        return None
+    user = dict(row)
+    user_cache.set(key, user, tags=[key], generation=generation)
+    return user
+
 # Health check endpoint
-@app.route('/health', methods=['GET'])
+@api.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for monitoring"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()}), 200
+    limiter = ratelimit.get_limiter()
+    return jsonify({
+        'status': 'healthy',
+        'timestamp': datetime.now().isoformat(),
+        'db_pool': get_pool().stats(),
+        'db_replicas': replicas.get_replicas().stats() if replicas.REPLICAS else None,
+        'rate_limits': limiter.stats() if limiter else None,
+        'caches': {
+            'books': book_cache.stats(),
+            'book_lists': book_list_cache.stats(),
+            'users': user_cache.stats()
+        }
+    }), 200
+
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Request, SQL, pool and cache metrics for Prometheus to scrape"""
+    if not current_app.config['METRICS_ENABLED']:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+
+    pool = get_pool().stats()
+    gauges = [
+        ('db_pool_connections_open', 'Pooled connections opened', pool['open']),
+        ('db_pool_connections_in_use', 'Pooled connections checked out', pool['in_use'])
+    ]
+    counters = [('db_pool_waits_total', 'Checkouts that had to wait for a connection', pool['waits'])]
+    if replicas.REPLICAS:
+        routing = replicas.get_replicas().stats()
+        counters += [
+            ('db_replica_reads_total', 'Read-only handlers served by a replica', routing['replica_reads']),
+            ('db_primary_reads_total', 'Read-only handlers sent to the primary after a write',
+             routing['primary_reads'])
+        ]
+    for name, cache in [('books', book_cache), ('book_lists', book_list_cache), ('users', user_cache)]:
+        stats = cache.stats()
+        gauges.append((f'cache_{name}_size', f'{name} cache entries', stats['size']))
+        counters += [
+            (f'cache_{name}_hits_total', f'{name} cache hits', stats['hits']),
+            (f'cache_{name}_misses_total', f'{name} cache misses', stats['misses']),
+            (f'cache_{name}_evictions_total', f'{name} cache entries evicted for space', stats['evictions'])
+        ]
+    limiter = ratelimit.get_limiter()
+    if limiter:
+        gauges.append(('rate_limit_keys', 'Rate-limit buckets held', limiter.stats()['keys']))
+    return Response(metrics.render(gauges, counters), mimetype='text/plain; version=0.0.4')
 
 # Authentication endpoints
-@app.route('/api/auth/register', methods=['POST'])
+@api.route('/api/auth/register', methods=['POST'])
 def register():
     """Register a new user"""
     data = request.get_json()
@@ -57,7 +186,6 @@ def register():
         return jsonify({'error': 'Missing required fields'}), 400
 
     email = data['email']
-    password = hashlib.sha256(data['password'].encode()).hexdigest()
     full_name = data['full_name']
     role = data.get('role', 'student')
 
@@ -65,20 +193,23 @@ def register():
     if role not in ['student', 'admin']:
         return jsonify({'error': 'Invalid role'}), 400
 
+    try:
+        password = passwords.offload(passwords.hash_password, data['password'])
+    except passwords.HashingBusy:
+        return jsonify({'error': 'Server busy, please retry'}), 503
+
     conn = get_db()
-    cursor = conn.cursor()
 
     try:
-        cursor.execute(
-            'INSERT INTO users (email, password, full_name, role) VALUES (?, ?, ?, ?)',
-            (email, password, full_name, role)
-        )
+        user_id = repository.create_user(conn, email, password, full_name, role)
+        events.append(conn, user_id, [
+            ('user.created', user_id, {'email': email, 'full_name': full_name, 'role': role})
+        ])
         conn.commit()
-        user_id = cursor.lastrowid
 
         access_token = create_access_token(
             identity=str(user_id),
-            additional_claims={'email': email, 'role': role}
+            additional_claims=user_claims({'email': email, 'role': role, 'full_name': full_name})
         )
 
         return jsonify({
@@ -91,12 +222,11 @@ def register():
                 'role': role
             }
         }), 201
-    except Exception as e:
+    except IntegrityError:
+        conn.rollback()
         return jsonify({'error': 'Email already exists'}), 409
-    finally:
-        conn.close()
 
-@app.route('/api/auth/login', methods=['POST'])
+@api.route('/api/auth/login', methods=['POST'])
 def login():
     """Login user"""
     data = request.get_json()
@@ -105,21 +235,28 @@ def login():
         return jsonify({'error': 'Missing email or password'}), 400
 
     email = data['email']
-    password = hashlib.sha256(data['password'].encode()).hexdigest()
 
     conn = get_db()
-    cursor = conn.cursor()
 
-    cursor.execute('SELECT * FROM users WHERE email = ? AND password = ?', (email, password))
-    user = cursor.fetchone()
-    conn.close()
+    user = repository.find_user_by_email(conn, email)
+    stored = user['password'] if user else passwords.dummy_hash()
 
-    if not user:
+    try:
+        matches, needs_rehash = passwords.offload(passwords.verify_password, data['password'], stored)
+        if user and matches and needs_rehash:
+            # Upgrade legacy or outdated hashes while we have the plain password
+            new_hash = passwords.offload(passwords.hash_password, data['password'])
+            repository.replace_password(conn, user['id'], new_hash, stored)
+            conn.commit()
+    except passwords.HashingBusy:
+        return jsonify({'error': 'Server busy, please retry'}), 503
+
+    if not user or not matches:
         return jsonify({'error': 'Invalid credentials'}), 401
 
     access_token = create_access_token(
         identity=str(user['id']),
-        additional_claims={'email': user['email'], 'role': user['role']}
+        additional_claims=user_claims(user)
     )
 
     return jsonify({
@@ -132,80 +269,215 @@ def login():
         }
     }), 200
 
-@app.route('/api/auth/me', methods=['GET'])
+@api.route('/api/auth/me', methods=['GET'])
 @jwt_required()
 def get_current_user():
-    """Get current user information"""
+    """Get current user information
+
+    With AUTH_ME_FROM_CLAIMS the answer comes straight from the verified
+    token, so a role change shows up once the user logs in again. Tokens
+    issued before full_name was added to the claims fall back to the
+    cached lookup.
+    """
     current_user = get_current_user_from_jwt()
-    conn = get_db()
-    cursor = conn.cursor()
 
-    cursor.execute('SELECT id, email, full_name, role FROM users WHERE id = ?', (current_user['user_id'],))
-    user = cursor.fetchone()
-    conn.close()
+    if current_app.config['AUTH_ME_FROM_CLAIMS'] and current_user['full_name'] is not None:
+        return jsonify({
+            'id': current_user['user_id'],
+            'email': current_user['email'],
+            'full_name': current_user['full_name'],
+            'role': current_user['role']
+        }), 200
+
+    user = load_user(current_user['user_id'])
 
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
-    return jsonify({
-        'id': user['id'],
-        'email': user['email'],
-        'full_name': user['full_name'],
-        'role': user['role']
-    }), 200
+    return jsonify(user), 200
 
 # Book endpoints
-@app.route('/api/books', methods=['GET'])
-@jwt_required()
-def get_books():
-    """Get all books with optional search and filter"""
-    search = request.args.get('search', '')
+def search_books(conn):
+    """Run the catalogue query described by the request arguments
+
+    Returns (rows, fields, key_fields, limit, facets) for page_response();
+    facets is None unless asked for with ``facets``.
+    Raises ValueError for invalid arguments.
+    """
+    search = search_argument()
+    search_mode = request.args.get('search_mode', 'fts')
     category = request.args.get('category', '')
     available_only = request.args.get('available_only', 'false').lower() == 'true'
 
-    conn = get_db()
-    cursor = conn.cursor()
+    if search_mode not in ['fts', 'substring']:
+        raise ValueError('Invalid search_mode')
 
-    query = 'SELECT * FROM books WHERE 1=1'
-    params = []
+    fields = parse_fields(BOOK_COLUMNS)
+    limit, after = parse_page()
+    facet_names = parse_facets()
 
-    if search:
-        query += ' AND (title LIKE ? OR author LIKE ? OR isbn LIKE ?)'
-        search_param = f'%{search}%'
-        params.extend([search_param, search_param, search_param])
+    books, key_fields = repository.search_books(
+        conn, search, search_mode, category, available_only, fields, after, limit
+    )
+    facets = None
+    if facet_names is not None:
+        facets = repository.book_facets(
+            conn, search, search_mode, category, available_only, facet_names, current_app.config['FACET_LIMIT']
+        )
+    return books, fields, key_fields, limit, facets
+
+def parse_facets():
+    """Read ``facets``: a comma-separated list of BOOK_FACETS, or empty for
+    all of them; None when the client did not ask for facets"""
+    names = request.args.get('facets')
+    if names is None:
+        return None
+
+    names = [name.strip() for name in names.split(',') if name.strip()] or list(BOOK_FACETS)
+    for name in names:
+        if name not in BOOK_FACETS:
+            raise ValueError(f'Unknown facet: {name}')
+    return names
+
+def search_argument():
+    """``search`` as it is queried; inner spacing matters to substring mode"""
+    return request.args.get('search', '').strip()
+
+def book_list_cache_key():
+    """Normalized request arguments identifying a book list query"""
+    args = request.args
+    return (
+        search_argument(),
+        args.get('search_mode', 'fts'),
+        args.get('category', ''),
+        args.get('available_only', 'false').lower() == 'true',
+        args.get('fields', ''),
+        args.get('limit', ''),
+        args.get('cursor', ''),
+        args.get('facets')
+    )
 
-    if category:
-        query += ' AND category = ?'
-        params.append(category)
+def invalidate_books(*book_ids):
+    """Drop cached rows and lists that contain the given books
 
-    if available_only:
-        query += ' AND available_copies > 0'
+    For changes to availability only; anything that can change list
+    membership or order (add, edit, delete, import) clears the list cache.
+    """
+    tags = [f'book:{book_id}' for book_id in book_ids]
+    book_cache.invalidate(*tags)
+    book_list_cache.invalidate(*tags, 'available')
 
-    query += ' ORDER BY title'
+@api.route('/api/books', methods=['GET'])
+@jwt_required()
+def get_books():
+    """Get all books with optional search and filter
+
+    Searches go through the books_fts index and are ranked by bm25 with
+    prefix matching on title and author. An ISBN is looked up exactly.
+    Pass search_mode=substring for the legacy LIKE scan.
+
+    ``fields`` limits the returned columns. ``limit``/``cursor`` switch to
+    keyset pagination on (title, id), or on relevance for searches.
+    ``facets`` adds category, availability and author counts for the
+    query to the page (see repository.book_facets).
+
+    Serialized responses are cached per normalized query and tagged with
+    the books they contain. A user who has just borrowed or returned
+    skips the cache, which may have been filled from a lagging replica.
+
+    Responses carry an ETag and Last-Modified from the books table
+    version; a matching If-None-Match is answered 304 from the cache, or
+    from the version row alone, without running the query.
+    """
+    cache_key = book_list_cache_key()
+    cached = None if replicas.is_sticky(get_jwt_identity()) else book_list_cache.get(cache_key)
+    if cached is not None:
+        body, etag, last_modified = cached
+        if conditional.not_modified(etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified)
+        response = current_app.response_class(body, mimetype='application/json')
+        return conditional.with_validators(response, etag, last_modified), 200
+    generation = book_list_cache.generation()
+
+    conn = read_db()
+    etag, last_modified = conditional.validators(conn, 'books', cache_key)
+    if conditional.not_modified(etag, last_modified):
+        return conditional.not_modified_response(etag, last_modified)
 
-    cursor.execute(query, params)
-    books = cursor.fetchall()
-    conn.close()
+    try:
+        books, fields, key_fields, limit, facets = search_books(conn)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    response, status = page_response(books, fields, key_fields, limit, facets)
 
-    return jsonify([dict(book) for book in books]), 200
+    # Facet counts depend on every book's availability, like available_only
+    tags = [f"book:{book['id']}" for book in books]
+    if cache_key[3] or facets is not None:
+        tags.append('available')
+    book_list_cache.set(cache_key, (response.get_data(), etag, last_modified), tags, generation)
 
-@app.route('/api/books/<int:book_id>', methods=['GET'])
+    return conditional.with_validators(response, etag, last_modified), status
+
+@api.route('/api/books/categories', methods=['GET'])
+@jwt_required()
+def get_book_categories():
+    """Every category with its book count, for category pickers; unlike
+    the category facet it is not capped at FACET_LIMIT"""
+    conn = read_db()
+    return jsonify([dict(row) for row in repository.book_categories(conn)]), 200
+
+@api.route('/api/books/<int:book_id>', methods=['GET'])
 @jwt_required()
 def get_book(book_id):
-    """Get a specific book by ID"""
-    conn = get_db()
-    cursor = conn.cursor()
+    """Get a specific book by ID, with validators as for get_books()"""
+    cached = None if replicas.is_sticky(get_jwt_identity()) else book_cache.get(book_id)
+
+    if cached is None:
+        generation = book_cache.generation()
+        conn = read_db()
+        etag, last_modified = conditional.validators(conn, 'books', ('book', book_id))
+        if conditional.not_modified(etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified)
+
+        row = repository.get_book(conn, book_id)
+
+        if not row:
+            return jsonify({'error': 'Book not found'}), 404
 
-    cursor.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-    book = cursor.fetchone()
-    conn.close()
+        cached = (dict(row), etag, last_modified)
+        book_cache.set(book_id, cached, [f'book:{book_id}'], generation)
 
-    if not book:
+    book, etag, last_modified = cached
+    if conditional.not_modified(etag, last_modified):
+        return conditional.not_modified_response(etag, last_modified)
+    return conditional.with_validators(jsonify(book), etag, last_modified), 200
+
+@api.route('/api/books/<int:book_id>/related', methods=['GET'])
+@jwt_required()
+def get_related_books(book_id):
+    """Books most often borrowed by the borrowers of this one
+
+    Read from the related_books table that related.py builds from the
+    loan history, so the cost does not grow with the history. ``share``
+    is the fraction of this book's borrowers who also borrowed the
+    related one. ``limit`` defaults to, and is capped at, RELATED_TOP_K.
+    """
+    top_k = current_app.config['RELATED_TOP_K']
+    try:
+        limit = int(request.args.get('limit', top_k))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    if limit < 1:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    conn = read_db()
+    if not repository.book_exists(conn, book_id):
         return jsonify({'error': 'Book not found'}), 404
 
-    return jsonify(dict(book)), 200
+    return jsonify([dict(row) for row in repository.related_books(conn, book_id, min(limit, top_k))]), 200
 
-@app.route('/api/books', methods=['POST'])
+@api.route('/api/books', methods=['POST'])
 @jwt_required()
 def add_book():
     """Add a new book (admin only)"""
@@ -220,35 +492,53 @@ def add_book():
         return jsonify({'error': 'Missing required fields'}), 400
 
     conn = get_db()
-    cursor = conn.cursor()
 
     try:
-        cursor.execute(
-            '''INSERT INTO books (isbn, title, author, category, total_copies, available_copies, description)
-               VALUES (?, ?, ?, ?, ?, ?, ?)''',
-            (
-                data.get('isbn'),
-                data['title'],
-                data['author'],
-                data.get('category'),
-                data.get('total_copies', 1),
-                data.get('available_copies', 1),
-                data.get('description')
-            )
-        )
+        book_id = repository.insert_book(conn, data)
+        book = dict(repository.get_book(conn, book_id))
+        events.append(conn, current_user['user_id'], [('book.created', book_id, book)])
         conn.commit()
-        book_id = cursor.lastrowid
-
-        cursor.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-        book = cursor.fetchone()
+        book_list_cache.clear()
 
-        return jsonify(dict(book)), 201
+        return jsonify(book), 201
     except Exception as e:
+        conn.rollback()
         return jsonify({'error': str(e)}), 400
+
+@api.route('/api/books/import', methods=['POST'])
+@jwt_required()
+def bulk_import_books():
+    """Bulk import books from a CSV or NDJSON request body (admin only)
+
+    The body is streamed and written in batches; books are upserted on
+    ISBN. The format comes from ``format`` or the Content-Type.
+    """
+    current_user = get_current_user_from_jwt()
+
+    if current_user['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    input_format = request.args.get('format')
+    if not input_format:
+        input_format = 'ndjson' if request.mimetype in ['application/x-ndjson', 'application/jsonl'] else 'csv'
+
+    if input_format not in READERS:
+        return jsonify({'error': 'Invalid format'}), 400
+
+    conn = get_db()
+
+    try:
+        result = import_books(
+            conn, READERS[input_format](decode_lines(request.stream)), actor_id=current_user['user_id']
+        )
     finally:
-        conn.close()
+        book_cache.clear()
+        book_list_cache.clear()
 
-@app.route('/api/books/<int:book_id>', methods=['PUT'])
+    # Unreadable input stops the import; the rows before it are committed
+    return jsonify(result), 400 if 'error' in result else 200
+
+@api.route('/api/books/<int:book_id>', methods=['PUT'])
 @jwt_required()
 def update_book(book_id):
     """Update a book (admin only)"""
@@ -260,40 +550,26 @@ def update_book(book_id):
     data = request.get_json()
 
     conn = get_db()
-    cursor = conn.cursor()
 
-    # Check if book exists
-    cursor.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-    if not cursor.fetchone():
-        conn.close()
+    before = repository.get_book(conn, book_id)
+    if before is None:
         return jsonify({'error': 'Book not found'}), 404
 
-    # Build update query dynamically
-    update_fields = []
-    params = []
-
-    for field in ['isbn', 'title', 'author', 'category', 'total_copies', 'available_copies', 'description']:
-        if field in data:
-            update_fields.append(f'{field} = ?')
-            params.append(data[field])
-
-    if not update_fields:
-        conn.close()
+    if not repository.update_book(conn, book_id, data):
         return jsonify({'error': 'No fields to update'}), 400
+    ready = circulation.fill_holds(conn, book_id) if 'available_copies' in data else []
 
-    params.append(book_id)
-    query = f"UPDATE books SET {', '.join(update_fields)} WHERE id = ?"
-
-    cursor.execute(query, params)
+    book = dict(repository.get_book(conn, book_id))
+    events.append(conn, current_user['user_id'], [
+        ('book.updated', book_id, events.changes(before, book, repository.BOOK_UPDATE_FIELDS))
+    ] + [events.hold_ready(hold_id, book_id) for hold_id in ready])
     conn.commit()
+    book_cache.invalidate(f'book:{book_id}')
+    book_list_cache.clear()
 
-    cursor.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-    book = cursor.fetchone()
-    conn.close()
-
-    return jsonify(dict(book)), 200
+    return jsonify(book), 200
 
-@app.route('/api/books/<int:book_id>', methods=['DELETE'])
+@api.route('/api/books/<int:book_id>', methods=['DELETE'])
 @jwt_required()
 def delete_book(book_id):
     """Delete a book (admin only)"""
@@ -303,52 +579,76 @@ def delete_book(book_id):
         return jsonify({'error': 'Admin access required'}), 403
 
     conn = get_db()
-    cursor = conn.cursor()
 
-    cursor.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-    if not cursor.fetchone():
-        conn.close()
+    book = repository.get_book(conn, book_id)
+    if book is None:
         return jsonify({'error': 'Book not found'}), 404
 
-    cursor.execute('DELETE FROM books WHERE id = ?', (book_id,))
-    conn.commit()
-    conn.close()
+    try:
+        repository.delete_book(conn, book_id)
+        events.append(conn, current_user['user_id'], [('book.deleted', book_id, dict(book))])
+        conn.commit()
+    except IntegrityError:
+        # Only databases that enforce the loans/holds foreign keys get here
+        conn.rollback()
+        return jsonify({'error': 'Book has loans or holds'}), 409
+    book_cache.invalidate(f'book:{book_id}')
+    book_list_cache.clear()
 
     return jsonify({'message': 'Book deleted successfully'}), 200
 
 # Loan endpoints
-@app.route('/api/loans', methods=['GET'])
+@api.route('/api/loans', methods=['GET'])
 @jwt_required()
 def get_loans():
-    """Get loans (all for admin, own for students)"""
+    """Get loans (all for admin, own for students)
+
+    Supports ``fields`` projection and keyset pagination on
+    (borrow_date, id), newest first. Without ``limit``/``cursor`` the full
+    list is streamed, as JSON or as an NDJSON/CSV export (``format``).
+    """
     current_user = get_current_user_from_jwt()
+    is_admin = current_user['role'] == 'admin'
+    columns = ADMIN_LOAN_COLUMNS if is_admin else LOAN_COLUMNS
 
-    conn = get_db()
-    cursor = conn.cursor()
-
-    if current_user['role'] == 'admin':
-        cursor.execute('''
-            SELECT l.*, b.title, b.author, u.email, u.full_name
-            FROM loans l
-            JOIN books b ON l.book_id = b.id
-            JOIN users u ON l.user_id = u.id
-            ORDER BY l.borrow_date DESC
-        ''')
-    else:
-        cursor.execute('''
-            SELECT l.*, b.title, b.author
-            FROM loans l
-            JOIN books b ON l.book_id = b.id
-            WHERE l.user_id = ?
-            ORDER BY l.borrow_date DESC
-        ''', (current_user['user_id'],))
+    try:
+        fields = parse_fields(columns)
+        limit, after = parse_page()
+        output_format = parse_format()
+        if limit is not None and output_format != 'json':
+            raise ValueError('format cannot be combined with limit or cursor')
+        cursor = repository.list_loans(
+            read_db(), None if is_admin else current_user['user_id'], fields, after, limit
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if limit is None:
+        return stream_rows(cursor, fields, output_format, filename='loans')
 
     loans = cursor.fetchall()
-    conn.close()
 
-    return jsonify([dict(loan) for loan in loans]), 200
+    return page_response(loans, fields, LOAN_KEY, limit)
 
-@app.route('/api/loans', methods=['POST'])
+@api.route('/api/loans/overdue', methods=['GET'])
+@jwt_required()
+def get_overdue_summary():
+    """Get overdue loan counts per user (all for admin, own for students)
+
+    Served from overdue_summary, which the overdue scheduler maintains.
+    """
+    current_user = get_current_user_from_jwt()
+
+    summary, last_run = repository.overdue_summary(
+        read_db(), None if current_user['role'] == 'admin' else current_user['user_id']
+    )
+
+    return jsonify({
+        'last_run': last_run,
+        'users': [dict(row) for row in summary]
+    }), 200
+
+@api.route('/api/loans', methods=['POST'])
 @jwt_required()
 def borrow_book():
     """Borrow a book"""
@@ -360,121 +660,241 @@ def borrow_book():
 
     book_id = data['book_id']
 
+    def borrow(conn):
+        body, status = circulation.borrow(conn, current_user['user_id'], book_id)
+        if status == 201:
+            events.append(conn, current_user['user_id'], [events.loan_created(body)])
+        return body, status
+
     conn = get_db()
-    cursor = conn.cursor()
+    body, status = run_immediate(conn, borrow)
+    if status == 201:
+        invalidate_books(body['book_id'])
+        replicas.mark_written(current_user['user_id'])
 
-    # Check if book is available
-    cursor.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-    book = cursor.fetchone()
+    return jsonify(body), status
 
-    if not book:
-        conn.close()
-        return jsonify({'error': 'Book not found'}), 404
+@api.route('/api/loans/<int:loan_id>/return', methods=['POST'])
+@jwt_required()
+def return_book(loan_id):
+    """Return a borrowed book"""
+    current_user = get_current_user_from_jwt()
 
-    if book['available_copies'] <= 0:
-        conn.close()
-        return jsonify({'error': 'Book is not available'}), 400
+    def return_loan(conn):
+        body, status = circulation.return_loan(
+            conn, loan_id, current_user['user_id'], current_user['role'] == 'admin'
+        )
+        if status == 200:
+            events.append(conn, current_user['user_id'], [events.loan_returned(body)] + events.copy_released(body))
+        return body, status
 
-    # Check if user already has this book
-    cursor.execute(
-        'SELECT * FROM loans WHERE user_id = ? AND book_id = ? AND status = ?',
-        (current_user['user_id'], book_id, 'active')
-    )
-    if cursor.fetchone():
-        conn.close()
-        return jsonify({'error': 'You already have this book borrowed'}), 400
+    conn = get_db()
+    body, status = run_immediate(conn, return_loan)
+    if status == 200:
+        invalidate_books(body['book_id'])
+        replicas.mark_written(current_user['user_id'])
 
-    # Create loan
-    due_date = datetime.now() + timedelta(days=14)  # 2 weeks loan period
+    return jsonify(body), status
 
-    cursor.execute(
-        'INSERT INTO loans (user_id, book_id, due_date) VALUES (?, ?, ?)',
-        (current_user['user_id'], book_id, due_date)
-    )
+def is_id(value):
+    """True for a JSON integer that fits a 64-bit id column; booleans and
+    numeric strings are not ids"""
+    return isinstance(value, int) and not isinstance(value, bool) and 0 < value < 2 ** 63
 
-    # Update available copies
-    cursor.execute(
-        'UPDATE books SET available_copies = available_copies - 1 WHERE id = ?',
-        (book_id,)
-    )
+@api.route('/api/loans/batch', methods=['POST'])
+@jwt_required()
+def borrow_books_batch():
+    """Borrow several books in one transaction (e.g. at a circulation desk)
 
-    conn.commit()
-    loan_id = cursor.lastrowid
+    Each book goes through the same checks as borrow_book(); a failed item
+    does not affect the others. Admins may borrow on behalf of ``user_id``.
+    """
+    current_user = get_current_user_from_jwt()
+    data = request.get_json()
+
+    if not data or not isinstance(data.get('book_ids'), list) or not data['book_ids']:
+        return jsonify({'error': 'Missing book_ids'}), 400
 
-    cursor.execute('''
-        SELECT l.*, b.title, b.author
-        FROM loans l
-        JOIN books b ON l.book_id = b.id
-        WHERE l.id = ?
-    ''', (loan_id,))
-    loan = cursor.fetchone()
-    conn.close()
+    if len(data['book_ids']) > current_app.config['LOAN_BATCH_MAX']:
+        return jsonify({'error': f"At most {current_app.config['LOAN_BATCH_MAX']} items per batch"}), 400
 
-    return jsonify(dict(loan)), 201
+    user_id = current_user['user_id']
+    if data.get('user_id') is not None:
+        if not is_id(data['user_id']):
+            return jsonify({'error': 'Invalid user_id'}), 400
+        if data['user_id'] != user_id:
+            if current_user['role'] != 'admin':
+                return jsonify({'error': 'Admin access required'}), 403
+            user_id = data['user_id']
 
-@app.route('/api/loans/<int:loan_id>/return', methods=['POST'])
+    conn = get_db()
+
+    if not repository.user_exists(conn, user_id):
+        return jsonify({'error': 'User not found'}), 404
+
+    def borrow_all(conn):
+        results, borrowed = [], []
+        for book_id in data['book_ids']:
+            if is_id(book_id):
+                body, status = circulation.borrow(conn, user_id, book_id)
+            else:
+                body, status = {'error': 'Invalid book_id'}, 400
+            results.append(dict(body, book_id=book_id, status_code=status))
+            if status == 201:
+                borrowed.append(events.loan_created(body))
+        events.append(conn, current_user['user_id'], borrowed)
+        return results
+
+    results = run_immediate(conn, borrow_all)
+    borrowed = [result['book_id'] for result in results if result['status_code'] == 201]
+    if borrowed:
+        invalidate_books(*borrowed)
+        replicas.mark_written(current_user['user_id'])
+        replicas.mark_written(user_id)
+
+    return jsonify({
+        'succeeded': len(borrowed),
+        'failed': len(results) - len(borrowed),
+        'results': results
+    }), 200
+
+@api.route('/api/loans/return/batch', methods=['POST'])
 @jwt_required()
-def return_book(loan_id):
-    """Return a borrowed book"""
+def return_books_batch():
+    """Return several loans in one transaction
+
+    Each loan goes through the same checks as return_book(); a failed item
+    does not affect the others.
+    """
     current_user = get_current_user_from_jwt()
+    data = request.get_json()
+
+    if not data or not isinstance(data.get('loan_ids'), list) or not data['loan_ids']:
+        return jsonify({'error': 'Missing loan_ids'}), 400
+
+    if len(data['loan_ids']) > current_app.config['LOAN_BATCH_MAX']:
+        return jsonify({'error': f"At most {current_app.config['LOAN_BATCH_MAX']} items per batch"}), 400
+
+    def return_all(conn):
+        results, returned = [], []
+        for loan_id in data['loan_ids']:
+            if is_id(loan_id):
+                body, status = circulation.return_loan(
+                    conn, loan_id, current_user['user_id'], current_user['role'] == 'admin'
+                )
+            else:
+                body, status = {'error': 'Invalid loan_id'}, 400
+            results.append(dict(body, loan_id=loan_id, status_code=status))
+            if status == 200:
+                returned += [events.loan_returned(body)] + events.copy_released(body)
+        events.append(conn, current_user['user_id'], returned)
+        return results
 
     conn = get_db()
-    cursor = conn.cursor()
+    results = run_immediate(conn, return_all)
+    returned = [result['book_id'] for result in results if result['status_code'] == 200]
+    if returned:
+        invalidate_books(*returned)
+        replicas.mark_written(current_user['user_id'])
 
-    # Get loan
-    cursor.execute('SELECT * FROM loans WHERE id = ?', (loan_id,))
-    loan = cursor.fetchone()
+    return jsonify({
+        'succeeded': len(returned),
+        'failed': len(results) - len(returned),
+        'results': results
+    }), 200
 
-    if not loan:
-        conn.close()
-        return jsonify({'error': 'Loan not found'}), 404
+# Hold endpoints
+@api.route('/api/holds', methods=['GET'])
+@jwt_required()
+def get_holds():
+    """Get the current user's active holds with their queue positions"""
+    current_user = get_current_user_from_jwt()
+    conn = read_db()
 
-    # Check if user owns this loan or is admin
-    if loan['user_id'] != current_user['user_id'] and current_user['role'] != 'admin':
-        conn.close()
-        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(circulation.list_holds(conn, current_user['user_id'])), 200
 
-    if loan['status'] == 'returned':
-        conn.close()
-        return jsonify({'error': 'Book already returned'}), 400
+@api.route('/api/holds', methods=['POST'])
+@jwt_required()
+def place_hold():
+    """Join the waiting list for a book with no copies available"""
+    current_user = get_current_user_from_jwt()
+    data = request.get_json()
 
-    # Update loan
-    cursor.execute(
-        'UPDATE loans SET return_date = ?, status = ? WHERE id = ?',
-        (datetime.now(), 'returned', loan_id)
-    )
+    if not data or not data.get('book_id'):
+        return jsonify({'error': 'Missing book_id'}), 400
 
-    # Update available copies
-    cursor.execute(
-        'UPDATE books SET available_copies = available_copies + 1 WHERE id = ?',
-        (loan['book_id'],)
-    )
+    def place_hold(conn):
+        body, status = circulation.place_hold(conn, current_user['user_id'], data['book_id'])
+        if status == 201:
+            events.append(conn, current_user['user_id'], [
+                ('hold.created', body['id'], {'user_id': body['user_id'], 'book_id': body['book_id']})
+            ])
+        return body, status
 
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    body, status = run_immediate(conn, place_hold)
+    if status == 201:
+        replicas.mark_written(current_user['user_id'])
+
+    return jsonify(body), status
+
+@api.route('/api/holds/<int:hold_id>', methods=['DELETE'])
+@jwt_required()
+def cancel_hold(hold_id):
+    """Cancel a hold; a copy set aside for it goes to the next in line"""
+    current_user = get_current_user_from_jwt()
+
+    def cancel_hold(conn):
+        body, status = circulation.cancel_hold(
+            conn, hold_id, current_user['user_id'], current_user['role'] == 'admin'
+        )
+        if status == 200:
+            events.append(conn, current_user['user_id'], [
+                ('hold.cancelled', hold_id, {'book_id': body['book_id']})
+            ] + events.copy_released(body))
+        return body, status
+
+    conn = get_db()
+    body, status = run_immediate(conn, cancel_hold)
+    if status == 200:
+        invalidate_books(body['book_id'])
+        replicas.mark_written(current_user['user_id'])
 
-    return jsonify({'message': 'Book returned successfully'}), 200
+    return jsonify(body), status
 
 # User management endpoints (admin only)
-@app.route('/api/users', methods=['GET'])
+@api.route('/api/users', methods=['GET'])
 @jwt_required()
 def get_users():
-    """Get all users (admin only)"""
+    """Get all users (admin only)
+
+    Supports ``fields`` projection and keyset pagination on
+    (created_at, id), newest first. Without ``limit``/``cursor`` the full
+    list is streamed, as JSON or as an NDJSON/CSV export (``format``).
+    """
     current_user = get_current_user_from_jwt()
 
     if current_user['role'] != 'admin':
         return jsonify({'error': 'Admin access required'}), 403
 
-    conn = get_db()
-    cursor = conn.cursor()
+    try:
+        fields = parse_fields(USER_COLUMNS)
+        limit, after = parse_page()
+        output_format = parse_format()
+        if limit is not None and output_format != 'json':
+            raise ValueError('format cannot be combined with limit or cursor')
+        cursor = repository.list_users(read_db(), fields, after, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if limit is None:
+        return stream_rows(cursor, fields, output_format, filename='users')
 
-    cursor.execute('SELECT id, email, full_name, role, created_at FROM users ORDER BY created_at DESC')
     users = cursor.fetchall()
-    conn.close()
 
-    return jsonify([dict(user) for user in users]), 200
+    return page_response(users, fields, USER_KEY, limit)
 
-@app.route('/api/users/<int:user_id>', methods=['PUT'])
+@api.route('/api/users/<int:user_id>', methods=['PUT'])
 @jwt_required()
 def update_user(user_id):
     """Update user role (admin only)"""
@@ -492,16 +912,19 @@ def update_user(user_id):
         return jsonify({'error': 'Invalid role'}), 400
 
     conn = get_db()
-    cursor = conn.cursor()
-
-    cursor.execute('UPDATE users SET role = ? WHERE id = ?', (data['role'], user_id))
+    user = repository.get_user_profile(conn, user_id)
+    repository.set_user_role(conn, user_id, data['role'])
+    if user is not None:
+        events.append(conn, current_user['user_id'], [
+            ('user.updated', user_id, events.changes(user, dict(user, role=data['role']), ['role']))
+        ])
     conn.commit()
-    conn.close()
+    user_cache.invalidate(f'user:{user_id}')
 
     return jsonify({'message': 'User updated successfully'}), 200
 
 # Statistics endpoint
-@app.route('/api/stats', methods=['GET'])
+@api.route('/api/stats', methods=['GET'])
 @jwt_required()
 def get_stats():
     """Get system statistics (admin only)"""
@@ -510,29 +933,97 @@ def get_stats():
     if current_user['role'] != 'admin':
         return jsonify({'error': 'Admin access required'}), 403
 
-    conn = get_db()
-    cursor = conn.cursor()
+    stats = repository.library_stats(read_db())
+
+    return jsonify(dict(stats)), 200
+
+@api.route('/api/stats/timeseries', methods=['GET'])
+@jwt_required()
+def get_stats_timeseries():
+    """Borrows, returns and distinct borrowers per period (admin only)"""
+    current_user = get_current_user_from_jwt()
+
+    if current_user['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    try:
+        interval, start, end = timeseries.parse_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    rows = repository.loan_rollups(
+        read_db(), interval, timeseries.period_key(interval, start), timeseries.period_key(interval, end)
+    )
+    return jsonify({
+        'interval': interval,
+        'start': timeseries.period_key(interval, start),
+        'end': timeseries.period_key(interval, end),
+        'series': timeseries.fill(interval, start, end, rows)
+    }), 200
 
-    cursor.execute('SELECT COUNT(*) as count FROM books')
-    total_books = cursor.fetchone()['count']
+@api.route('/api/stats/top', methods=['GET'])
+@jwt_required()
+def get_stats_top():
+    """Most borrowed books and most active borrowers of a period (admin only)"""
+    current_user = get_current_user_from_jwt()
 
-    cursor.execute('SELECT SUM(available_copies) as count FROM books')
-    available_books = cursor.fetchone()['count']
+    if current_user['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
 
-    cursor.execute('SELECT COUNT(*) as count FROM users')
-    total_users = cursor.fetchone()['count']
+    try:
+        interval, start, end, limit = timeseries.parse_top()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    cursor.execute('SELECT COUNT(*) as count FROM loans WHERE status = ?', ('active',))
-    active_loans = cursor.fetchone()['count']
+    period = timeseries.period_key(interval, start)
+    conn = read_db()
+    totals = repository.loan_rollup(conn, interval, period)
+    return jsonify({
+        'interval': interval,
+        'period': period,
+        'end': timeseries.period_key(interval, end),
+        'totals': dict(totals) if totals else {'borrows': 0, 'returns': 0, 'borrowers': 0},
+        'books': [dict(row) for row in repository.top_books(conn, interval, period, limit)],
+        'borrowers': [dict(row) for row in repository.top_borrowers(conn, interval, period, limit)]
+    }), 200
 
-    conn.close()
+# Change feed (admin only)
+@api.route('/api/events', methods=['GET'])
+@jwt_required()
+def get_events():
+    """Events after ``since``, oldest first (admin only)
+
+    With ``wait``, a request that finds no events holds on for up to that
+    many seconds until one is written (long polling), or gets a 503 when
+    EVENTS_MAX_WAITERS requests are already waiting. Pass the returned
+    ``last_seq`` as the next ``since``.
+    """
+    current_user = get_current_user_from_jwt()
+
+    if current_user['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
 
+    try:
+        since, limit, wait = events.parse_feed()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        found = events.wait_for(since, limit, wait)
+    except events.FeedBusy:
+        response = jsonify({'error': 'Too many requests waiting for events, please retry'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
     return jsonify({
-        'total_books': total_books,
-        'available_books': available_books or 0,
-        'total_users': total_users,
-        'active_loans': active_loans
+        'events': found,
+        'last_seq': found[-1]['seq'] if found else since,
+        'more': len(found) == limit
     }), 200
 
+app = create_app()
+
 if __name__ == '__main__':
+    # Development server; see serve.py for production
+    init_db()
+    start_background_jobs(app)
     app.run(debug=True, host='0.0.0.0', port=5000)
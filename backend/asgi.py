@@ -0,0 +1,153 @@
+"""Run the WSGI app under an ASGI server
+
+WsgiToAsgi translates each HTTP request into a WSGI call that runs on a
+bounded thread pool, so the event loop never blocks on database work and
+at most ``threads`` requests touch the connection pool at once; the rest
+wait in the loop without holding a thread. The request body is pulled
+from the loop as the app reads ``wsgi.input`` (RequestBody), so a large
+upload such as a catalogue import is never held in memory whole. The
+response is iterated on that same worker thread (Flask's streamed
+exports keep their request context there) and each chunk is handed back
+to the loop as it is produced.
+
+Serve it with any ASGI server, e.g. ``uvicorn serve:asgi_application``.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+class RequestBody(io.RawIOBase):
+    """``wsgi.input`` that receives the request body as the app reads it
+
+    Read on the worker thread: each refill waits for the next
+    ``http.request`` message from ``receive`` on the event loop, so at
+    most one message is buffered and a slow client only holds back the
+    request it is sending. A disconnect ends the body early.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def _refill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._done = True
+            return
+        self._buffer += message.get('body', b'')
+        if not message.get('more_body'):
+            self._done = True
+
+    def readinto(self, buffer):
+        while not self._buffer and not self._done:
+            self._refill()
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI http scope and a binary stream of its
+    request body"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # The stream ends with the body, so chunked uploads can be read
+        # without a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').lower()
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+class WsgiToAsgi:
+    """ASGI application wrapping a WSGI one"""
+
+    def __init__(self, app, threads=Config.ASGI_THREADS):
+        self.app = app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            loop = asyncio.get_running_loop()
+            body = io.BufferedReader(RequestBody(receive, loop))
+            await loop.run_in_executor(self.executor, self._respond, loop, send, build_environ(scope, body))
+        else:
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _respond(self, loop, send, environ):
+        """Call the WSGI app and send its response; runs on the executor"""
+        state = {}
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and state.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            state['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            }
+
+        def send_start():
+            if not state.get('sent'):
+                emit(state['start'])
+                state['sent'] = True
+
+        result = self.app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    send_start()
+                    emit({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send_start()
+            emit({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
@@ -0,0 +1,76 @@
+"""Benchmark batch loan endpoints against one call per book
+
+Checks out and returns stacks of books, first one POST /api/loans and
+POST /api/loans/<id>/return per book, then with POST /api/loans/batch and
+POST /api/loans/return/batch, and reports books per second for each.
+
+Usage:
+    python bench_batch_loans.py --stacks 50 --stack-size 15
+"""
+import argparse
+import os
+import tempfile
+import time
+import database
+
+def seed(books):
+    """Fresh database with ``books`` titles, one copy each"""
+    database.close_pool()
+    database.DATABASE = os.path.join(tempfile.mkdtemp(), 'library.db')
+    database.init_db()
+
+    conn = database.get_db()
+    try:
+        conn.executemany(
+            'INSERT INTO books (isbn, title, author, total_copies, available_copies) VALUES (?, ?, ?, 1, 1)',
+            [(f'bench-{i}', f'Bench Book {i}', 'Bench Author') for i in range(books)]
+        )
+        conn.commit()
+        return [row['id'] for row in conn.execute("SELECT id FROM books WHERE isbn LIKE 'bench-%' ORDER BY id")]
+    finally:
+        database.release_db(conn)
+
+def admin_headers(client):
+    response = client.post('/api/auth/login', json={'email': 'admin@library.com', 'password': 'admin123'})
+    return {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+
+def run_single(client, headers, stacks):
+    started = time.perf_counter()
+    for stack in stacks:
+        loan_ids = [
+            client.post('/api/loans', json={'book_id': book_id}, headers=headers).get_json()['id']
+            for book_id in stack
+        ]
+        for loan_id in loan_ids:
+            client.post(f'/api/loans/{loan_id}/return', headers=headers)
+    return time.perf_counter() - started
+
+def run_batch(client, headers, stacks):
+    started = time.perf_counter()
+    for stack in stacks:
+        results = client.post('/api/loans/batch', json={'book_ids': stack}, headers=headers).get_json()['results']
+        loan_ids = [result['id'] for result in results]
+        client.post('/api/loans/return/batch', json={'loan_ids': loan_ids}, headers=headers)
+    return time.perf_counter() - started
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark batch vs single loan calls')
+    parser.add_argument('--stacks', type=int, default=50, help='number of checkouts')
+    parser.add_argument('--stack-size', type=int, default=15, help='books per checkout')
+    args = parser.parse_args()
+
+    from app import app
+
+    book_ids = seed(args.stacks * args.stack_size)
+    stacks = [book_ids[i:i + args.stack_size] for i in range(0, len(book_ids), args.stack_size)]
+    client = app.test_client()
+    headers = admin_headers(client)
+
+    books = len(book_ids)
+    single = run_single(client, headers, stacks)
+    batch = run_batch(client, headers, stacks)
+
+    print()
+    print(f"Single calls: {books} borrows + returns in {single:.2f}s ({books / single:.0f} books/s)")
+    print(f"Batch calls:  {books} borrows + returns in {batch:.2f}s ({books / batch:.0f} books/s)")
+    print(f"Speedup: {single / batch:.1f}x")
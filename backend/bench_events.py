@@ -0,0 +1,54 @@
+"""Cost of the event log on the loan endpoints, and the feed's read rate
+
+Borrows and returns stacks of books (see bench_batch_loans.py), one call
+per book and then in batches, with events.append() doing its work and
+with it replaced by a no-op. Then reads the whole log back through
+GET /api/events a page at a time.
+
+Usage:
+    python bench_events.py --stacks 50 --stack-size 15 --rounds 3
+"""
+import argparse
+import time
+import events
+from bench_batch_loans import admin_headers, run_batch, run_single, seed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the event log')
+    parser.add_argument('--stacks', type=int, default=50, help='number of checkouts')
+    parser.add_argument('--stack-size', type=int, default=15, help='books per checkout')
+    parser.add_argument('--rounds', type=int, default=3, help='runs per setting (best reported)')
+    args = parser.parse_args()
+
+    from app import app
+
+    book_ids = seed(args.stacks * args.stack_size)
+    stacks = [book_ids[i:i + args.stack_size] for i in range(0, len(book_ids), args.stack_size)]
+    client = app.test_client()
+    headers = admin_headers(client)
+    books = len(book_ids)
+
+    append = events.append
+    timings = {}
+    for logged in [False, True, False, True] * args.rounds:
+        events.append = append if logged else (lambda conn, actor_id, batch: None)
+        for name, run in [('single', run_single), ('batch', run_batch)]:
+            elapsed = run(client, headers, stacks)
+            timings[name, logged] = min(elapsed, timings.get((name, logged), elapsed))
+    events.append = append
+
+    print()
+    print(f"{'calls':>8} {'no log books/s':>15} {'logged books/s':>15} {'overhead':>9}")
+    for name in ['single', 'batch']:
+        bare, logged = timings[name, False], timings[name, True]
+        print(f"{name:>8} {books / bare:>15.0f} {books / logged:>15.0f} {(logged / bare - 1) * 100:>8.1f}%")
+
+    started, since, count = time.perf_counter(), 0, 0
+    while True:
+        page = client.get(f'/api/events?since={since}&limit=1000', headers=headers).get_json()
+        count += len(page['events'])
+        since = page['last_seq']
+        if not page['more']:
+            break
+    elapsed = time.perf_counter() - started
+    print(f"Feed: read {count} events in {elapsed:.2f}s ({count / elapsed:.0f} events/s)")
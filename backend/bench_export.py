@@ -0,0 +1,102 @@
+"""Peak memory and time to first byte of the admin loan export
+
+Seeds a database with ``--loans`` returned loans, then reads them back
+the old way (fetchall() and jsonify of the whole list) and through the
+streaming GET /api/loans in each format, tracking peak Python memory
+with tracemalloc.
+
+Usage:
+    python bench_export.py --loans 200000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from flask import jsonify
+import database
+
+def seed(loans, users=500, books=2000):
+    database.close_pool()
+    database.DATABASE = os.path.join(tempfile.mkdtemp(), 'library.db')
+    database.init_db()
+
+    conn = database.get_db()
+    try:
+        conn.executemany(
+            'INSERT INTO users (email, password, full_name) VALUES (?, ?, ?)',
+            [(f'bench{i}@library.com', 'x', f'Bench User {i}') for i in range(users)]
+        )
+        conn.executemany(
+            'INSERT INTO books (isbn, title, author, total_copies, available_copies) VALUES (?, ?, ?, 1, 1)',
+            [(f'bench-{i}', f'Bench Book {i}', 'Bench Author') for i in range(books)]
+        )
+        conn.executemany('''
+            INSERT INTO loans (user_id, book_id, borrow_date, due_date, return_date, status)
+            VALUES (
+                (SELECT id FROM users WHERE email = ?), (SELECT id FROM books WHERE isbn = ?),
+                datetime('2024-01-01', ? || ' minutes'), datetime('2024-01-15', ? || ' minutes'),
+                datetime('2024-01-10', ? || ' minutes'), 'returned'
+            )
+        ''', [(f'bench{i % users}@library.com', f'bench-{i % books}', i, i, i) for i in range(loans)])
+        conn.commit()
+    finally:
+        database.release_db(conn)
+
+def measure(run):
+    """Returns (seconds to first byte, total seconds, peak MiB, bytes)"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    first = None
+    size = 0
+    for chunk in run():
+        if first is None:
+            first = time.perf_counter() - started
+        size += len(chunk)
+    total = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    tracemalloc.stop()
+    return first, total, peak, size
+
+def buffered(app):
+    """What get_loans() did before streaming"""
+    def run():
+        with app.test_request_context():
+            conn = database.get_db()
+            rows = conn.execute('''
+                SELECT l.id, l.user_id, l.book_id, l.borrow_date, l.due_date, l.return_date, l.status,
+                       l.overdue_at, b.title, b.author, u.email, u.full_name
+                FROM loans l JOIN books b ON l.book_id = b.id JOIN users u ON l.user_id = u.id
+                ORDER BY l.borrow_date DESC, l.id DESC
+            ''').fetchall()
+            yield jsonify([dict(row) for row in rows]).get_data()
+    return run
+
+def streamed(client, headers, output_format):
+    def run():
+        response = client.get(f'/api/loans?format={output_format}', headers=headers, buffered=False)
+        try:
+            yield from response.response
+        finally:
+            response.close()
+    return run
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark buffered vs streamed loan exports')
+    parser.add_argument('--loans', type=int, default=100000, help='loans to export')
+    args = parser.parse_args()
+
+    from app import app
+
+    seed(args.loans)
+    client = app.test_client()
+    token = client.post('/api/auth/login', json={'email': 'admin@library.com', 'password': 'admin123'})
+    headers = {'Authorization': f"Bearer {token.get_json()['access_token']}"}
+
+    runs = [('buffered json', buffered(app))] + [
+        (f'streamed {name}', streamed(client, headers, name)) for name in ['json', 'ndjson', 'csv']
+    ]
+    print(f"{'mode':>15} {'first byte ms':>14} {'total s':>8} {'peak MiB':>9} {'MiB out':>8}")
+    for name, run in runs:
+        first, total, peak, size = measure(run)
+        print(f"{name:>15} {first * 1000:>14.1f} {total:>8.2f} {peak:>9.1f} {size / (1024 * 1024):>8.1f}")
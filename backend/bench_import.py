@@ -0,0 +1,91 @@
+"""Benchmark bulk catalogue import against one-book-at-a-time inserts
+
+Generates a synthetic CSV catalogue, imports it into a fresh database
+with catalogue_import.import_books(), and compares the throughput with
+the add_book() pattern of one INSERT, commit and re-SELECT per book.
+
+Usage:
+    python bench_import.py --rows 500000 --baseline-rows 5000
+"""
+import argparse
+import csv
+import os
+import tempfile
+import time
+import database
+from catalogue_import import import_books, read_csv
+
+def write_catalogue(path, rows):
+    """Write a synthetic catalogue with ``rows`` books"""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['isbn', 'title', 'author', 'category', 'total_copies', 'available_copies', 'description'])
+        for i in range(rows):
+            copies = i % 5 + 1
+            writer.writerow([
+                f'979-{i:010d}',
+                f'Synthetic Title {i}',
+                f'Author {i % 10007}',
+                f'Category {i % 50}',
+                copies,
+                copies,
+                f'Generated record number {i} for import benchmarking'
+            ])
+
+def fresh_database(directory, name):
+    """Point database.py at a new file and create the schema"""
+    database.close_pool()
+    database.DATABASE = os.path.join(directory, name)
+    database.init_db()
+    return database.get_db()
+
+def bench_bulk(directory, catalogue, batch_size):
+    conn = fresh_database(directory, 'bulk.db')
+    try:
+        with open(catalogue, encoding='utf-8', newline='') as f:
+            return import_books(conn, read_csv(f), batch_size)
+    finally:
+        database.release_db(conn)
+
+def bench_single(directory, catalogue, rows):
+    """The add_book() pattern: INSERT, commit, then re-SELECT the row"""
+    conn = fresh_database(directory, 'single.db')
+    try:
+        started = time.perf_counter()
+        with open(catalogue, encoding='utf-8', newline='') as f:
+            for count, record in enumerate(csv.DictReader(f)):
+                if count >= rows:
+                    break
+                cursor = conn.execute(
+                    '''INSERT INTO books (isbn, title, author, category, total_copies, available_copies, description)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    (record['isbn'], record['title'], record['author'], record['category'],
+                     record['total_copies'], record['available_copies'], record['description'])
+                )
+                conn.commit()
+                conn.execute('SELECT * FROM books WHERE id = ?', (cursor.lastrowid,)).fetchone()
+        elapsed = time.perf_counter() - started
+        return {'processed': rows, 'elapsed_seconds': round(elapsed, 3), 'rows_per_second': round(rows / elapsed, 1)}
+    finally:
+        database.release_db(conn)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark bulk catalogue import')
+    parser.add_argument('--rows', type=int, default=100000, help='books in the synthetic catalogue')
+    parser.add_argument('--baseline-rows', type=int, default=2000, help='books to insert one at a time')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows per bulk transaction')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    catalogue = os.path.join(directory, 'catalogue.csv')
+    write_catalogue(catalogue, args.rows)
+
+    bulk = bench_bulk(directory, catalogue, args.batch_size)
+    single = bench_single(directory, catalogue, min(args.baseline_rows, args.rows))
+
+    print()
+    print(f"Bulk import:   {bulk['imported']} rows in {bulk['elapsed_seconds']}s "
+          f"({bulk['rows_per_second']} rows/s, {bulk['failed']} failed)")
+    print(f"Single insert: {single['processed']} rows in {single['elapsed_seconds']}s "
+          f"({single['rows_per_second']} rows/s)")
+    print(f"Speedup: {bulk['rows_per_second'] / single['rows_per_second']:.1f}x")
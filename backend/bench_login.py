@@ -0,0 +1,88 @@
+"""Login throughput benchmark at several scrypt cost settings
+
+For each cost, seeds users hashed at that cost and drives POST
+/api/auth/login from a fixed number of client threads, then reports
+throughput and p50/p99 latency.
+
+Usage:
+    python bench_login.py --costs 4096 16384 32768 --threads 8 --logins 400
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+import database
+import passwords
+from config import Config
+
+USERS = 20
+PASSWORD = 'benchmark-password'
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def seed_users(cost):
+    """Fresh database with USERS accounts hashed at the given scrypt N"""
+    Config.PASSWORD_SCRYPT_N = cost
+    database.close_pool()
+    database.DATABASE = os.path.join(tempfile.mkdtemp(), 'library.db')
+    database.init_db()
+
+    conn = database.get_db()
+    try:
+        for i in range(USERS):
+            conn.execute(
+                'INSERT INTO users (email, password, full_name) VALUES (?, ?, ?)',
+                (f'bench{i}@library.com', passwords.hash_password(PASSWORD), f'Bench User {i}')
+            )
+        conn.commit()
+    finally:
+        database.release_db(conn)
+
+def run_logins(app, threads, logins):
+    latencies = []
+    statuses = []
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        client = app.test_client()
+        for i in range(worker_id, logins, threads):
+            started = time.perf_counter()
+            response = client.post('/api/auth/login', json={
+                'email': f'bench{i % USERS}@library.com',
+                'password': PASSWORD
+            })
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses.append(response.status_code)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies, statuses, time.perf_counter() - started
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark login at several scrypt costs')
+    parser.add_argument('--costs', type=int, nargs='+', default=[2 ** 12, 2 ** 14, 2 ** 15], help='scrypt N values')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--logins', type=int, default=200, help='logins per cost setting')
+    args = parser.parse_args()
+
+    # Every client thread logs in from the same address
+    Config.RATE_LIMIT_ENABLED = False
+    from app import app
+
+    print(f"{'scrypt N':>10} {'logins/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for cost in args.costs:
+        seed_users(cost)
+        latencies, statuses, elapsed = run_logins(app, args.threads, args.logins)
+        errors = len([status for status in statuses if status != 200])
+        print(f"{cost:>10} {len(latencies) / elapsed:>10.1f} "
+              f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f} {errors:>7}")
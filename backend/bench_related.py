@@ -0,0 +1,161 @@
+"""Build, refresh and lookup cost of the related-books table
+
+Seeds a synthetic loan history (books grouped into taste clusters, with
+skewed popularity inside each cluster), runs a full related.build(),
+then adds ``--new-loans`` loans and times related.refresh() with the
+history kept in memory and read afresh. Finally it times
+GET /api/books/<id>/related against computing the same list with a
+self-join on loans per request, for the most borrowed books and for
+random ones.
+
+Usage:
+    python bench_related.py --loans 10000000 --users 1000000 --books 200000
+    python bench_related.py --database /tmp/related.db --skip-seed   # reuse a seeded file
+"""
+import argparse
+import os
+import random
+import resource
+import tempfile
+import time
+import database
+import related
+from config import Config
+
+CLUSTERS = 50
+CHUNK_SIZE = 100000
+
+SELF_JOIN = '''
+    SELECT other.book_id, COUNT(DISTINCT other.user_id) AS borrowers
+    FROM loans this
+    JOIN loans other ON other.user_id = this.user_id AND other.book_id != this.book_id
+    WHERE this.book_id = ?
+    GROUP BY other.book_id
+    ORDER BY borrowers DESC, other.book_id
+    LIMIT ?
+'''
+
+def loan_history(rng, count, users, books):
+    """(user_id, book_id) loans: mostly from the user's cluster, popular books first"""
+    size = books // CLUSTERS
+    for _ in range(count):
+        user = rng.randint(1, users)
+        if rng.random() < 0.7:
+            book = (user % CLUSTERS) * size + int(size * rng.random() ** 3)
+        else:
+            book = int(books * rng.random() ** 3)
+        yield user + 1, book + 1  # user 1 is the admin
+
+def add_loans(conn, loans):
+    chunk = []
+    for loan in loans:
+        chunk.append(loan)
+        if len(chunk) == CHUNK_SIZE:
+            _insert_loans(conn, chunk)
+            chunk = []
+    if chunk:
+        _insert_loans(conn, chunk)
+
+def _insert_loans(conn, chunk):
+    conn.executemany('''
+        INSERT INTO loans (user_id, book_id, borrow_date, due_date, return_date, status)
+        VALUES (?, ?, '2024-01-01', '2024-01-15', '2024-01-10', 'returned')
+    ''', chunk)
+    conn.commit()
+
+def seed(conn, rng, books, users, loans):
+    conn.execute('DELETE FROM books')
+    conn.executemany(
+        'INSERT INTO books (id, isbn, title, author, total_copies, available_copies) VALUES (?, ?, ?, ?, 1, 1)',
+        [(i, f'bench-{i}', f'Bench Book {i}', 'Bench Author') for i in range(1, books + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO users (id, email, password, full_name) VALUES (?, ?, ?, ?)',
+        [(i + 1, f'bench{i}@library.com', 'x', f'Bench User {i}') for i in range(1, users + 1)]
+    )
+    conn.commit()
+    add_loans(conn, loan_history(rng, loans, users, books))
+
+def timed(run):
+    started = time.perf_counter()
+    result = run()
+    return result, time.perf_counter() - started
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def lookups(run, book_ids):
+    """(p50, p99) milliseconds of ``run(book_id)`` over ``book_ids``"""
+    latencies = []
+    for book_id in book_ids:
+        started = time.perf_counter()
+        run(book_id)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the related-books model')
+    parser.add_argument('--loans', type=int, default=10000000, help='loans in the synthetic history')
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--books', type=int, default=200000)
+    parser.add_argument('--new-loans', type=int, default=10000, help='loans added before the refresh')
+    parser.add_argument('--requests', type=int, default=2000, help='endpoint lookups per book set')
+    parser.add_argument('--baseline-requests', type=int, default=20, help='self-join lookups per book set')
+    parser.add_argument('--database', help='SQLite file (default: a new temporary file)')
+    parser.add_argument('--skip-seed', action='store_true', help='use a history seeded by an earlier run')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    database.close_pool()
+    database.DATABASE = args.database or os.path.join(tempfile.mkdtemp(), 'library.db')
+    database.init_db()
+
+    from app import app
+
+    conn = database.get_db()
+    if not args.skip_seed:
+        _, seconds = timed(lambda: seed(conn, rng, args.books, args.users, args.loans))
+        print(f"Seeded {args.loans} loans in {seconds:.1f}s")
+    loans = conn.execute('SELECT COUNT(*) AS n FROM loans').fetchone()['n']
+
+    history = related.LoanHistory()
+    count, seconds = timed(lambda: related.build(conn, history=history))
+    print(f"Full build:  {loans} loans, {count} books in {seconds:.1f}s "
+          f"({loans / seconds:,.0f} loans/s, peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB)")
+
+    # As the background refresher runs, with the history in memory, then
+    # as a one-off run that has to read it first
+    for name, kept in [('warm', history), ('cold', None)]:
+        add_loans(conn, loan_history(rng, args.new_loans, args.users, args.books))
+        count, seconds = timed(lambda: related.refresh(conn, history=kept))
+        print(f"Refresh ({name}): {args.new_loans} new loans, {count} books recomputed in {seconds:.1f}s")
+
+    client = app.test_client()
+    token = client.post('/api/auth/login', json={'email': 'admin@library.com', 'password': 'admin123'})
+    headers = {'Authorization': f"Bearer {token.get_json()['access_token']}"}
+
+    popular = [row['book_id'] for row in conn.execute('''
+        SELECT book_id FROM loans GROUP BY book_id ORDER BY COUNT(*) DESC LIMIT 100
+    ''').fetchall()]
+    books = {
+        'popular': popular,
+        'random': [rng.randint(1, args.books) for _ in range(100)]
+    }
+
+    def endpoint(book_id):
+        assert client.get(f'/api/books/{book_id}/related', headers=headers).status_code == 200
+
+    def self_join(book_id):
+        conn.execute(SELF_JOIN, (book_id, Config.RELATED_TOP_K)).fetchall()
+
+    print(f"{'lookup':>20} {'books':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, book_ids in books.items():
+        for method, run, requests in [
+            ('endpoint', endpoint, args.requests), ('self-join', self_join, args.baseline_requests)
+        ]:
+            sample = [book_ids[i % len(book_ids)] for i in range(requests)]
+            p50, p99 = lookups(run, sample)
+            print(f"{method:>20} {name:>8} {p50:>9.2f} {p99:>9.2f}")
+    database.release_db(conn)
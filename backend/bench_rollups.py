@@ -0,0 +1,205 @@
+"""Loan rollups against GROUP BY over loans, and their cost on the borrow path
+
+Seeds ``--years`` of loan history (borrow dates spread evenly, most loans
+returned within a month), times database.rebuild_rollups(), then times
+GET /api/stats/timeseries and /api/stats/top against the GROUP BY
+queries over loans they replace. Finally it times single borrow and
+return transactions with the rollup triggers in place and dropped.
+
+Usage:
+    python bench_rollups.py --loans 3000000 --years 5
+    python bench_rollups.py --database /tmp/rollups.db --skip-seed   # reuse a seeded file
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+import circulation
+import database
+import timeseries
+
+CHUNK_SIZE = 100000
+
+RAW_SERIES = '''
+    SELECT period, SUM(borrows), SUM(returns), SUM(borrowers) FROM (
+        SELECT {period} AS period, COUNT(*) AS borrows, 0 AS returns, COUNT(DISTINCT user_id) AS borrowers
+        FROM loans WHERE borrow_date >= ? AND borrow_date < ? GROUP BY 1
+        UNION ALL
+        SELECT {returned}, 0, COUNT(*), 0
+        FROM loans WHERE status = 'returned' AND return_date >= ? AND return_date < ? GROUP BY 1
+    ) GROUP BY period
+'''
+
+RAW_TOP = '''
+    SELECT book_id, COUNT(*) AS borrows FROM loans
+    WHERE borrow_date >= ? AND borrow_date < ?
+    GROUP BY book_id ORDER BY borrows DESC, book_id LIMIT 10
+'''
+
+def rollup_triggers(conn):
+    return [row['sql'] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'loan_rollups_%'"
+    ).fetchall()]
+
+def drop_triggers(conn):
+    for name in ['loan_rollups_borrow', 'loan_rollups_returned', 'loan_rollups_return']:
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    conn.commit()
+
+def restore_triggers(conn, triggers):
+    for sql in triggers:
+        conn.execute(sql)
+    conn.commit()
+
+def loan_history(rng, count, start, seconds, users, books):
+    """Loans as insert parameters
+
+    Only one loan per (user, book) may be active, as
+    idx_loans_active_user_book enforces; a repeat is returned the moment
+    it is borrowed.
+    """
+    active = set()
+    for _ in range(count):
+        user_id, book_id = rng.randint(2, users + 1), rng.randint(1, books)
+        borrowed = start + timedelta(seconds=rng.randrange(seconds))
+        returned = borrowed + timedelta(seconds=rng.randrange(30 * 86400))
+        if returned > start + timedelta(seconds=seconds):
+            if (user_id, book_id) in active:
+                returned = borrowed
+            else:
+                active.add((user_id, book_id))
+                returned = None
+        yield (
+            user_id, book_id, borrowed.strftime('%Y-%m-%d %H:%M:%S'),
+            (borrowed + circulation.LOAN_PERIOD).strftime('%Y-%m-%d %H:%M:%S'),
+            returned and returned.strftime('%Y-%m-%d %H:%M:%S'), 'returned' if returned else 'active'
+        )
+
+def seed(conn, rng, loans, years, books, users):
+    """Seed with the rollup triggers dropped; rebuild_rollups() fills them"""
+    triggers = rollup_triggers(conn)
+    drop_triggers(conn)
+    conn.execute('DELETE FROM books')
+    conn.executemany(
+        'INSERT INTO books (id, isbn, title, author, total_copies, available_copies) VALUES (?, ?, ?, ?, 1000, 1000)',
+        [(i, f'bench-{i}', f'Bench Book {i}', 'Bench Author') for i in range(1, books + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO users (id, email, password, full_name) VALUES (?, ?, ?, ?)',
+        [(i + 1, f'bench{i}@library.com', 'x', f'Bench User {i}') for i in range(1, users + 1)]
+    )
+    conn.commit()
+    seconds = int(years * 365 * 86400)
+    start = timeseries.period_start('day', timeseries.utcnow()) - timedelta(seconds=seconds)
+    chunk = []
+    for loan in loan_history(rng, loans, start, seconds, users, books):
+        chunk.append(loan)
+        if len(chunk) == CHUNK_SIZE:
+            _insert(conn, chunk)
+            chunk = []
+    if chunk:
+        _insert(conn, chunk)
+    restore_triggers(conn, triggers)
+
+def _insert(conn, chunk):
+    conn.executemany('''
+        INSERT INTO loans (user_id, book_id, borrow_date, due_date, return_date, status)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', chunk)
+    conn.commit()
+
+def timed(run):
+    started = time.perf_counter()
+    result = run()
+    return result, time.perf_counter() - started
+
+def median_ms(run, repeat):
+    samples = sorted(timed(run)[1] for _ in range(repeat))
+    return samples[len(samples) // 2] * 1000
+
+def circulation_us(conn, rng, count, users, books):
+    """Median microseconds of a borrow and of a return transaction"""
+    borrows, returns = [], []
+    for _ in range(count):
+        user_id, book_id = rng.randint(2, users + 1), rng.randint(1, books)
+        (loan, status), seconds = timed(lambda: database.run_immediate(
+            conn, lambda conn: circulation.borrow(conn, user_id, book_id)
+        ))
+        if status != 201:
+            continue
+        borrows.append(seconds)
+        _, seconds = timed(lambda: database.run_immediate(
+            conn, lambda conn: circulation.return_loan(conn, loan['id'], user_id, is_admin=True)
+        ))
+        returns.append(seconds)
+    return [sorted(samples)[len(samples) // 2] * 1e6 for samples in (borrows, returns)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the loan rollups')
+    parser.add_argument('--loans', type=int, default=3000000, help='loans in the synthetic history')
+    parser.add_argument('--years', type=float, default=5, help='span of the history')
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per query (median reported)')
+    parser.add_argument('--borrows', type=int, default=2000, help='borrow/return transactions per trigger setting')
+    parser.add_argument('--database', help='SQLite file (default: a new temporary file)')
+    parser.add_argument('--skip-seed', action='store_true', help='use a history seeded by an earlier run')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    database.close_pool()
+    database.DATABASE = args.database or os.path.join(tempfile.mkdtemp(), 'library.db')
+    database.init_db()
+
+    from app import app
+
+    conn = database.get_db()
+    if not args.skip_seed:
+        _, seconds = timed(lambda: seed(conn, rng, args.loans, args.years, args.books, args.users))
+        print(f"Seeded {args.loans} loans over {args.years} years in {seconds:.1f}s")
+        _, seconds = timed(lambda: database.rebuild_rollups(conn))
+        print(f"Rebuilt rollups in {seconds:.1f}s ({args.loans / seconds:,.0f} loans/s)")
+    loans = conn.execute('SELECT COUNT(*) AS n FROM loans').fetchone()['n']
+    rows = conn.execute('SELECT COUNT(*) AS n FROM book_rollups').fetchone()['n']
+    print(f"{loans} loans, {rows} book rollup rows")
+
+    client = app.test_client()
+    token = client.post('/api/auth/login', json={'email': 'admin@library.com', 'password': 'admin123'})
+    headers = {'Authorization': f"Bearer {token.get_json()['access_token']}"}
+
+    now = timeseries.utcnow()
+    end = timeseries.next_period('day', timeseries.period_start('day', now))
+    cases = []
+    for interval, span in [('day', timedelta(days=int(args.years * 365))), ('week', timedelta(days=365)),
+                           ('hour', timedelta(days=7))]:
+        start = timeseries.period_start(interval, end - span)
+        expression = database.ROLLUP_PERIODS[interval]
+        raw = RAW_SERIES.format(period=expression.format(ts='borrow_date'), returned=expression.format(ts='return_date'))
+        bounds = (str(start), str(end)) * 2
+        path = f'/api/stats/timeseries?interval={interval}&start={start.isoformat()}&end={end.isoformat()}'
+        cases.append((f'{interval} series, {span.days}d', path, raw, bounds))
+    for interval in ['week', 'month']:
+        start = timeseries.period_start(interval, now)
+        bounds = (str(start), str(timeseries.next_period(interval, start)))
+        cases.append((f'top books, this {interval}', f'/api/stats/top?interval={interval}', RAW_TOP, bounds))
+
+    print(f"{'query':>26} {'rollups ms':>11} {'GROUP BY ms':>12} {'speedup':>8}")
+    for name, path, raw, bounds in cases:
+        assert client.get(path, headers=headers).status_code == 200
+        rollup = median_ms(lambda: client.get(path, headers=headers), args.repeat)
+        baseline = median_ms(lambda: conn.execute(raw, bounds).fetchall(), args.repeat)
+        print(f"{name:>26} {rollup:>11.2f} {baseline:>12.1f} {baseline / rollup:>7.0f}x")
+
+    triggers = rollup_triggers(conn)
+    with_triggers = circulation_us(conn, rng, args.borrows, args.users, args.books)
+    drop_triggers(conn)
+    without_triggers = circulation_us(conn, rng, args.borrows, args.users, args.books)
+    restore_triggers(conn, triggers)
+    database.rebuild_rollups(conn)
+    print(f"{'transaction':>26} {'triggers us':>11} {'without us':>12}")
+    for name, kept, dropped in zip(['borrow', 'return'], with_triggers, without_triggers):
+        print(f"{name:>26} {kept:>11.0f} {dropped:>12.0f}")
+    database.release_db(conn)
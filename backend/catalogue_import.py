@@ -0,0 +1,272 @@
+"""Bulk catalogue import from CSV or NDJSON
+
+Records are streamed, validated one at a time and written with batched
+executemany() calls, one transaction per batch, so memory stays bounded
+no matter how large the input is. Books are upserted on ISBN; copies an
+upsert adds to a book with waiting holds go to those holds, as returns do.
+
+Usage:
+    python catalogue_import.py books.csv
+    python catalogue_import.py books.ndjson --batch-size 5000
+"""
+import codecs
+import csv
+import json
+import time
+import circulation
+from config import Config
+from database import IntegrityError
+import events
+
+BOOK_FIELDS = ['isbn', 'title', 'author', 'category', 'total_copies', 'available_copies', 'description']
+
+# Keep the error report bounded for badly broken files
+MAX_REPORTED_ERRORS = 1000
+
+# Raised while reading the input itself; the import stops there
+READ_ERRORS = (UnicodeDecodeError, csv.Error)
+
+UPSERT_BOOK = '''
+    INSERT INTO books (isbn, title, author, category, total_copies, available_copies, description)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (isbn) DO UPDATE SET
+        title = excluded.title,
+        author = excluded.author,
+        category = excluded.category,
+        description = excluded.description,
+        available_copies = CASE
+            WHEN books.available_copies + excluded.total_copies - books.total_copies > 0
+            THEN books.available_copies + excluded.total_copies - books.total_copies
+            ELSE 0
+        END,
+        total_copies = excluded.total_copies
+'''
+
+def read_csv(lines):
+    """Yield (row_number, record) from CSV text lines with a header row"""
+    reader = csv.DictReader(lines)
+    for record in reader:
+        yield reader.line_num, record
+
+def read_ndjson(lines):
+    """Yield (row_number, record) from newline-delimited JSON
+
+    Lines that are not valid JSON objects are yielded as a ValueError so
+    they end up in the error report rather than aborting the import.
+    """
+    for row_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield row_number, ValueError(f'Invalid JSON: {e}')
+            continue
+        if not isinstance(record, dict):
+            yield row_number, ValueError('Expected a JSON object')
+            continue
+        yield row_number, record
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson
+}
+
+def decode_lines(stream, encoding='utf-8'):
+    """Iterate text lines from a binary stream without reading it all"""
+    return codecs.iterdecode(stream, encoding)
+
+def _optional_text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def _copies(value, default):
+    if value is None or value == '':
+        return default
+    copies = int(value)
+    if copies < 0:
+        raise ValueError('Copies cannot be negative')
+    return copies
+
+def book_params(record):
+    """Validate a record and turn it into UPSERT_BOOK parameters"""
+    title = _optional_text(record.get('title'))
+    author = _optional_text(record.get('author'))
+    if not title or not author:
+        raise ValueError('Missing title or author')
+
+    try:
+        total_copies = _copies(record.get('total_copies'), 1)
+        available_copies = _copies(record.get('available_copies'), total_copies)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Invalid copies: {e}')
+
+    if available_copies > total_copies:
+        raise ValueError('available_copies cannot exceed total_copies')
+
+    return (
+        _optional_text(record.get('isbn')),
+        title,
+        author,
+        _optional_text(record.get('category')),
+        total_copies,
+        available_copies,
+        _optional_text(record.get('description'))
+    )
+
+def _imported(params):
+    """One event per batch, listing the ISBNs (where given) it wrote"""
+    return [('books.imported', None, {'count': len(params), 'isbns': [row[0] for row in params if row[0]]})]
+
+# ISBNs per lookup of upserted books that have waiting holds
+HOLD_LOOKUP_CHUNK = 500
+
+def _fill_holds(conn, params):
+    """Hand copies an upsert put on the shelf to the books' waiting holds
+
+    Returns the hold.ready events.
+    """
+    ready = []
+    isbns = [row[0] for row in params if row[0]]
+    for start in range(0, len(isbns), HOLD_LOOKUP_CHUNK):
+        chunk = isbns[start:start + HOLD_LOOKUP_CHUNK]
+        books = conn.execute(f'''
+            SELECT id FROM books b
+            WHERE isbn IN ({', '.join('?' * len(chunk))}) AND available_copies > 0
+              AND EXISTS (SELECT 1 FROM holds h WHERE h.book_id = b.id AND h.status = 'waiting')
+            ORDER BY id
+        ''', chunk).fetchall()
+        for book in books:
+            ready += [events.hold_ready(hold_id, book['id']) for hold_id in circulation.fill_holds(conn, book['id'])]
+    return ready
+
+def _write_batch(conn, batch, result, actor_id=None):
+    """Write one batch in its own transaction
+
+    The whole batch goes through a single executemany(). If the database
+    rejects a row as invalid, the batch is replayed row by row so only the
+    bad rows are reported and the rest still land. Any other database
+    error (a busy or locked database, a lost connection) is raised with
+    the batch rolled back.
+    """
+    try:
+        conn.executemany(UPSERT_BOOK, [params for _, params in batch])
+        ready = _fill_holds(conn, [params for _, params in batch])
+        events.append(conn, actor_id, _imported([params for _, params in batch]) + ready)
+        conn.commit()
+        result['imported'] += len(batch)
+        return
+    except IntegrityError:
+        conn.rollback()
+    except Exception:
+        conn.rollback()
+        raise
+
+    # A savepoint per row, since a failed statement aborts the whole
+    # transaction on PostgreSQL; the outer one keeps the batch in a single
+    # transaction on SQLite
+    written = []
+    try:
+        conn.execute('SAVEPOINT import_batch')
+        for row_number, params in batch:
+            conn.execute('SAVEPOINT import_row')
+            try:
+                conn.execute(UPSERT_BOOK, params)
+                written.append((row_number, params))
+            except IntegrityError as e:
+                conn.execute('ROLLBACK TO import_row')
+                _record_error(result, row_number, str(e))
+            conn.execute('RELEASE import_row')
+        conn.execute('RELEASE import_batch')
+        ready = _fill_holds(conn, [params for _, params in written])
+        if written:
+            events.append(conn, actor_id, _imported([params for _, params in written]) + ready)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    result['imported'] += len(written)
+
+def _record_error(result, row_number, message):
+    result['failed'] += 1
+    if len(result['errors']) < MAX_REPORTED_ERRORS:
+        result['errors'].append({'row': row_number, 'error': message})
+
+def _readable(records, result):
+    """Yield records until the input cannot be read, noting why in ``result``"""
+    try:
+        yield from records
+    except READ_ERRORS as e:
+        result['error'] = f'Could not read import: {e}'
+
+def import_books(conn, records, batch_size=Config.IMPORT_BATCH_SIZE, progress=None, actor_id=None):
+    """Upsert books from an iterable of (row_number, record)
+
+    Returns a summary with counts, per-row errors and throughput. If given,
+    ``progress`` is called with the running summary after every batch.
+    Each batch appends a ``books.imported`` event by ``actor_id``. Input
+    that stops decoding part-way ends the import after writing the rows
+    read so far, with the reason in the summary's ``error``.
+    """
+    started = time.perf_counter()
+    result = {'processed': 0, 'imported': 0, 'failed': 0, 'errors': []}
+    batch = []
+
+    for row_number, record in _readable(records, result):
+        result['processed'] += 1
+        try:
+            if isinstance(record, Exception):
+                raise record
+            batch.append((row_number, book_params(record)))
+        except ValueError as e:
+            _record_error(result, row_number, str(e))
+            continue
+
+        if len(batch) >= batch_size:
+            _write_batch(conn, batch, result, actor_id)
+            batch = []
+            if progress:
+                progress(result)
+
+    if batch:
+        _write_batch(conn, batch, result, actor_id)
+
+    elapsed = time.perf_counter() - started
+    result['elapsed_seconds'] = round(elapsed, 3)
+    result['rows_per_second'] = round(result['processed'] / elapsed, 1) if elapsed > 0 else None
+    return result
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import database
+
+    parser = argparse.ArgumentParser(description='Bulk import books from CSV or NDJSON')
+    parser.add_argument('path', help='file to import')
+    parser.add_argument('--format', choices=sorted(READERS), help='input format (default: from file extension)')
+    parser.add_argument('--batch-size', type=int, default=Config.IMPORT_BATCH_SIZE, help='rows per transaction')
+    parser.add_argument('--database', default=database.DATABASE, help='SQLite database file')
+    args = parser.parse_args()
+
+    input_format = args.format or ('ndjson' if os.path.splitext(args.path)[1] in ['.ndjson', '.jsonl'] else 'csv')
+    database.DATABASE = args.database
+    database.init_db()
+
+    def report(result):
+        print(f"{result['processed']} rows processed, {result['failed']} failed")
+
+    conn = database.get_db()
+    try:
+        with open(args.path, encoding='utf-8', newline='') as f:
+            result = import_books(conn, READERS[input_format](f), args.batch_size, progress=report)
+    finally:
+        database.release_db(conn)
+
+    for error in result['errors']:
+        print(f"Row {error['row']}: {error['error']}")
+    if 'error' in result:
+        print(result['error'])
+    print(f"Imported {result['imported']} of {result['processed']} rows "
+          f"in {result['elapsed_seconds']}s ({result['rows_per_second']} rows/s)")
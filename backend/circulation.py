@@ -0,0 +1,249 @@
+"""Borrow and return operations
+
+Each function runs inside the caller's transaction (see
+database.run_immediate) and returns ``(body, status)`` for the response,
+so single and batch endpoints share the same invariants:
+
+- a copy is only taken by a guarded ``UPDATE ... WHERE available_copies > 0``
+- the unique partial index on active (user_id, book_id) rejects a second
+  active loan of the same book
+- a loan is only returned once, by a guarded ``UPDATE ... WHERE status = 'active'``
+- a returned copy goes to the first waiting hold (which becomes 'ready')
+  before it goes back on the shelf, and only that hold's owner can borrow it;
+  copies added to the shelf otherwise (an edit, an import) are handed to
+  waiting holds the same way by fill_holds()
+
+Dates are naive UTC, like the database's CURRENT_TIMESTAMP that fills
+borrow_date and return_date, so due and ready dates compare with them.
+
+On SQLite the caller's BEGIN IMMEDIATE already serializes writers. On
+PostgreSQL each operation first locks the book's row (lock_book), so
+operations on the same book queue up while other books proceed.
+"""
+from datetime import timedelta
+from database import IntegrityError, dialect
+from timeseries import utcnow
+
+LOAN_PERIOD = timedelta(days=14)  # 2 weeks loan period
+
+def lock_book(conn, book_id):
+    """Hold the book's row lock until the transaction ends (PostgreSQL)"""
+    if dialect(conn) == 'postgresql':
+        conn.execute('SELECT id FROM books WHERE id = ? FOR UPDATE', (book_id,))
+
+def borrow(conn, user_id, book_id):
+    """Check out one copy of a book for a user"""
+    conn.execute('SAVEPOINT borrow')
+    lock_book(conn, book_id)
+
+    hold = conn.execute(
+        "SELECT id, status FROM holds WHERE user_id = ? AND book_id = ? AND status IN ('waiting', 'ready')",
+        (user_id, book_id)
+    ).fetchone()
+
+    # A ready hold already has a copy set aside; otherwise take one off the shelf
+    if hold is None or hold['status'] != 'ready':
+        cursor = conn.execute(
+            'UPDATE books SET available_copies = available_copies - 1 WHERE id = ? AND available_copies > 0',
+            (book_id,)
+        )
+        if cursor.rowcount == 0:
+            conn.execute('RELEASE borrow')
+            if not conn.execute('SELECT 1 FROM books WHERE id = ?', (book_id,)).fetchone():
+                return {'error': 'Book not found'}, 404
+            return {'error': 'Book is not available'}, 400
+
+    try:
+        loan_id = conn.execute(
+            'INSERT INTO loans (user_id, book_id, due_date) VALUES (?, ?, ?) RETURNING id',
+            (user_id, book_id, utcnow() + LOAN_PERIOD)
+        ).fetchone()['id']
+    except IntegrityError:
+        conn.execute('ROLLBACK TO borrow')
+        conn.execute('RELEASE borrow')
+        return {'error': 'You already have this book borrowed'}, 400
+
+    if hold is not None:
+        conn.execute("UPDATE holds SET status = 'fulfilled' WHERE id = ?", (hold['id'],))
+
+    loan = conn.execute('''
+        SELECT l.*, b.title, b.author
+        FROM loans l
+        JOIN books b ON l.book_id = b.id
+        WHERE l.id = ?
+    ''', (loan_id,)).fetchone()
+
+    conn.execute('RELEASE borrow')
+    return dict(loan), 201
+
+def return_loan(conn, loan_id, user_id, is_admin=False):
+    """Return a loan and put its copy back on the shelf"""
+    loan = conn.execute('SELECT * FROM loans WHERE id = ?', (loan_id,)).fetchone()
+
+    if not loan:
+        return {'error': 'Loan not found'}, 404
+
+    # Check if user owns this loan or is admin
+    if loan['user_id'] != user_id and not is_admin:
+        return {'error': 'Unauthorized'}, 403
+
+    lock_book(conn, loan['book_id'])
+    # The database clock, like borrow_date, so both are UTC
+    cursor = conn.execute(
+        "UPDATE loans SET return_date = CURRENT_TIMESTAMP, status = 'returned' WHERE id = ? AND status = 'active'",
+        (loan_id,)
+    )
+    if cursor.rowcount == 0:
+        return {'error': 'Book already returned'}, 400
+
+    ready_hold_id = release_copy(conn, loan['book_id'])
+
+    return {
+        'message': 'Book returned successfully', 'loan_id': loan_id, 'book_id': loan['book_id'],
+        'ready_hold_id': ready_hold_id
+    }, 200
+
+def _next_waiting_hold(conn, book_id):
+    hold = conn.execute('''
+        SELECT id FROM holds
+        WHERE book_id = ? AND status = 'waiting'
+        ORDER BY hold_date, id
+        LIMIT 1
+    ''', (book_id,)).fetchone()
+    return hold['id'] if hold else None
+
+def _make_ready(conn, hold_id):
+    conn.execute(
+        "UPDATE holds SET status = 'ready', ready_date = ? WHERE id = ?",
+        (utcnow(), hold_id)
+    )
+
+def release_copy(conn, book_id):
+    """Give a copy that came back to the next waiting hold, or to the shelf
+
+    Returns the id of the hold that became ready, or None.
+    """
+    hold_id = _next_waiting_hold(conn, book_id)
+    if hold_id is not None:
+        _make_ready(conn, hold_id)
+        return hold_id
+
+    conn.execute(
+        'UPDATE books SET available_copies = available_copies + 1 WHERE id = ?',
+        (book_id,)
+    )
+    return None
+
+def fill_holds(conn, book_id):
+    """Move copies on the shelf to waiting holds, oldest hold first
+
+    For copies that arrive other than by a return or a cancelled hold: a
+    raised available_copies or an import. Returns the ids of the holds
+    that became ready.
+    """
+    lock_book(conn, book_id)
+    ready = []
+    while True:
+        hold_id = _next_waiting_hold(conn, book_id)
+        if hold_id is None:
+            return ready
+        cursor = conn.execute(
+            'UPDATE books SET available_copies = available_copies - 1 WHERE id = ? AND available_copies > 0',
+            (book_id,)
+        )
+        if cursor.rowcount == 0:
+            return ready
+        _make_ready(conn, hold_id)
+        ready.append(hold_id)
+
+def expire_hold(conn, hold_id, book_id):
+    """Give up a ready hold that was not collected; its copy is released
+
+    Returns None if the hold is no longer ready, otherwise
+    {'hold_id', 'book_id', 'ready_hold_id'} like cancel_hold().
+    """
+    lock_book(conn, book_id)
+    cursor = conn.execute(
+        "UPDATE holds SET status = 'expired' WHERE id = ? AND status = 'ready'", (hold_id,)
+    )
+    if cursor.rowcount == 0:
+        return None
+    return {'hold_id': hold_id, 'book_id': book_id, 'ready_hold_id': release_copy(conn, book_id)}
+
+# Queue position of each waiting hold: a count over the per-book range of
+# idx_holds_book_waiting up to the hold itself, never a scan of all holds.
+# That is O(log n + position); a stored position would have to be
+# renumbered for the rest of the queue on every borrow or cancel.
+HOLD_SELECT = '''
+    SELECT h.*, b.title, b.author,
+        CASE WHEN h.status = 'waiting' THEN (
+            SELECT COUNT(*) FROM holds q
+            WHERE q.book_id = h.book_id AND q.status = 'waiting'
+              AND (q.hold_date, q.id) <= (h.hold_date, h.id)
+        ) END AS position
+    FROM holds h
+    JOIN books b ON h.book_id = b.id
+'''
+
+def list_holds(conn, user_id):
+    """A user's waiting and ready holds, oldest first, with queue positions"""
+    rows = conn.execute(
+        HOLD_SELECT + " WHERE h.user_id = ? AND h.status IN ('waiting', 'ready') ORDER BY h.hold_date, h.id",
+        (user_id,)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+def place_hold(conn, user_id, book_id):
+    """Join the FIFO queue for a book that has no copies on the shelf"""
+    lock_book(conn, book_id)
+    book = conn.execute('SELECT available_copies FROM books WHERE id = ?', (book_id,)).fetchone()
+
+    if not book:
+        return {'error': 'Book not found'}, 404
+
+    if book['available_copies'] > 0:
+        return {'error': 'Book is available, borrow it instead'}, 400
+
+    if conn.execute(
+        "SELECT 1 FROM loans WHERE user_id = ? AND book_id = ? AND status = 'active'",
+        (user_id, book_id)
+    ).fetchone():
+        return {'error': 'You already have this book borrowed'}, 400
+
+    conn.execute('SAVEPOINT place_hold')
+    try:
+        hold_id = conn.execute(
+            'INSERT INTO holds (user_id, book_id) VALUES (?, ?) RETURNING id', (user_id, book_id)
+        ).fetchone()['id']
+    except IntegrityError:
+        conn.execute('ROLLBACK TO place_hold')
+        conn.execute('RELEASE place_hold')
+        return {'error': 'You already have a hold on this book'}, 400
+    conn.execute('RELEASE place_hold')
+
+    hold = conn.execute(HOLD_SELECT + ' WHERE h.id = ?', (hold_id,)).fetchone()
+    return dict(hold), 201
+
+def cancel_hold(conn, hold_id, user_id, is_admin=False):
+    """Leave the queue; a ready hold passes its copy on"""
+    hold = conn.execute('SELECT * FROM holds WHERE id = ?', (hold_id,)).fetchone()
+
+    if not hold:
+        return {'error': 'Hold not found'}, 404
+
+    if hold['user_id'] != user_id and not is_admin:
+        return {'error': 'Unauthorized'}, 403
+
+    lock_book(conn, hold['book_id'])
+    cursor = conn.execute(
+        "UPDATE holds SET status = 'cancelled' WHERE id = ? AND status IN ('waiting', 'ready')",
+        (hold_id,)
+    )
+    if cursor.rowcount == 0:
+        return {'error': 'Hold is no longer active'}, 400
+
+    ready_hold_id = release_copy(conn, hold['book_id']) if hold['status'] == 'ready' else None
+
+    return {
+        'message': 'Hold cancelled', 'hold_id': hold_id, 'book_id': hold['book_id'], 'ready_hold_id': ready_hold_id
+    }, 200
@@ -0,0 +1,46 @@
+"""Conditional GET for catalogue responses
+
+Validators come from the table_versions row that triggers bump on every
+change to a table, so a request carrying a current ``If-None-Match`` (or
+``If-Modified-Since``) is answered 304 after one primary-key lookup,
+without reading the table itself. ETags are strong: a version names one
+state of the table, and the query arguments pick the response within it.
+"""
+import hashlib
+from datetime import datetime, timezone
+from flask import current_app, request
+from werkzeug.http import http_date, is_resource_modified
+import repository
+
+# Responses depend on the caller's token, so shared caches must not keep
+# them, and browsers revalidate before every reuse
+CACHE_CONTROL = 'private, no-cache'
+
+def _timestamp(value):
+    """updated_at as an aware UTC datetime (SQLite stores it as text)"""
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value))
+    return value.replace(tzinfo=timezone.utc, microsecond=0)
+
+def validators(conn, table, key):
+    """(etag, last_modified) for a response identified by ``key``
+
+    Read before the data it describes, so a concurrent change can only
+    make the validators older than the body, never newer.
+    """
+    version, updated_at = repository.table_version(conn, table)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return f'{table}-{version}-{digest}', _timestamp(updated_at)
+
+def not_modified(etag, last_modified):
+    """True when the request's conditional headers match the validators"""
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+def with_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.headers['Last-Modified'] = http_date(last_modified)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+def not_modified_response(etag, last_modified):
+    return with_validators(current_app.response_class(status=304), etag, last_modified)
@@ -3,8 +3,67 @@ from datetime import timedelta
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///library.db'
+    DATABASE_URL = os.environ.get('DATABASE_URL') or 'sqlite:///library.db'
+    SQLALCHEMY_DATABASE_URI = DATABASE_URL
+    DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+    REPLICA_SNAPSHOT_INTERVAL_SECONDS = float(os.environ.get('REPLICA_SNAPSHOT_INTERVAL_SECONDS', 0))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+    DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+    DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 64000))
+    DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+    DB_BUSY_RETRIES = int(os.environ.get('DB_BUSY_RETRIES', 5))
+    PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))
+    PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', 8))
+    PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', 1))
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 64))
+    BOOK_CACHE_ENABLED = os.environ.get('BOOK_CACHE_ENABLED', 'true').lower() == 'true'
+    BOOK_CACHE_SIZE = int(os.environ.get('BOOK_CACHE_SIZE', 2048))
+    BOOK_LIST_CACHE_SIZE = int(os.environ.get('BOOK_LIST_CACHE_SIZE', 256))
+    BOOK_CACHE_TTL = float(os.environ.get('BOOK_CACHE_TTL', 60))
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 4096))
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+    AUTH_ME_FROM_CLAIMS = os.environ.get('AUTH_ME_FROM_CLAIMS', 'false').lower() == 'true'
+    OVERDUE_SCHEDULER_ENABLED = os.environ.get('OVERDUE_SCHEDULER_ENABLED', 'true').lower() == 'true'
+    OVERDUE_INTERVAL_SECONDS = float(os.environ.get('OVERDUE_INTERVAL_SECONDS', 300))
+    OVERDUE_BATCH_SIZE = int(os.environ.get('OVERDUE_BATCH_SIZE', 500))
+    HOLD_PICKUP_DAYS = float(os.environ.get('HOLD_PICKUP_DAYS', 7))
+    LOAN_BATCH_MAX = int(os.environ.get('LOAN_BATCH_MAX', 100))
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+    EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 500))
+    IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_STORAGE = os.environ.get('RATE_LIMIT_STORAGE', 'memory')
+    RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+    RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', 0))
+    RATE_LIMIT_DEFAULT = os.environ.get('RATE_LIMIT_DEFAULT', '')
+    RATE_LIMITS = {
+        'api.login': {
+            'ip': os.environ.get('RATE_LIMIT_LOGIN_IP', '30/60'),
+            'account': os.environ.get('RATE_LIMIT_LOGIN_ACCOUNT', '5/60')
+        },
+        'api.register': {
+            'ip': os.environ.get('RATE_LIMIT_REGISTER_IP', '10/60'),
+            'account': os.environ.get('RATE_LIMIT_REGISTER_ACCOUNT', '3/60')
+        }
+    }
+    FACET_LIMIT = int(os.environ.get('FACET_LIMIT', 20))
+    RELATED_TOP_K = int(os.environ.get('RELATED_TOP_K', 20))
+    RELATED_BLOCK_PAIRS = int(os.environ.get('RELATED_BLOCK_PAIRS', 20000000))
+    RELATED_REFRESH_INTERVAL_SECONDS = float(os.environ.get('RELATED_REFRESH_INTERVAL_SECONDS', 0))
+    EVENTS_PAGE_SIZE = int(os.environ.get('EVENTS_PAGE_SIZE', 100))
+    EVENTS_MAX_PAGE = int(os.environ.get('EVENTS_MAX_PAGE', 1000))
+    EVENTS_MAX_WAIT_SECONDS = float(os.environ.get('EVENTS_MAX_WAIT_SECONDS', 25))
+    EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.25))
+    # Long polls waiting at once; each holds a request thread (SERVE_THREADS)
+    EVENTS_MAX_WAITERS = int(os.environ.get('EVENTS_MAX_WAITERS', 4))
+    SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', 1))
+    SERVE_THREADS = int(os.environ.get('SERVE_THREADS', 8))
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 16))
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'jwt-secret-key-change-in-production'
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
     JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=30)
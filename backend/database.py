@@ -1,19 +1,739 @@
 import sqlite3
 from datetime import datetime
-import hashlib
 import os
+import random
+import threading
+import time
+from flask import g, has_app_context
+from config import Config
+from passwords import hash_password
+from metrics import connection_factory
+import postgres
 
-DATABASE = 'library.db'
+# sqlite:///path, postgresql://..., or a plain SQLite file path
+DATABASE = Config.DATABASE_URL
 
-def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
+if postgres.psycopg2 is not None:
+    DatabaseError = (sqlite3.DatabaseError, postgres.psycopg2.DatabaseError)
+    IntegrityError = (sqlite3.IntegrityError, postgres.psycopg2.IntegrityError)
+    OperationalError = (sqlite3.OperationalError, postgres.psycopg2.OperationalError)
+else:
+    DatabaseError = sqlite3.DatabaseError
+    IntegrityError = sqlite3.IntegrityError
+    OperationalError = sqlite3.OperationalError
+
+def parse_database_url(url):
+    """Split a database URL into (dialect, target)
+
+    target is a file path for SQLite and a libpq connection string for
+    PostgreSQL.
+    """
+    if url.startswith(('postgres://', 'postgresql://')):
+        return postgres.DIALECT, url
+    if url.startswith('sqlite:///'):
+        return 'sqlite', url[len('sqlite:///'):]
+    if '://' in url:
+        raise ValueError(f'Unsupported DATABASE_URL: {url}')
+    return 'sqlite', url
+
+def dialect(conn):
+    """'sqlite' or 'postgresql' for a pooled connection"""
+    return getattr(conn, 'dialect', 'sqlite')
+
+def connect_sqlite(path):
+    """Open a SQLite connection tuned for concurrent use
+
+    WAL mode with ``synchronous=NORMAL``, a larger page cache,
+    memory-mapped I/O and a busy timeout, so readers no longer block the
+    writer and short write bursts wait instead of failing with "database
+    is locked".
+    """
+    conn = sqlite3.connect(
+        path,
+        timeout=Config.DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        factory=connection_factory()
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{int(Config.DB_CACHE_SIZE_KB)}')
+    conn.execute(f'PRAGMA mmap_size = {int(Config.DB_MMAP_SIZE)}')
+    conn.execute(f'PRAGMA busy_timeout = {int(Config.DB_BUSY_TIMEOUT_MS)}')
     return conn
 
-def init_db():
-    """Initialize the database with tables"""
-    conn = get_db()
+class ConnectionPool:
+    """Bounded pool of database connections that are opened once and reused
+
+    ``database`` is anything parse_database_url() accepts; the pool opens
+    SQLite connections with connect_sqlite() and PostgreSQL ones with
+    postgres.connect().
+    """
+
+    def __init__(self, database, size=Config.DB_POOL_SIZE, timeout=Config.DB_POOL_TIMEOUT):
+        self.database = database
+        self.dialect, self.target = parse_database_url(database)
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._opened = 0
+        self._available = threading.Condition()
+        self.checkouts = 0
+        self.waits = 0
+
+    def _connect(self):
+        if self.dialect == postgres.DIALECT:
+            return postgres.connect(self.target)
+        return connect_sqlite(self.target)
+
+    def acquire(self):
+        """Check out a connection, opening a new one while under ``size``"""
+        with self._available:
+            self.checkouts += 1
+            if not self._idle and self._opened >= self.size:
+                self.waits += 1
+                if not self._available.wait_for(lambda: self._idle, self.timeout):
+                    raise sqlite3.OperationalError('Timed out waiting for a database connection')
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._available:
+                self._opened -= 1
+                self._available.notify()
+            raise
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any uncommitted work"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._available:
+            self._idle.append(conn)
+            self._available.notify()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._available:
+            while self._idle:
+                self._idle.pop().close()
+                self._opened -= 1
+
+    def stats(self):
+        """Pool metrics for monitoring"""
+        with self._available:
+            return {
+                'dialect': self.dialect,
+                'size': self.size,
+                'open': self._opened,
+                'idle': len(self._idle),
+                'in_use': self._opened - len(self._idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Get the process-wide connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE)
+    return _pool
+
+def close_pool():
+    """Close the pool so the next get_db() opens fresh connections"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+def get_db():
+    """Get database connection
+
+    Inside a Flask app context the connection is checked out once and
+    returned to the pool when the context is torn down. Outside of one the
+    caller owns the connection and must give it back with release_db().
+    """
+    if has_app_context():
+        if 'db' not in g:
+            g.db = get_pool().acquire()
+        return g.db
+    return get_pool().acquire()
+
+def release_db(conn):
+    """Return a connection obtained outside an app context to the pool"""
+    get_pool().release(conn)
+
+def close_db(exception=None):
+    """Teardown handler: give the context's connection back to the pool"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        release_db(conn)
+
+def is_busy_error(error):
+    """True for errors that are worth retrying: SQLITE_BUSY / SQLITE_LOCKED,
+    or a PostgreSQL serialization failure or deadlock"""
+    if postgres.is_retryable(error):
+        return True
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'locked' in str(error) or 'busy' in str(error)
+
+def run_immediate(conn, work, retries=Config.DB_BUSY_RETRIES):
+    """Run ``work(conn)`` in a BEGIN IMMEDIATE transaction and commit it
+
+    Taking the write lock up front means reads inside ``work`` see the
+    state the writes apply to. PostgreSQL has no database-wide write lock,
+    so there ``work`` locks the rows it depends on instead (see
+    circulation.lock_book). Any exception rolls the transaction back;
+    SQLITE_BUSY and PostgreSQL deadlocks are retried with jittered backoff.
+    """
+    if conn.in_transaction:
+        conn.commit()
+
+    for attempt in range(retries + 1):
+        try:
+            if dialect(conn) == 'sqlite':
+                conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(conn)
+                conn.commit()
+                return result
+            except BaseException:
+                conn.rollback()
+                raise
+        except OperationalError as e:
+            if not is_busy_error(e) or attempt == retries:
+                raise
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+def init_app(app):
+    """Bind the connection pool to the app context lifecycle"""
+    app.teardown_appcontext(close_db)
+
+# The real aggregates that library_stats keeps incrementally
+STATS_AGGREGATES = '''
+    SELECT
+        (SELECT COUNT(*) FROM books) AS total_books,
+        (SELECT COALESCE(SUM(available_copies), 0) FROM books) AS available_books,
+        (SELECT COUNT(*) FROM users) AS total_users,
+        (SELECT COUNT(*) FROM loans WHERE status = 'active') AS active_loans
+'''
+
+# Trigger statements that count a books row (``new`` or ``old``) in, or
+# out of, facet_counts; empty category and author values are not counted
+FACET_COUNTS_ADD = '''
+        INSERT INTO facet_counts (facet, value, books, available)
+        SELECT facet, value, 1, COALESCE({row}.available_copies, 0) > 0
+        FROM (
+            SELECT 'all' AS facet, '' AS value
+            UNION ALL SELECT 'category', {row}.category
+            UNION ALL SELECT 'author', {row}.author
+        )
+        WHERE facet = 'all' OR value != ''
+        ON CONFLICT (facet, value) DO UPDATE SET
+            books = books + 1,
+            available = available + excluded.available;
+'''
+FACET_COUNTS_REMOVE = '''
+        UPDATE facet_counts SET
+            books = books - 1,
+            available = available - (COALESCE({row}.available_copies, 0) > 0)
+        WHERE facet = 'all'
+            OR (facet = 'category' AND value = {row}.category)
+            OR (facet = 'author' AND value = {row}.author);
+        DELETE FROM facet_counts
+        WHERE books = 0 AND ((facet = 'category' AND value = {row}.category) OR (facet = 'author' AND value = {row}.author));
+'''
+
+# Start of the hour, day, week (Monday) and month of a loan timestamp, as
+# text. Loan volume is rolled up at every granularity, loans per book and
+# per borrower (TOP_GRANULARITIES) from days up.
+ROLLUP_PERIODS = {
+    'hour': "strftime('%Y-%m-%d %H:00:00', {ts})",
+    'day': 'date({ts})',
+    'week': "date({ts}, 'weekday 0', '-6 days')",
+    'month': "strftime('%Y-%m-01', {ts})"
+}
+TOP_GRANULARITIES = ['day', 'week', 'month']
+
+def _rollup_periods(ts, granularities=ROLLUP_PERIODS):
+    """(granularity, period) rows for the timestamp expression ``ts``"""
+    return ' UNION ALL '.join(
+        f"SELECT '{name}' AS granularity, {ROLLUP_PERIODS[name].format(ts=ts)} AS period"
+        for name in granularities
+    )
+
+# Trigger statements that count a borrow (``new``, an inserted loan) or a
+# return into the rollups. A borrower is counted once per period, the
+# first time they appear in borrower_rollups.
+LOAN_ROLLUPS_BORROW = f'''
+        INSERT INTO loan_rollups (granularity, period, borrows, returns, borrowers)
+        SELECT granularity, period, 1, 0, granularity != 'hour' AND NOT EXISTS (
+            SELECT 1 FROM borrower_rollups b
+            WHERE b.granularity = p.granularity AND b.period = p.period AND b.user_id = new.user_id
+        )
+        FROM ({_rollup_periods('new.borrow_date')}) AS p WHERE period IS NOT NULL
+        ON CONFLICT (granularity, period) DO UPDATE
+        SET borrows = borrows + 1, borrowers = borrowers + excluded.borrowers;
+        INSERT INTO borrower_rollups (granularity, period, user_id, borrows)
+        SELECT granularity, period, new.user_id, 1
+        FROM ({_rollup_periods('new.borrow_date', TOP_GRANULARITIES)}) WHERE period IS NOT NULL
+        ON CONFLICT (granularity, period, user_id) DO UPDATE SET borrows = borrows + 1;
+        INSERT INTO book_rollups (granularity, period, book_id, borrows)
+        SELECT granularity, period, new.book_id, 1
+        FROM ({_rollup_periods('new.borrow_date', TOP_GRANULARITIES)}) WHERE period IS NOT NULL
+        ON CONFLICT (granularity, period, book_id) DO UPDATE SET borrows = borrows + 1;
+'''
+LOAN_ROLLUPS_RETURN = f'''
+        INSERT INTO loan_rollups (granularity, period, borrows, returns, borrowers)
+        SELECT granularity, period, 0, 1, 0 FROM ({_rollup_periods('new.return_date')}) WHERE period IS NOT NULL
+        ON CONFLICT (granularity, period) DO UPDATE SET returns = returns + 1;
+'''
+
+def _rollup_rebuild(periods, top_granularities):
+    """Statements that recompute every rollup from the loans table, given
+    each granularity's period expression"""
+    statements = ['DELETE FROM loan_rollups', 'DELETE FROM book_rollups', 'DELETE FROM borrower_rollups']
+    for name, expression in periods.items():
+        borrowed, returned = expression.format(ts='borrow_date'), expression.format(ts='return_date')
+        borrowers = 'COUNT(DISTINCT user_id)' if name in top_granularities else '0'
+        statements.append(f'''
+    INSERT INTO loan_rollups (granularity, period, borrows, returns, borrowers)
+    SELECT '{name}', period, SUM(borrows), SUM(returns), SUM(borrowers) FROM (
+        SELECT {borrowed} AS period, COUNT(*) AS borrows, 0 AS returns, {borrowers} AS borrowers
+        FROM loans WHERE {borrowed} IS NOT NULL GROUP BY 1
+        UNION ALL
+        SELECT {returned}, 0, COUNT(*), 0
+        FROM loans WHERE status = 'returned' AND {returned} IS NOT NULL GROUP BY 1
+    ) AS counts
+    GROUP BY period''')
+        if name in top_granularities:
+            for table, column in [('book_rollups', 'book_id'), ('borrower_rollups', 'user_id')]:
+                statements.append(f'''
+    INSERT INTO {table} (granularity, period, {column}, borrows)
+    SELECT '{name}', {borrowed}, {column}, COUNT(*)
+    FROM loans WHERE {borrowed} IS NOT NULL GROUP BY 2, 3''')
+    return [statement.strip() for statement in statements]
+
+ROLLUP_REBUILD = _rollup_rebuild(ROLLUP_PERIODS, TOP_GRANULARITIES)
+ROLLUP_REBUILD_SCRIPT = ';\n\n    '.join(ROLLUP_REBUILD)
+
+# Schema migrations, applied in order. The index of each script plus one is
+# the schema version recorded in PRAGMA user_version once it has run.
+# PostgreSQL gets the equivalent schema from postgres.MIGRATIONS; keep the
+# two in step.
+MIGRATIONS = [
+    # 1: full-text index over book titles and authors, kept in sync by
+    # triggers and backfilled from existing rows
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title,
+        author,
+        content='books',
+        content_rowid='id'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+        INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+    END;
+
+    INSERT INTO books_fts (books_fts) VALUES ('rebuild');
+    ''',
+
+    # 2: secondary indexes for the hot queries in app.py
+    '''
+    -- borrow_book duplicate check and get_stats active loan count
+    CREATE INDEX IF NOT EXISTS idx_loans_active_user_book
+        ON loans (user_id, book_id) WHERE status = 'active';
+
+    -- get_loans for a student, newest first
+    CREATE INDEX IF NOT EXISTS idx_loans_user_borrow_date ON loans (user_id, borrow_date);
+
+    -- get_loans for an admin, newest first
+    CREATE INDEX IF NOT EXISTS idx_loans_borrow_date ON loans (borrow_date);
+
+    -- get_books ordered by title, with and without a category filter
+    CREATE INDEX IF NOT EXISTS idx_books_title ON books (title);
+    CREATE INDEX IF NOT EXISTS idx_books_category_title ON books (category, title);
+
+    -- get_users, newest first
+    CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at);
+
+    -- waiting holds per book in queue order, and holds per user
+    CREATE INDEX IF NOT EXISTS idx_holds_book_waiting
+        ON holds (book_id, hold_date) WHERE status = 'waiting';
+    CREATE INDEX IF NOT EXISTS idx_holds_user ON holds (user_id);
+    ''',
+
+    # 3: single-row counters behind /api/stats, maintained by triggers
+    f'''
+    CREATE TABLE IF NOT EXISTS library_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_books INTEGER NOT NULL DEFAULT 0,
+        available_books INTEGER NOT NULL DEFAULT 0,
+        total_users INTEGER NOT NULL DEFAULT 0,
+        active_loans INTEGER NOT NULL DEFAULT 0
+    );
+
+    INSERT OR REPLACE INTO library_stats (id, total_books, available_books, total_users, active_loans)
+        SELECT 1, total_books, available_books, total_users, active_loans FROM ({STATS_AGGREGATES});
+
+    CREATE TRIGGER IF NOT EXISTS library_stats_book_insert AFTER INSERT ON books BEGIN
+        UPDATE library_stats SET
+            total_books = total_books + 1,
+            available_books = available_books + COALESCE(new.available_copies, 0)
+        WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS library_stats_book_delete AFTER DELETE ON books BEGIN
+        UPDATE library_stats SET
+            total_books = total_books - 1,
+            available_books = available_books - COALESCE(old.available_copies, 0)
+        WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS library_stats_book_update AFTER UPDATE OF available_copies ON books BEGIN
+        UPDATE library_stats SET
+            available_books = available_books + COALESCE(new.available_copies, 0) - COALESCE(old.available_copies, 0)
+        WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS library_stats_user_insert AFTER INSERT ON users BEGIN
+        UPDATE library_stats SET total_users = total_users + 1 WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS library_stats_user_delete AFTER DELETE ON users BEGIN
+        UPDATE library_stats SET total_users = total_users - 1 WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS library_stats_loan_insert AFTER INSERT ON loans BEGIN
+        UPDATE library_stats SET
+            active_loans = active_loans + (CASE WHEN new.status = 'active' THEN 1 ELSE 0 END)
+        WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS library_stats_loan_delete AFTER DELETE ON loans BEGIN
+        UPDATE library_stats SET
+            active_loans = active_loans - (CASE WHEN old.status = 'active' THEN 1 ELSE 0 END)
+        WHERE id = 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS library_stats_loan_update AFTER UPDATE OF status ON loans BEGIN
+        UPDATE library_stats SET
+            active_loans = active_loans
+                + (CASE WHEN new.status = 'active' THEN 1 ELSE 0 END)
+                - (CASE WHEN old.status = 'active' THEN 1 ELSE 0 END)
+        WHERE id = 1;
+    END;
+    ''',
+
+    # 4: at most one active loan per (user, book). Duplicates left by the old
+    # racy borrow path are closed and their copies given back first.
+    '''
+    UPDATE books SET available_copies = available_copies + (
+        SELECT COUNT(*) - COUNT(DISTINCT user_id) FROM loans
+        WHERE loans.book_id = books.id AND loans.status = 'active'
+    )
+    WHERE id IN (
+        SELECT book_id FROM loans WHERE status = 'active'
+        GROUP BY user_id, book_id HAVING COUNT(*) > 1
+    );
+
+    UPDATE loans SET status = 'returned', return_date = CURRENT_TIMESTAMP
+    WHERE status = 'active' AND id NOT IN (
+        SELECT MIN(id) FROM loans WHERE status = 'active' GROUP BY user_id, book_id
+    );
+
+    UPDATE books SET available_copies = 0 WHERE available_copies < 0;
+
+    DROP INDEX IF EXISTS idx_loans_active_user_book;
+    CREATE UNIQUE INDEX idx_loans_active_user_book
+        ON loans (user_id, book_id) WHERE status = 'active';
+    ''',
+
+    # 5: hold queue. A ready hold has a returned copy set aside for it; a
+    # user has at most one waiting or ready hold per book.
+    '''
+    ALTER TABLE holds ADD COLUMN ready_date TIMESTAMP;
+
+    UPDATE holds SET status = 'cancelled'
+    WHERE status IN ('waiting', 'ready') AND id NOT IN (
+        SELECT MIN(id) FROM holds WHERE status IN ('waiting', 'ready') GROUP BY user_id, book_id
+    );
+
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_active_user_book
+        ON holds (user_id, book_id) WHERE status IN ('waiting', 'ready');
+    ''',
+
+    # 6: overdue detection (see scheduler.py). Overdue loans stay 'active'
+    # and get overdue_at set; overdue_summary holds per-user counts.
+    '''
+    ALTER TABLE loans ADD COLUMN overdue_at TIMESTAMP;
+
+    CREATE INDEX IF NOT EXISTS idx_loans_status_due_date ON loans (status, due_date);
+
+    CREATE TABLE IF NOT EXISTS overdue_summary (
+        user_id INTEGER PRIMARY KEY,
+        overdue_count INTEGER NOT NULL,
+        oldest_due_date TIMESTAMP,
+        updated_at TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS scheduler_state (
+        name TEXT PRIMARY KEY,
+        last_due_date TIMESTAMP,
+        last_loan_id INTEGER,
+        last_run TIMESTAMP
+    );
+
+    CREATE TRIGGER IF NOT EXISTS overdue_summary_return AFTER UPDATE OF status ON loans
+    WHEN old.overdue_at IS NOT NULL AND new.status <> 'active' BEGIN
+        INSERT OR REPLACE INTO overdue_summary (user_id, overdue_count, oldest_due_date, updated_at)
+        SELECT old.user_id, COUNT(*), MIN(due_date), CURRENT_TIMESTAMP
+        FROM loans
+        WHERE user_id = old.user_id AND status = 'active' AND overdue_at IS NOT NULL;
+        DELETE FROM overdue_summary WHERE user_id = old.user_id AND overdue_count = 0;
+    END;
+    ''',
+
+    # 7: per-table change versions behind ETag / Last-Modified, bumped by
+    # triggers in the same transaction as the change. Versions start from
+    # the creation time so a recreated database does not reuse old ETags.
+    '''
+    CREATE TABLE IF NOT EXISTS table_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        updated_at TIMESTAMP NOT NULL
+    );
+
+    INSERT OR IGNORE INTO table_versions (name, version, updated_at)
+    VALUES ('books', CAST(strftime('%s', 'now') AS INTEGER), CURRENT_TIMESTAMP);
+
+    CREATE TRIGGER IF NOT EXISTS books_version_insert AFTER INSERT ON books BEGIN
+        UPDATE table_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE name = 'books';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_version_update AFTER UPDATE ON books BEGIN
+        UPDATE table_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE name = 'books';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_version_delete AFTER DELETE ON books BEGIN
+        UPDATE table_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE name = 'books';
+    END;
+    ''',
+
+    # 8: precomputed "borrowers of this also borrowed" lists (related.py),
+    # and the index it uses to find a book's borrowers
+    '''
+    CREATE TABLE IF NOT EXISTS related_books (
+        book_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        related_id INTEGER NOT NULL,
+        borrowers INTEGER NOT NULL,
+        share REAL NOT NULL,
+        PRIMARY KEY (book_id, position)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_loans_book_user ON loans (book_id, user_id);
+    ''',
+
+    # 9: book counts per category and author, and in total ('all'), for
+    # the facets of unfiltered browsing. A book is available when it has a
+    # copy on the shelf; updates that change neither facet value nor that
+    # flag (most borrows and returns) leave the counts alone. There is no
+    # index on the counts: keeping one up to date tripled the cost of the
+    # triggers on import, while the top authors are a top-N sort over one
+    # facet's rows (16 ms for 100k authors) and the response is cached.
+    f'''
+    CREATE TABLE IF NOT EXISTS facet_counts (
+        facet TEXT NOT NULL,
+        value TEXT NOT NULL,
+        books INTEGER NOT NULL,
+        available INTEGER NOT NULL,
+        PRIMARY KEY (facet, value)
+    ) WITHOUT ROWID;
+
+    INSERT OR REPLACE INTO facet_counts (facet, value, books, available)
+    SELECT 'all', '', COUNT(*), COALESCE(SUM(COALESCE(available_copies, 0) > 0), 0) FROM books
+    UNION ALL
+    SELECT 'category', category, COUNT(*), SUM(COALESCE(available_copies, 0) > 0) FROM books
+    WHERE category != '' GROUP BY category
+    UNION ALL
+    SELECT 'author', author, COUNT(*), SUM(COALESCE(available_copies, 0) > 0) FROM books
+    WHERE author != '' GROUP BY author;
+
+    CREATE TRIGGER IF NOT EXISTS facet_counts_insert AFTER INSERT ON books BEGIN
+        {FACET_COUNTS_ADD.format(row='new').strip()}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS facet_counts_delete AFTER DELETE ON books BEGIN
+        {FACET_COUNTS_REMOVE.format(row='old').strip()}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS facet_counts_update AFTER UPDATE OF category, author, available_copies ON books
+    WHEN old.category IS NOT new.category OR old.author IS NOT new.author
+        OR (COALESCE(old.available_copies, 0) > 0) != (COALESCE(new.available_copies, 0) > 0)
+    BEGIN
+        {FACET_COUNTS_REMOVE.format(row='old').strip()}
+        {FACET_COUNTS_ADD.format(row='new').strip()}
+    END;
+    ''',
+
+    # 10: loan volume per hour, day, week and month, and loans per book and
+    # per borrower from days up, for /api/stats/timeseries and
+    # /api/stats/top. Kept current by triggers in the borrow or return
+    # transaction, and backfilled from the existing loans.
+    f'''
+    CREATE TABLE IF NOT EXISTS loan_rollups (
+        granularity TEXT NOT NULL,
+        period TEXT NOT NULL,
+        borrows INTEGER NOT NULL,
+        returns INTEGER NOT NULL,
+        borrowers INTEGER NOT NULL,
+        PRIMARY KEY (granularity, period)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS book_rollups (
+        granularity TEXT NOT NULL,
+        period TEXT NOT NULL,
+        book_id INTEGER NOT NULL,
+        borrows INTEGER NOT NULL,
+        PRIMARY KEY (granularity, period, book_id)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS borrower_rollups (
+        granularity TEXT NOT NULL,
+        period TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        borrows INTEGER NOT NULL,
+        PRIMARY KEY (granularity, period, user_id)
+    ) WITHOUT ROWID;
+
+    {ROLLUP_REBUILD_SCRIPT};
+
+    CREATE TRIGGER IF NOT EXISTS loan_rollups_borrow AFTER INSERT ON loans BEGIN
+        {LOAN_ROLLUPS_BORROW.strip()}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS loan_rollups_returned AFTER INSERT ON loans
+    WHEN new.status = 'returned' BEGIN
+        {LOAN_ROLLUPS_RETURN.strip()}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS loan_rollups_return AFTER UPDATE OF status ON loans
+    WHEN old.status = 'active' AND new.status = 'returned' BEGIN
+        {LOAN_ROLLUPS_RETURN.strip()}
+    END;
+    ''',
+
+    # 11: append-only event log behind /api/events (see events.py). seq
+    # is AUTOINCREMENT so it is never reused, even after the newest rows
+    # are gone from a restored backup.
+    '''
+    CREATE TABLE IF NOT EXISTS events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        actor_id INTEGER,
+        type TEXT NOT NULL,
+        entity_id INTEGER,
+        data TEXT
+    );
+
+    CREATE TRIGGER IF NOT EXISTS events_no_update BEFORE UPDATE ON events BEGIN
+        SELECT RAISE(ABORT, 'events are append-only');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS events_no_delete BEFORE DELETE ON events BEGIN
+        SELECT RAISE(ABORT, 'events are append-only');
+    END;
+    ''',
+
+    # 12: ready holds by age, for expiring the uncollected ones (see
+    # scheduler.expire_holds)
+    '''
+    CREATE INDEX IF NOT EXISTS idx_holds_ready_date ON holds (ready_date) WHERE status = 'ready';
+    ''',
+]
+
+def migrate(conn):
+    """Apply pending migrations, each in its own transaction"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+    for number, script in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        try:
+            conn.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;')
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        print(f"Applied migration {number}")
+
+def verify_stats(conn):
+    """Compare library_stats with the real aggregates
+
+    Returns a dict of {counter: (stored, actual)} for every counter that has
+    drifted; empty when they all match.
+    """
+    stored = conn.execute('SELECT * FROM library_stats WHERE id = 1').fetchone()
+    actual = conn.execute(STATS_AGGREGATES).fetchone()
+
+    mismatches = {}
+    for name in actual.keys():
+        stored_value = stored[name] if stored else None
+        if stored_value != actual[name]:
+            mismatches[name] = (stored_value, actual[name])
+    return mismatches
+
+def rebuild_stats(conn):
+    """Recompute library_stats from the real aggregates"""
+    conn.execute(f'''
+        INSERT INTO library_stats (id, total_books, available_books, total_users, active_loans)
+        SELECT 1, total_books, available_books, total_users, active_loans FROM ({STATS_AGGREGATES}) AS actual
+        WHERE true
+        ON CONFLICT (id) DO UPDATE SET
+            total_books = excluded.total_books,
+            available_books = excluded.available_books,
+            total_users = excluded.total_users,
+            active_loans = excluded.active_loans
+    ''')
+    conn.commit()
+
+def rebuild_rollups(conn):
+    """Recompute the loan rollups from the loans table
+
+    Holds the write lock while it runs, so borrows and returns wait for
+    it rather than being counted twice or missed.
+    """
+    def rebuild(conn):
+        if dialect(conn) == postgres.DIALECT:
+            conn.execute('SELECT rebuild_loan_rollups()')
+        else:
+            for statement in ROLLUP_REBUILD:
+                conn.execute(statement)
+    run_immediate(conn, rebuild)
+
+def create_sqlite_schema(conn):
+    """Create the base tables and apply the SQLite migrations"""
     cursor = conn.cursor()
 
     # Users table
@@ -73,10 +793,23 @@ def init_db():
 
     conn.commit()
 
+    # Bring the schema up to date
+    migrate(conn)
+
+def init_db():
+    """Initialize the database with tables"""
+    conn = get_db()
+    cursor = conn.cursor()
+
+    if dialect(conn) == postgres.DIALECT:
+        postgres.migrate(conn)
+    else:
+        create_sqlite_schema(conn)
+
     # Create default admin user if not exists
     cursor.execute('SELECT * FROM users WHERE email = ?', ('admin@library.com',))
     if not cursor.fetchone():
-        admin_password = hashlib.sha256('admin123'.encode()).hexdigest()
+        admin_password = hash_password('admin123')
         cursor.execute(
             'INSERT INTO users (email, password, full_name, role) VALUES (?, ?, ?, ?)',
             ('admin@library.com', admin_password, 'Administrator', 'admin')
@@ -102,8 +835,45 @@ def init_db():
         conn.commit()
         print(f"Added {len(sample_books)} sample books")
 
-    conn.close()
+    release_db(conn)
     print("Database initialized successfully!")
 
+def rebuild_stats_command(verify_only=False):
+    """Verify the stats counters and rebuild them if they have drifted"""
+    conn = get_db()
+    try:
+        mismatches = verify_stats(conn)
+        for name, (stored, actual) in mismatches.items():
+            print(f"{name}: stored {stored}, actual {actual}")
+
+        if not mismatches:
+            print("Stats counters match the tables")
+        elif not verify_only:
+            rebuild_stats(conn)
+            print("Stats counters rebuilt")
+        return not mismatches
+    finally:
+        release_db(conn)
+
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Library database administration')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('init', help='create tables and apply migrations (default)')
+    stats_parser = subparsers.add_parser('rebuild-stats', help='verify and rebuild the /api/stats counters')
+    stats_parser.add_argument('--verify-only', action='store_true', help='report drift without rebuilding')
+    subparsers.add_parser('rebuild-rollups', help='recompute the /api/stats/timeseries and /api/stats/top rollups')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild-stats':
+        init_db()
+        raise SystemExit(0 if rebuild_stats_command(args.verify_only) else 1)
     init_db()
+    if args.command == 'rebuild-rollups':
+        conn = get_db()
+        try:
+            rebuild_rollups(conn)
+        finally:
+            release_db(conn)
+        print("Loan rollups rebuilt")
@@ -0,0 +1,142 @@
+"""Append-only event log and the change feed behind GET /api/events
+
+Each change is recorded as an event: who made it (``actor_id``), a
+``type`` such as ``book.updated``, the id of the changed row and a JSON
+``data`` payload. A handler collects the events of its transaction and
+append() writes them with one executemany() just before the commit, so
+an event exists exactly when its change does and a batch of fifty
+borrows costs one extra statement, not fifty. Triggers refuse to update
+or delete events.
+
+``seq`` grows in commit order, so a consumer that keeps the last ``seq``
+it has seen resumes from it without missing or repeating an event. On
+SQLite writers are serialized anyway. PostgreSQL hands out sequence
+values before commit, so two writers could commit out of order and a
+reader could move past a ``seq`` that has not committed yet; there
+append() locks the events table against other writers (not readers)
+for the short rest of the transaction.
+
+Each waiting long poll holds a request thread, so at most
+EVENTS_MAX_WAITERS wait at once; past that a request that finds nothing
+is refused with FeedBusy rather than left to wait.
+"""
+import json
+import threading
+import time
+from flask import request
+from config import Config
+import database
+import postgres
+
+class FeedBusy(Exception):
+    """Raised when EVENTS_MAX_WAITERS long polls are already waiting"""
+
+_waiters = threading.BoundedSemaphore(Config.EVENTS_MAX_WAITERS)
+
+def append(conn, actor_id, events):
+    """Write ``events``, (type, entity_id, data) tuples, in the caller's
+    transaction"""
+    if not events:
+        return
+    if database.dialect(conn) == postgres.DIALECT:
+        conn.execute('LOCK TABLE events IN EXCLUSIVE MODE')
+    conn.executemany(
+        'INSERT INTO events (actor_id, type, entity_id, data) VALUES (?, ?, ?, ?)',
+        [(actor_id, type, entity_id, _encode(data)) for type, entity_id, data in events]
+    )
+
+def _encode(data):
+    if data is None:
+        return None
+    return json.dumps(data, default=str, separators=(',', ':'))
+
+def loan_created(loan):
+    """Event for a loan row or borrow response"""
+    return 'loan.created', loan['id'], {
+        'user_id': loan['user_id'], 'book_id': loan['book_id'], 'due_date': loan['due_date']
+    }
+
+def loan_returned(body):
+    """Event for a circulation.return_loan() response"""
+    return 'loan.returned', body['loan_id'], {'book_id': body['book_id']}
+
+def hold_ready(hold_id, book_id):
+    """Event for a hold that a copy has been set aside for; the hold's
+    hold.created event names its user"""
+    return 'hold.ready', hold_id, {'book_id': book_id}
+
+def copy_released(body):
+    """hold.ready events for a return_loan() or cancel_hold() response
+    whose copy went to the next waiting hold"""
+    if body.get('ready_hold_id') is None:
+        return []
+    return [hold_ready(body['ready_hold_id'], body['book_id'])]
+
+def changes(before, after, fields):
+    """{'before': ..., 'after': ...} for the ``fields`` whose value changed"""
+    changed = [field for field in fields if before[field] != after[field]]
+    return {
+        'before': {field: before[field] for field in changed},
+        'after': {field: after[field] for field in changed}
+    }
+
+def read(conn, since, limit):
+    """Up to ``limit`` events after ``since``, oldest first"""
+    rows = conn.execute('''
+        SELECT seq, created_at, actor_id, type, entity_id, data FROM events
+        WHERE seq > ?
+        ORDER BY seq
+        LIMIT ?
+    ''', (since, limit)).fetchall()
+    return [dict(row, data=json.loads(row['data']) if row['data'] else None) for row in rows]
+
+def wait_for(since, limit, timeout, interval=Config.EVENTS_POLL_INTERVAL):
+    """read(), waiting up to ``timeout`` seconds for the first event
+
+    Polls every ``interval`` seconds, which also picks up events written
+    by other processes. A pooled connection is held only while querying,
+    so waiting consumers do not starve the request handlers. Raises
+    FeedBusy when nothing is found and EVENTS_MAX_WAITERS requests are
+    already waiting.
+    """
+    deadline = time.monotonic() + timeout
+    found = _read(since, limit)
+    if found or timeout <= 0:
+        return found
+    if not _waiters.acquire(blocking=False):
+        raise FeedBusy()
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return found
+            time.sleep(min(interval, remaining))
+            found = _read(since, limit)
+            if found:
+                return found
+    finally:
+        _waiters.release()
+
+def _read(since, limit):
+    pool = database.get_pool()
+    conn = pool.acquire()
+    try:
+        return read(conn, since, limit)
+    finally:
+        pool.release(conn)
+
+def parse_feed():
+    """Read ``since``, ``limit`` and ``wait`` for GET /api/events
+
+    Returns (since, limit, wait), with ``limit`` capped at
+    EVENTS_MAX_PAGE and ``wait`` at EVENTS_MAX_WAIT_SECONDS.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', Config.EVENTS_PAGE_SIZE))
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        raise ValueError('since and limit must be integers, wait a number of seconds')
+    if since < 0 or limit < 1 or not wait >= 0:
+        raise ValueError('since and wait cannot be negative, limit must be positive')
+    return since, min(limit, Config.EVENTS_MAX_PAGE), min(wait, Config.EVENTS_MAX_WAIT_SECONDS)
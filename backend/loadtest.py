@@ -0,0 +1,446 @@
+"""Load-testing harness: seeded data, mixed workloads, per-endpoint latency
+
+Seeds a synthetic catalogue, users and returned-loan history at a given
+scale, then drives a workload mix from a fixed number of client threads
+for a fixed time. It reports throughput and p50/p95/p99 latency per
+endpoint as JSON. Runs are reproducible for a given --seed. Pass
+--compare with an earlier report to print the change per endpoint.
+
+By default requests go through the Flask test client in this process
+against a fresh database. Use --url to load a running server instead;
+that server must be seeded first with --seed-only against its database,
+and since every client logs in from this one address, started with
+RATE_LIMIT_ENABLED=false (the in-process app is built without limits).
+
+Usage:
+    python loadtest.py --scale 10k --mix mixed --threads 8 --duration 30 --output run.json
+    python loadtest.py --scale 1m --database /tmp/load.db --seed-only
+    python loadtest.py --database /tmp/load.db --skip-seed --mix borrow-storm --compare run.json
+    python loadtest.py --url http://localhost:5000 --skip-seed --mix search
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+import database
+import passwords
+from config import Config
+
+class LoadTestConfig(Config):
+    """The app's configuration without rate limits: every simulated client
+    logs in from the same address"""
+    RATE_LIMIT_ENABLED = False
+
+# Rows seeded at each --scale: (books, users, loans)
+SCALES = {
+    '10k': (2000, 1000, 7000),
+    '100k': (20000, 10000, 70000),
+    '1m': (200000, 100000, 700000),
+    '10m': (2000000, 1000000, 7000000)
+}
+
+# Weights of the operations in each --mix
+MIXES = {
+    'mixed': {'search': 40, 'browse': 35, 'borrow_return': 20, 'admin_stats': 5},
+    'search': {'search': 1},
+    'browse': {'browse': 1},
+    'borrow-storm': {'borrow_return': 1},
+    'admin': {'admin_stats': 1}
+}
+
+WORDS = [
+    'river', 'shadow', 'garden', 'empire', 'silent', 'winter', 'glass', 'harbor', 'crimson', 'forest',
+    'machine', 'letter', 'island', 'thunder', 'paper', 'mirror', 'ember', 'orbit', 'signal', 'atlas',
+    'python', 'systems', 'design', 'patterns', 'history', 'modern', 'theory', 'practical', 'secret', 'journey'
+]
+FIRST_NAMES = ['Ada', 'Alan', 'Grace', 'Linus', 'Barbara', 'Ken', 'Margaret', 'Dennis', 'Frances', 'Edsger']
+LAST_NAMES = ['Lovelace', 'Turing', 'Hopper', 'Torvalds', 'Liskov', 'Thompson', 'Hamilton', 'Ritchie', 'Allen']
+CATEGORIES = ['Programming', 'Fiction', 'History', 'Science', 'Design', 'Travel']
+
+PASSWORD = 'loadtest-password'
+ADMIN = ('admin@library.com', 'admin123')
+CHUNK = 10000
+
+# Seeding
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _insert(conn, sql, rows):
+    for chunk in _chunks(rows):
+        conn.executemany(sql, chunk)
+        conn.commit()
+
+def _id_range(conn, table, column, prefix):
+    row = conn.execute(
+        f'SELECT MIN(id) AS low, MAX(id) AS high FROM {table} WHERE {column} LIKE ?', (f'{prefix}%',)
+    ).fetchone()
+    return row['low'], row['high']
+
+def seed(conn, books, users, loans, rng):
+    """Insert synthetic books, users and returned loans
+
+    Every seeded user has the password PASSWORD (hashed once). Loans are
+    all returned, so copy counts and library_stats stay consistent.
+    """
+    password = passwords.hash_password(PASSWORD)
+
+    _insert(conn, '''
+        INSERT INTO books (isbn, title, author, category, total_copies, available_copies, description)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        (
+            f'load-{i:08d}',
+            ' '.join(rng.choice(WORDS) for _ in range(3)).title(),
+            f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+            rng.choice(CATEGORIES),
+            copies,
+            copies,
+            None
+        )
+        for i in range(books)
+        for copies in [rng.randint(1, 5)]
+    ))
+
+    _insert(conn, 'INSERT INTO users (email, password, full_name) VALUES (?, ?, ?)', (
+        (f'load{i}@library.com', password, f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}')
+        for i in range(users)
+    ))
+
+    first_book, last_book = _id_range(conn, 'books', 'isbn', 'load-')
+    first_user, last_user = _id_range(conn, 'users', 'email', 'load')
+    start = datetime(2020, 1, 1)
+    history = (
+        (
+            rng.randint(first_user, last_user),
+            rng.randint(first_book, last_book),
+            borrowed.strftime('%Y-%m-%d %H:%M:%S'),
+            (borrowed + timedelta(days=14)).strftime('%Y-%m-%d %H:%M:%S'),
+            (borrowed + timedelta(days=rng.randint(1, 20))).strftime('%Y-%m-%d %H:%M:%S')
+        )
+        for _ in range(loans)
+        for borrowed in [start + timedelta(minutes=rng.randint(0, 4 * 365 * 24 * 60))]
+    )
+    _insert(conn, '''
+        INSERT INTO loans (user_id, book_id, borrow_date, due_date, return_date, status)
+        VALUES (?, ?, ?, ?, ?, 'returned')
+    ''', history)
+
+# Clients
+class AppClient:
+    """Requests through the Flask test client of the in-process app"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_json(silent=True)
+
+class HttpClient:
+    """Requests over one keep-alive HTTP connection to a running server"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        connection = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection(parts.hostname, parts.port, timeout=60)
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, path, payload, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            raise
+        try:
+            return response.status, json.loads(data) if data else None
+        except ValueError:
+            return response.status, None
+
+def sample_book_ids(client, headers, pages=5):
+    """Ids from the first few catalogue pages, for the workload to pick from"""
+    book_ids = []
+    path = '/api/books?fields=id&limit=1000'
+    for _ in range(pages):
+        status, page = client.request('GET', path, None, headers)
+        if status != 200:
+            raise RuntimeError(f'Listing books failed with HTTP {status}: {page}')
+        book_ids += [book['id'] for book in page['items']]
+        if not page['next_cursor']:
+            break
+        path = f"/api/books?fields=id&limit=1000&cursor={page['next_cursor']}"
+    return book_ids
+
+def login(client, email, password):
+    status, body = client.request('POST', '/api/auth/login', {'email': email, 'password': password})
+    if status != 200:
+        raise RuntimeError(f'Login as {email} failed with HTTP {status}: {body}')
+    return {'Authorization': f"Bearer {body['access_token']}"}
+
+# Workload
+class RequestFailed(Exception):
+    pass
+
+class Recorder:
+    """Latency samples and status codes per endpoint, shared by all threads"""
+
+    def __init__(self):
+        self.samples = {}
+        self.statuses = {}
+        self.exceptions = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
+            self.statuses.clear()
+            self.exceptions.clear()
+
+    def call(self, client, endpoint, method, path, body=None, headers=None):
+        started = time.perf_counter()
+        try:
+            status, data = client.request(method, path, body, headers)
+        except Exception as e:
+            with self._lock:
+                self.exceptions[endpoint] = self.exceptions.get(endpoint, 0) + 1
+            raise RequestFailed(endpoint) from e
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(elapsed)
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+        return status, data
+
+class Workload:
+    """The operations of a mix, each a short sequence of API calls"""
+
+    def __init__(self, recorder, book_ids, admin):
+        self.recorder = recorder
+        self.book_ids = book_ids
+        self.hot = book_ids[:max(1, len(book_ids) // 100)]
+        self.admin = admin
+
+    def search(self, client, headers, rng):
+        term = rng.choice(WORDS)
+        if rng.random() < 0.3:
+            term = term[:4]
+        self.recorder.call(client, 'GET /api/books?search', 'GET', f'/api/books?search={term}&limit=20', None, headers)
+
+    def browse(self, client, headers, rng):
+        """A few catalogue pages, then one of the books on them"""
+        status, page = self.recorder.call(client, 'GET /api/books?limit', 'GET', '/api/books?limit=20', None, headers)
+        for _ in range(rng.randint(0, 3)):
+            if status != 200 or not page['next_cursor']:
+                break
+            status, page = self.recorder.call(
+                client, 'GET /api/books?limit', 'GET', f"/api/books?limit=20&cursor={page['next_cursor']}", None, headers
+            )
+        book_id = rng.choice(page['items'])['id'] if status == 200 and page['items'] else rng.choice(self.book_ids)
+        self.recorder.call(client, 'GET /api/books/<id>', 'GET', f'/api/books/{book_id}', None, headers)
+
+    def borrow_return(self, client, headers, rng):
+        """Borrow a book, mostly one of the hottest 1%, and return it"""
+        book_id = rng.choice(self.hot if rng.random() < 0.8 else self.book_ids)
+        status, loan = self.recorder.call(client, 'POST /api/loans', 'POST', '/api/loans', {'book_id': book_id}, headers)
+        if status == 201:
+            self.recorder.call(client, 'POST /api/loans/<id>/return', 'POST', f"/api/loans/{loan['id']}/return", None, headers)
+
+    def admin_stats(self, client, headers, rng):
+        self.recorder.call(client, 'GET /api/stats', 'GET', '/api/stats', None, self.admin)
+        self.recorder.call(client, 'GET /api/loans?limit', 'GET', '/api/loans?limit=50', None, self.admin)
+
+def run(make_client, workload, mix, user_headers, threads, duration, seed_value, warmup=0.0):
+    """Drive ``mix`` from ``threads`` closed-loop clients for ``duration``
+    seconds after ``warmup``; returns the measured wall time"""
+    operations = list(mix)
+    weights = [mix[name] for name in operations]
+    stop = threading.Event()
+
+    def worker(index):
+        rng = random.Random(seed_value * 1000 + index)
+        client = make_client()
+        headers = user_headers[index % len(user_headers)]
+        while not stop.is_set():
+            operation = rng.choices(operations, weights)[0]
+            try:
+                getattr(workload, operation)(client, headers, rng)
+            except RequestFailed:
+                pass  # counted by the recorder; carry on with the next operation
+
+    pool = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    if warmup:
+        time.sleep(warmup)
+        workload.recorder.reset()
+    started = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    for thread in pool:
+        thread.join()
+    return time.perf_counter() - started
+
+# Reporting
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint in sorted(set(recorder.samples) | set(recorder.exceptions)):
+        samples = recorder.samples.get(endpoint, [])
+        statuses = recorder.statuses.get(endpoint, {})
+        summary = {
+            'requests': len(samples),
+            'throughput': round(len(samples) / elapsed, 1),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'server_errors': sum(count for status, count in statuses.items() if status >= 500),
+            'exceptions': recorder.exceptions.get(endpoint, 0)
+        }
+        if samples:
+            summary.update({
+                'mean_ms': round(sum(samples) / len(samples) * 1000, 2),
+                'p50_ms': round(percentile(samples, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(samples, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(samples, 0.99) * 1000, 2),
+                'max_ms': round(max(samples) * 1000, 2)
+            })
+        endpoints[endpoint] = summary
+    total = sum(summary['requests'] for summary in endpoints.values())
+    return {'requests': total, 'throughput': round(total / elapsed, 1), 'endpoints': endpoints}
+
+def compare(report, baseline):
+    """Lines describing the change in throughput and p95 per endpoint"""
+    lines = [f"{'endpoint':<30} {'req/s':>9} {'change':>8} {'p95 ms':>9} {'change':>8}"]
+    for endpoint, current in report['results']['endpoints'].items():
+        before = baseline['results']['endpoints'].get(endpoint)
+        if not before or 'p95_ms' not in current or 'p95_ms' not in before:
+            lines.append(f"{endpoint:<30} {current['throughput']:>9} {'new':>8}")
+            continue
+        throughput = (current['throughput'] / before['throughput'] - 1) * 100 if before['throughput'] else 0
+        p95 = (current['p95_ms'] / before['p95_ms'] - 1) * 100 if before['p95_ms'] else 0
+        lines.append(
+            f"{endpoint:<30} {current['throughput']:>9} {throughput:>+7.1f}% {current['p95_ms']:>9} {p95:>+7.1f}%"
+        )
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed a library database and load-test the API')
+    parser.add_argument('--scale', choices=SCALES, default='10k', help='rows to seed')
+    parser.add_argument('--books', type=int, help='override the books seeded by --scale')
+    parser.add_argument('--users', type=int, help='override the users seeded by --scale')
+    parser.add_argument('--loans', type=int, help='override the loans seeded by --scale')
+    parser.add_argument('--database', help='database URL or SQLite path (default: a new temporary file)')
+    parser.add_argument('--seed-only', action='store_true', help='seed --database and exit')
+    parser.add_argument('--skip-seed', action='store_true', help='use data seeded by an earlier run')
+    parser.add_argument('--url', help='load a running server instead of the in-process app')
+    parser.add_argument('--mix', choices=MIXES, default='mixed', help='workload mix')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--clients', type=int, default=20, help='distinct users the threads log in as')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to measure')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds to run before measuring')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for data and workload')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON report to compare against')
+    args = parser.parse_args(argv)
+
+    books, users, loans = SCALES[args.scale]
+    books = args.books if args.books is not None else books
+    users = args.users if args.users is not None else users
+    loans = args.loans if args.loans is not None else loans
+
+    if not args.url:
+        database.close_pool()
+        database.DATABASE = args.database or os.path.join(tempfile.mkdtemp(), 'library.db')
+    elif args.database:
+        database.close_pool()
+        database.DATABASE = args.database
+
+    if not args.skip_seed:
+        database.init_db()
+        conn = database.get_db()
+        try:
+            started = time.perf_counter()
+            seed(conn, books, users, loans, random.Random(args.seed))
+            print(f"Seeded {books} books, {users} users, {loans} loans in "
+                  f"{time.perf_counter() - started:.1f}s", file=sys.stderr)
+        finally:
+            database.release_db(conn)
+        if args.seed_only:
+            return None
+
+    if args.url:
+        def make_client():
+            return HttpClient(args.url)
+    else:
+        from app import create_app
+
+        app = create_app(LoadTestConfig)
+
+        def make_client():
+            return AppClient(app)
+
+    setup = make_client()
+    admin = login(setup, *ADMIN)
+    book_ids = sample_book_ids(setup, admin)
+    user_headers = [login(setup, f'load{i}@library.com', PASSWORD) for i in range(min(args.clients, users))]
+    if not user_headers:
+        raise SystemExit('No seeded users to log in as; seed first or raise --users')
+
+    workload = Workload(Recorder(), book_ids, admin)
+    elapsed = run(
+        make_client, workload, MIXES[args.mix], user_headers, args.threads, args.duration, args.seed, args.warmup
+    )
+
+    report = {
+        'config': {
+            'scale': {'books': books, 'users': users, 'loans': loans},
+            'mix': args.mix,
+            'threads': args.threads,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'seed': args.seed,
+            'target': args.url or 'in-process',
+            'database': database.parse_database_url(database.DATABASE)[0] if not args.url else None,
+            'python': platform.python_version(),
+            'started': datetime.now().isoformat(timespec='seconds')
+        },
+        'results': summarize(workload.recorder, elapsed)
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\n'.join(compare(report, baseline)), file=sys.stderr)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Request and SQL instrumentation exposed in the Prometheus text format
+
+init_app() times every request per endpoint. Connections opened by the
+pool use InstrumentedConnection, whose cursors time each statement,
+count it per operation and log statements slower than SLOW_QUERY_MS
+with their normalized SQL. Only execute() is timed; rows fetched later
+are not. With METRICS_ENABLED off, the pool opens plain connections and
+no request hooks are registered.
+"""
+import logging
+import re
+import sqlite3
+import threading
+import time
+from flask import g, request
+from config import Config
+
+logger = logging.getLogger('library.sql')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counter keyed by label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labels, labels)} {_number(value)}'
+
+class Histogram:
+    """Cumulative bucket histogram keyed by label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    def samples(self):
+        with self._lock:
+            series = {labels: (list(counts), total, sum_) for labels, (counts, total, sum_) in self._series.items()}
+        names = self.labels + ('le',)
+        for labels, (counts, total, sum_) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_labels(names, labels + (_number(bound),))} {cumulative}'
+            yield f'{self.name}_bucket{_labels(names, labels + ("+Inf",))} {total}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {total}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {_number(sum_)}'
+
+REQUESTS = Counter('http_requests_total', 'HTTP requests handled', ('method', 'endpoint', 'status'))
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ('method', 'endpoint'))
+REQUEST_QUERIES = Histogram(
+    'http_request_sql_statements', 'SQL statements run per request', ('method', 'endpoint'), COUNT_BUCKETS
+)
+SQL_STATEMENTS = Counter('sql_statements_total', 'SQL statements executed', ('operation',))
+SQL_LATENCY = Histogram('sql_statement_duration_seconds', 'SQL execute() time', ('operation',), SQL_BUCKETS)
+SQL_ERRORS = Counter('sql_errors_total', 'SQL statements that raised', ('operation',))
+SLOW_QUERIES = Counter('sql_slow_statements_total', 'Statements slower than SLOW_QUERY_MS', ('operation',))
+JWT_FAILURES = Counter('jwt_failures_total', 'Rejected JWTs', ('reason',))
+RATE_LIMITED = Counter('http_rate_limited_total', 'Requests rejected by the rate limiter', ('endpoint', 'scope'))
+
+REGISTRY = [
+    REQUESTS, REQUEST_LATENCY, REQUEST_QUERIES,
+    SQL_STATEMENTS, SQL_LATENCY, SQL_ERRORS, SLOW_QUERIES, JWT_FAILURES, RATE_LIMITED
+]
+
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE = re.compile(r'\s+')
+_KEYWORD = re.compile(r'\s*(\w+)')
+
+def normalize_sql(sql):
+    """Collapse literals, placeholder lists and whitespace so that
+    statements differing only in values read the same in the slow log"""
+    sql = _STRINGS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _LISTS.sub('(...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+def _operation(sql):
+    match = _KEYWORD.match(sql)
+    return match.group(1).upper() if match else ''
+
+# Per-thread statement count for the request being handled
+_current = threading.local()
+
+def record_query(sql, elapsed, failed=False):
+    operation = _operation(sql)
+    SQL_STATEMENTS.inc(operation)
+    SQL_LATENCY.observe(elapsed, operation)
+    if failed:
+        SQL_ERRORS.inc(operation)
+    _current.statements = getattr(_current, 'statements', 0) + 1
+    if elapsed * 1000 >= Config.SLOW_QUERY_MS:
+        SLOW_QUERIES.inc(operation)
+        logger.warning('Slow query (%.1f ms): %s', elapsed * 1000, normalize_sql(sql))
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports each statement to record_query()"""
+
+    def _timed(self, run, sql):
+        started = time.perf_counter()
+        try:
+            result = run()
+        except Exception:
+            record_query(sql, time.perf_counter() - started, failed=True)
+            raise
+        record_query(sql, time.perf_counter() - started)
+        return result
+
+    def execute(self, sql, parameters=()):
+        return self._timed(lambda: super(InstrumentedCursor, self).execute(sql, parameters), sql)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(lambda: super(InstrumentedCursor, self).executemany(sql, seq_of_parameters), sql)
+
+    def executescript(self, sql_script):
+        return self._timed(lambda: super(InstrumentedCursor, self).executescript(sql_script), sql_script)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors, including the shortcut execute*() ones,
+    are InstrumentedCursors"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+def connection_factory():
+    """Connection class for the pool to open"""
+    return InstrumentedConnection if Config.METRICS_ENABLED else sqlite3.Connection
+
+def _endpoint():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+def _start_timer():
+    g.metrics_started = time.perf_counter()
+    _current.statements = 0
+
+def _record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        endpoint = _endpoint()
+        REQUEST_LATENCY.observe(time.perf_counter() - started, request.method, endpoint)
+        REQUEST_QUERIES.observe(getattr(_current, 'statements', 0), request.method, endpoint)
+        REQUESTS.inc(request.method, endpoint, str(response.status_code))
+    return response
+
+def init_app(app):
+    """Register the request timing hooks when metrics are enabled"""
+    if app.config['METRICS_ENABLED']:
+        app.before_request(_start_timer)
+        app.after_request(_record_request)
+
+def render(gauges=(), counters=()):
+    """Every registered metric, plus ``(name, documentation, value)``
+    gauges and counters read from elsewhere (pool, caches), in the
+    Prometheus text exposition format
+
+    Counter names must end in ``_total``.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    for kind, metrics in [('gauge', gauges), ('counter', counters)]:
+        for name, documentation, value in metrics:
+            if kind == 'counter' and not name.endswith('_total'):
+                raise ValueError(f'Counter {name} must end in _total')
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {_number(value)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,113 @@
+"""Keyset pagination and field projection for list endpoints"""
+import base64
+import json
+import math
+from flask import jsonify, request
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(values):
+    """Encode the sort key of the last row as an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor()"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or not all(_is_key_value(value) for value in values):
+        raise ValueError('Invalid cursor')
+    return values
+
+def _is_key_value(value):
+    """A value a sort key column can hold: text, a finite number or null"""
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return value is None or isinstance(value, (str, int))
+
+def parse_fields(allowed):
+    """Read the ``fields`` projection, defaulting to every allowed field"""
+    fields = request.args.get('fields')
+    if not fields:
+        return list(allowed)
+
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    for name in names:
+        if name not in allowed:
+            raise ValueError(f'Unknown field: {name}')
+    return names
+
+def parse_page():
+    """Read ``limit`` and ``cursor``
+
+    Returns (limit, after). limit is None when the client did not ask for
+    a page, in which case the endpoint keeps returning a plain list.
+    """
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+
+    if limit is None and cursor is None:
+        return None, None
+
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+    except ValueError:
+        raise ValueError('Invalid limit')
+    if limit < 1:
+        raise ValueError('Invalid limit')
+
+    after = decode_cursor(cursor) if cursor else None
+    return min(limit, MAX_PAGE_SIZE), after
+
+def select_list(columns, fields, key_fields):
+    """SELECT list for the projected fields plus the sort key"""
+    names = fields + [key for key in key_fields if key not in fields]
+    return ', '.join(f'{columns[name]} AS {name}' for name in names)
+
+def keyset_clause(columns, key_fields, after, descending=False):
+    """WHERE fragment and params that resume after the cursor position"""
+    if after is None:
+        return '', []
+    if len(after) != len(key_fields):
+        raise ValueError('Invalid cursor')
+
+    key = ', '.join(columns[name] for name in key_fields)
+    placeholders = ', '.join('?' for _ in key_fields)
+    operator = '<' if descending else '>'
+    return f' AND ({key}) {operator} ({placeholders})', list(after)
+
+def order_clause(columns, key_fields, descending=False):
+    """ORDER BY matching the keyset"""
+    direction = 'DESC' if descending else 'ASC'
+    return ' ORDER BY ' + ', '.join(f'{columns[name]} {direction}' for name in key_fields)
+
+def limit_clause(limit):
+    """Fetch one extra row so we know whether another page exists"""
+    if limit is None:
+        return '', []
+    return ' LIMIT ?', [limit + 1]
+
+def page_response(rows, fields, key_fields, limit, facets=None):
+    """Serialize rows as a plain list, or as a page with ``next_cursor``
+
+    Facet counts, when given, are added to the page; asking for them
+    switches to the page form even without ``limit``.
+    """
+    if limit is None and facets is None:
+        return jsonify([{name: row[name] for name in fields} for row in rows]), 200
+
+    has_more = limit is not None and len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor([rows[-1][key] for key in key_fields]) if has_more else None
+
+    page = {
+        'items': [{name: row[name] for name in fields} for row in rows],
+        'next_cursor': next_cursor
+    }
+    if facets is not None:
+        page['facets'] = facets
+    return jsonify(page), 200
@@ -0,0 +1,98 @@
+"""Password hashing with salted scrypt
+
+Hashes are stored as ``scrypt$<n>$<r>$<p>$<salt>$<hash>`` so the cost can
+be raised later: verify_password() reports when a stored hash uses other
+parameters (or is a legacy unsalted SHA-256 digest) and should be
+rehashed on the next successful login.
+
+scrypt is deliberately CPU- and memory-heavy, so hashing runs on a small
+bounded worker pool (see offload()) instead of on every request thread.
+"""
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+ALGORITHM = 'scrypt'
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool already has a full queue"""
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(),
+        salt=salt,
+        n=n,
+        r=r,
+        p=p,
+        maxmem=128 * r * (n + p + 2) + 1024 * 1024,
+        dklen=KEY_BYTES
+    )
+
+def hash_password(password):
+    """Hash a password with a fresh salt and the configured cost"""
+    n, r, p = Config.PASSWORD_SCRYPT_N, Config.PASSWORD_SCRYPT_R, Config.PASSWORD_SCRYPT_P
+    salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(password, salt, n, r, p)
+    return f'{ALGORITHM}${n}${r}${p}${salt.hex()}${digest.hex()}'
+
+def is_legacy_hash(stored):
+    """Unsalted SHA-256 hex digests written before scrypt was introduced"""
+    return len(stored) == 64 and '$' not in stored
+
+def verify_password(password, stored):
+    """Check a password against a stored hash
+
+    Returns (matches, needs_rehash).
+    """
+    if is_legacy_hash(stored):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        matches = hmac.compare_digest(legacy, stored)
+        return matches, matches
+
+    # A malformed stored hash, including cost parameters hashlib refuses
+    # (ValueError, or TypeError/OverflowError for out-of-range integers),
+    # fails verification instead of the request
+    try:
+        algorithm, n, r, p, salt, digest = stored.split('$')
+        n, r, p = int(n), int(r), int(p)
+        salt, digest = bytes.fromhex(salt), bytes.fromhex(digest)
+        if algorithm != ALGORITHM:
+            return False, False
+        computed = _scrypt(password, salt, n, r, p)
+    except (ValueError, TypeError, OverflowError):
+        return False, False
+
+    matches = hmac.compare_digest(computed, digest)
+    current = (n, r, p) == (Config.PASSWORD_SCRYPT_N, Config.PASSWORD_SCRYPT_R, Config.PASSWORD_SCRYPT_P)
+    return matches, matches and not current
+
+# Used to keep the cost of a login for an unknown email the same as for a
+# known one, so response times do not reveal which emails are registered
+_dummy_hash = None
+
+def dummy_hash():
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password('not-a-real-password')
+    return _dummy_hash
+
+_executor = ThreadPoolExecutor(max_workers=Config.PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+_slots = threading.BoundedSemaphore(Config.PASSWORD_HASH_WORKERS + Config.PASSWORD_HASH_QUEUE)
+
+def offload(fn, *args):
+    """Run a hashing function on the bounded worker pool and wait for it
+
+    hashlib releases the GIL while hashing, so other request threads keep
+    running. Raises HashingBusy instead of queueing without limit.
+    """
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        return _executor.submit(fn, *args).result()
+    finally:
+        _slots.release()
@@ -0,0 +1,640 @@
+"""PostgreSQL backend for the connection pool in database.py
+
+The rest of the code base talks to connections the way it talks to
+sqlite3: ``?`` placeholders, ``conn.execute()`` shortcuts, rows that can
+be read by name or position and converted with dict(), and
+``in_transaction``. The small adapter below gives psycopg2 connections
+that interface, so only the SQL that really differs between the two
+databases needs a PostgreSQL variant (see repository.py).
+
+Timestamps come back as the same ``YYYY-MM-DD HH:MM:SS[.ffffff]`` strings
+SQLite returns, so responses and pagination cursors look the same on
+both backends.
+
+psycopg2 is only needed when DATABASE_URL points at PostgreSQL.
+"""
+import datetime
+import decimal
+import itertools
+import re
+import time
+from config import Config
+import metrics
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+DIALECT = 'postgresql'
+
+_cursor_names = itertools.count(1)
+
+# Quoted strings and identifiers, then bare ``?`` placeholders and ``%``
+_TOKENS = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|\?|%""")
+
+def translate(sql):
+    """Rewrite qmark placeholders as psycopg2 ``%s`` ones
+
+    A ``?`` inside a quoted string stays as it is; every literal ``%`` is
+    doubled, since psycopg2 formats the whole statement.
+    """
+    def replace(match):
+        token = match.group(0)
+        return '%s' if token == '?' else token.replace('%', '%%')
+    return _TOKENS.sub(replace, sql)
+
+def _value(value):
+    if isinstance(value, datetime.datetime):
+        return str(value)
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+class Row:
+    """Read-only row addressable by column name or index, like sqlite3.Row"""
+
+    __slots__ = ('_names', '_values')
+
+    def __init__(self, names, values):
+        self._names = names
+        self._values = tuple(_value(value) for value in values)
+
+    def keys(self):
+        return list(self._names)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return self._values[key]
+        try:
+            return self._values[self._names.index(key)]
+        except ValueError:
+            raise IndexError(f'No item with that key: {key}')
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        return isinstance(other, Row) and self._names == other._names and self._values == other._values
+
+    def __repr__(self):
+        return f'<Row {dict(zip(self._names, self._values))}>'
+
+class Cursor:
+    """sqlite3-style cursor over a psycopg2 cursor"""
+
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        if name is None:
+            self._cursor = connection.raw.cursor()
+        else:
+            self._cursor = connection.raw.cursor(name=name)
+            self._cursor.itersize = Config.EXPORT_FETCH_SIZE
+        self._names = None
+
+    def _timed(self, run, sql):
+        if not Config.METRICS_ENABLED:
+            run()
+            return self
+        started = time.perf_counter()
+        try:
+            run()
+        except Exception:
+            metrics.record_query(sql, time.perf_counter() - started, failed=True)
+            raise
+        metrics.record_query(sql, time.perf_counter() - started)
+        return self
+
+    def execute(self, sql, parameters=()):
+        self._names = None
+        return self._timed(lambda: self._cursor.execute(translate(sql), tuple(parameters)), sql)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Not execute_batch(): it sends pages of statements as one query, so
+        # rowcount would only cover the last statement of the last page
+        self._names = None
+        return self._timed(
+            lambda: self._cursor.executemany(translate(sql), [tuple(params) for params in seq_of_parameters]), sql
+        )
+
+    def executescript(self, sql_script):
+        # Scripts carry no parameters, so psycopg2 sends them as they are
+        self._names = None
+        return self._timed(lambda: self._cursor.execute(sql_script), sql_script)
+
+    def _has_rows(self):
+        # Like sqlite3, fetching after a statement without results gives
+        # nothing; server-side cursors only describe their rows once fetched
+        return self._cursor.name is not None or self._cursor.description is not None
+
+    def _rows(self, rows):
+        if rows and self._names is None:
+            self._names = tuple(column.name for column in self._cursor.description)
+        return [Row(self._names, values) for values in rows]
+
+    def fetchone(self):
+        if not self._has_rows():
+            return None
+        values = self._cursor.fetchone()
+        return self._rows([values])[0] if values is not None else None
+
+    def fetchmany(self, size=None):
+        if not self._has_rows():
+            return []
+        return self._rows(self._cursor.fetchmany(size or self._cursor.arraysize))
+
+    def fetchall(self):
+        if not self._has_rows():
+            return []
+        return self._rows(self._cursor.fetchall())
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+class Connection:
+    """sqlite3-style connection over a psycopg2 connection"""
+
+    dialect = DIALECT
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def cursor(self):
+        return Cursor(self)
+
+    def server_cursor(self):
+        """Cursor whose rows stay on the server until fetched, for
+        streaming large results; only valid until the transaction ends"""
+        return Cursor(self, f'stream_{next(_cursor_names)}')
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    @property
+    def in_transaction(self):
+        return self.raw.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+def connect(dsn):
+    """Open an adapted connection; statements run in UTC, like SQLite's
+    CURRENT_TIMESTAMP"""
+    if psycopg2 is None:
+        raise RuntimeError('DATABASE_URL points at PostgreSQL but psycopg2 is not installed')
+    raw = psycopg2.connect(dsn, options='-c timezone=UTC')
+    return Connection(raw)
+
+def is_retryable(error):
+    """Serialization failures and deadlocks, which are worth retrying"""
+    return getattr(error, 'pgcode', None) in ('40001', '40P01')
+
+# Schema migrations for PostgreSQL, applied in order and recorded in
+# schema_version. The first one creates the schema that SQLite reaches
+# after its migrations 1-6 (see database.MIGRATIONS); later ones follow
+# SQLite's from 7 on.
+MIGRATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        full_name TEXT NOT NULL,
+        role TEXT NOT NULL DEFAULT 'student',
+        created_at TIMESTAMP DEFAULT LOCALTIMESTAMP(0)
+    );
+
+    CREATE TABLE IF NOT EXISTS books (
+        id SERIAL PRIMARY KEY,
+        isbn TEXT UNIQUE,
+        title TEXT NOT NULL,
+        author TEXT NOT NULL,
+        category TEXT,
+        total_copies INTEGER DEFAULT 1,
+        available_copies INTEGER DEFAULT 1,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT LOCALTIMESTAMP(0),
+        -- full-text search over title (weight A) and author (weight B)
+        search_vector TSVECTOR GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', COALESCE(title, '')), 'A') ||
+            setweight(to_tsvector('simple', COALESCE(author, '')), 'B')
+        ) STORED
+    );
+
+    CREATE TABLE IF NOT EXISTS loans (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        book_id INTEGER NOT NULL REFERENCES books (id),
+        borrow_date TIMESTAMP DEFAULT LOCALTIMESTAMP(0),
+        due_date TIMESTAMP NOT NULL,
+        return_date TIMESTAMP,
+        status TEXT DEFAULT 'active',
+        overdue_at TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS holds (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        book_id INTEGER NOT NULL REFERENCES books (id),
+        hold_date TIMESTAMP DEFAULT LOCALTIMESTAMP(0),
+        status TEXT DEFAULT 'waiting',
+        ready_date TIMESTAMP
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_books_search ON books USING GIN (search_vector);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_loans_active_user_book
+        ON loans (user_id, book_id) WHERE status = 'active';
+    CREATE INDEX IF NOT EXISTS idx_loans_user_borrow_date ON loans (user_id, borrow_date);
+    CREATE INDEX IF NOT EXISTS idx_loans_borrow_date ON loans (borrow_date);
+    CREATE INDEX IF NOT EXISTS idx_loans_status_due_date ON loans (status, due_date);
+    CREATE INDEX IF NOT EXISTS idx_books_title ON books (title);
+    CREATE INDEX IF NOT EXISTS idx_books_category_title ON books (category, title);
+    CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at);
+    CREATE INDEX IF NOT EXISTS idx_holds_book_waiting
+        ON holds (book_id, hold_date) WHERE status = 'waiting';
+    CREATE INDEX IF NOT EXISTS idx_holds_user ON holds (user_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_active_user_book
+        ON holds (user_id, book_id) WHERE status IN ('waiting', 'ready');
+
+    CREATE TABLE IF NOT EXISTS library_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_books INTEGER NOT NULL DEFAULT 0,
+        available_books INTEGER NOT NULL DEFAULT 0,
+        total_users INTEGER NOT NULL DEFAULT 0,
+        active_loans INTEGER NOT NULL DEFAULT 0
+    );
+
+    INSERT INTO library_stats (id) VALUES (1) ON CONFLICT (id) DO NOTHING;
+
+    CREATE OR REPLACE FUNCTION library_stats_books() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE library_stats SET
+                total_books = total_books + 1,
+                available_books = available_books + COALESCE(NEW.available_copies, 0)
+            WHERE id = 1;
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE library_stats SET
+                total_books = total_books - 1,
+                available_books = available_books - COALESCE(OLD.available_copies, 0)
+            WHERE id = 1;
+        ELSIF NEW.available_copies IS DISTINCT FROM OLD.available_copies THEN
+            UPDATE library_stats SET
+                available_books = available_books + COALESCE(NEW.available_copies, 0) - COALESCE(OLD.available_copies, 0)
+            WHERE id = 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION library_stats_users() RETURNS trigger AS $$
+    BEGIN
+        UPDATE library_stats SET
+            total_users = total_users + (CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END)
+        WHERE id = 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION library_stats_loans() RETURNS trigger AS $$
+    DECLARE
+        delta INTEGER := 0;
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'active' THEN
+            delta := delta + 1;
+        END IF;
+        IF TG_OP IN ('DELETE', 'UPDATE') AND OLD.status = 'active' THEN
+            delta := delta - 1;
+        END IF;
+        IF delta <> 0 THEN
+            UPDATE library_stats SET active_loans = active_loans + delta WHERE id = 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS library_stats_books ON books;
+    CREATE TRIGGER library_stats_books AFTER INSERT OR DELETE OR UPDATE OF available_copies ON books
+        FOR EACH ROW EXECUTE FUNCTION library_stats_books();
+    DROP TRIGGER IF EXISTS library_stats_users ON users;
+    CREATE TRIGGER library_stats_users AFTER INSERT OR DELETE ON users
+        FOR EACH ROW EXECUTE FUNCTION library_stats_users();
+    DROP TRIGGER IF EXISTS library_stats_loans ON loans;
+    CREATE TRIGGER library_stats_loans AFTER INSERT OR DELETE OR UPDATE OF status ON loans
+        FOR EACH ROW EXECUTE FUNCTION library_stats_loans();
+
+    CREATE TABLE IF NOT EXISTS overdue_summary (
+        user_id INTEGER PRIMARY KEY,
+        overdue_count INTEGER NOT NULL,
+        oldest_due_date TIMESTAMP,
+        updated_at TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS scheduler_state (
+        name TEXT PRIMARY KEY,
+        last_due_date TIMESTAMP,
+        last_loan_id INTEGER,
+        last_run TIMESTAMP
+    );
+
+    CREATE OR REPLACE FUNCTION overdue_summary_return() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO overdue_summary (user_id, overdue_count, oldest_due_date, updated_at)
+        SELECT OLD.user_id, COUNT(*), MIN(due_date), LOCALTIMESTAMP(0)
+        FROM loans
+        WHERE user_id = OLD.user_id AND status = 'active' AND overdue_at IS NOT NULL
+        ON CONFLICT (user_id) DO UPDATE SET
+            overdue_count = excluded.overdue_count,
+            oldest_due_date = excluded.oldest_due_date,
+            updated_at = excluded.updated_at;
+        DELETE FROM overdue_summary WHERE user_id = OLD.user_id AND overdue_count = 0;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS overdue_summary_return ON loans;
+    CREATE TRIGGER overdue_summary_return AFTER UPDATE OF status ON loans
+        FOR EACH ROW WHEN (OLD.overdue_at IS NOT NULL AND NEW.status <> 'active')
+        EXECUTE FUNCTION overdue_summary_return();
+    ''',
+
+    # 2: per-table change versions, as SQLite migration 7; one bump per
+    # statement rather than per row
+    '''
+    CREATE TABLE IF NOT EXISTS table_versions (
+        name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL,
+        updated_at TIMESTAMP NOT NULL
+    );
+
+    INSERT INTO table_versions (name, version, updated_at)
+    VALUES ('books', EXTRACT(EPOCH FROM LOCALTIMESTAMP(0))::bigint, LOCALTIMESTAMP(0))
+    ON CONFLICT (name) DO NOTHING;
+
+    CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE table_versions SET version = version + 1, updated_at = LOCALTIMESTAMP(0) WHERE name = TG_ARGV[0];
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS books_version ON books;
+    CREATE TRIGGER books_version AFTER INSERT OR UPDATE OR DELETE ON books
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version('books');
+    ''',
+
+    # 3: related_books, as SQLite migration 8
+    '''
+    CREATE TABLE IF NOT EXISTS related_books (
+        book_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        related_id INTEGER NOT NULL,
+        borrowers INTEGER NOT NULL,
+        share DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (book_id, position)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_loans_book_user ON loans (book_id, user_id);
+    ''',
+
+    # 4: facet_counts, as SQLite migration 9
+    '''
+    CREATE TABLE IF NOT EXISTS facet_counts (
+        facet TEXT NOT NULL,
+        value TEXT NOT NULL,
+        books INTEGER NOT NULL,
+        available INTEGER NOT NULL,
+        PRIMARY KEY (facet, value)
+    );
+
+    INSERT INTO facet_counts (facet, value, books, available)
+    SELECT 'all', '', COUNT(*), COUNT(*) FILTER (WHERE available_copies > 0) FROM books
+    UNION ALL
+    SELECT 'category', category, COUNT(*), COUNT(*) FILTER (WHERE available_copies > 0) FROM books
+    WHERE category <> '' GROUP BY category
+    UNION ALL
+    SELECT 'author', author, COUNT(*), COUNT(*) FILTER (WHERE available_copies > 0) FROM books
+    WHERE author <> '' GROUP BY author
+    ON CONFLICT (facet, value) DO UPDATE SET books = excluded.books, available = excluded.available;
+
+    CREATE OR REPLACE FUNCTION facet_counts_books() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE'
+            AND OLD.category IS NOT DISTINCT FROM NEW.category
+            AND OLD.author IS NOT DISTINCT FROM NEW.author
+            AND (COALESCE(OLD.available_copies, 0) > 0) = (COALESCE(NEW.available_copies, 0) > 0) THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE facet_counts SET
+                books = books - 1,
+                available = available - (CASE WHEN OLD.available_copies > 0 THEN 1 ELSE 0 END)
+            WHERE facet = 'all'
+                OR (facet = 'category' AND value = OLD.category)
+                OR (facet = 'author' AND value = OLD.author);
+            DELETE FROM facet_counts
+            WHERE books = 0 AND ((facet = 'category' AND value = OLD.category) OR (facet = 'author' AND value = OLD.author));
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO facet_counts (facet, value, books, available)
+            SELECT v.facet, v.value, 1, CASE WHEN NEW.available_copies > 0 THEN 1 ELSE 0 END
+            FROM (VALUES ('all', ''), ('category', NEW.category), ('author', NEW.author)) AS v (facet, value)
+            WHERE v.facet = 'all' OR v.value <> ''
+            ON CONFLICT (facet, value) DO UPDATE SET
+                books = facet_counts.books + 1,
+                available = facet_counts.available + excluded.available;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS facet_counts_books ON books;
+    CREATE TRIGGER facet_counts_books AFTER INSERT OR DELETE OR UPDATE OF category, author, available_copies ON books
+        FOR EACH ROW EXECUTE FUNCTION facet_counts_books();
+    ''',
+
+    # 5: loan rollups, as SQLite migration 10. A borrower is counted the
+    # first time their borrower_rollups row is inserted, which the upsert
+    # reports reliably under concurrent borrows (xmax = 0 on a new row).
+    # The rebuild locks loans against writes while it runs.
+    '''
+    CREATE TABLE IF NOT EXISTS loan_rollups (
+        granularity TEXT NOT NULL,
+        period TEXT NOT NULL,
+        borrows INTEGER NOT NULL,
+        returns INTEGER NOT NULL,
+        borrowers INTEGER NOT NULL,
+        PRIMARY KEY (granularity, period)
+    );
+
+    CREATE TABLE IF NOT EXISTS book_rollups (
+        granularity TEXT NOT NULL,
+        period TEXT NOT NULL,
+        book_id INTEGER NOT NULL,
+        borrows INTEGER NOT NULL,
+        PRIMARY KEY (granularity, period, book_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS borrower_rollups (
+        granularity TEXT NOT NULL,
+        period TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        borrows INTEGER NOT NULL,
+        PRIMARY KEY (granularity, period, user_id)
+    );
+
+    CREATE OR REPLACE FUNCTION rollup_period(granularity TEXT, ts TIMESTAMP) RETURNS TEXT AS $$
+        SELECT CASE granularity
+            WHEN 'hour' THEN to_char(date_trunc('hour', ts), 'YYYY-MM-DD HH24:MI:SS')
+            WHEN 'day' THEN to_char(ts, 'YYYY-MM-DD')
+            WHEN 'week' THEN to_char(date_trunc('week', ts), 'YYYY-MM-DD')
+            WHEN 'month' THEN to_char(ts, 'YYYY-MM-01')
+        END
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION rebuild_loan_rollups() RETURNS void AS $$
+    BEGIN
+        LOCK TABLE loans IN SHARE MODE;
+        DELETE FROM loan_rollups;
+        DELETE FROM book_rollups;
+        DELETE FROM borrower_rollups;
+        INSERT INTO loan_rollups (granularity, period, borrows, returns, borrowers)
+        SELECT granularity, period, SUM(borrows), SUM(returns), SUM(borrowers) FROM (
+            SELECT g AS granularity, rollup_period(g, borrow_date) AS period, COUNT(*) AS borrows, 0 AS returns,
+                CASE WHEN g = 'hour' THEN 0 ELSE COUNT(DISTINCT user_id) END AS borrowers
+            FROM loans CROSS JOIN unnest(ARRAY['hour', 'day', 'week', 'month']) AS g
+            WHERE borrow_date IS NOT NULL GROUP BY 1, 2
+            UNION ALL
+            SELECT g, rollup_period(g, return_date), 0, COUNT(*), 0
+            FROM loans CROSS JOIN unnest(ARRAY['hour', 'day', 'week', 'month']) AS g
+            WHERE status = 'returned' AND return_date IS NOT NULL GROUP BY 1, 2
+        ) AS counts
+        GROUP BY 1, 2;
+        INSERT INTO book_rollups (granularity, period, book_id, borrows)
+        SELECT g, rollup_period(g, borrow_date), book_id, COUNT(*)
+        FROM loans CROSS JOIN unnest(ARRAY['day', 'week', 'month']) AS g
+        WHERE borrow_date IS NOT NULL GROUP BY 1, 2, 3;
+        INSERT INTO borrower_rollups (granularity, period, user_id, borrows)
+        SELECT g, rollup_period(g, borrow_date), user_id, COUNT(*)
+        FROM loans CROSS JOIN unnest(ARRAY['day', 'week', 'month']) AS g
+        WHERE borrow_date IS NOT NULL GROUP BY 1, 2, 3;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    SELECT rebuild_loan_rollups();
+
+    CREATE OR REPLACE FUNCTION loan_rollups_loans() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' AND NEW.borrow_date IS NOT NULL THEN
+            INSERT INTO loan_rollups (granularity, period, borrows, returns, borrowers)
+            SELECT g, rollup_period(g, NEW.borrow_date), 1, 0, 0
+            FROM unnest(ARRAY['hour', 'day', 'week', 'month']) AS g
+            ON CONFLICT (granularity, period) DO UPDATE SET borrows = loan_rollups.borrows + 1;
+            WITH counted AS (
+                INSERT INTO borrower_rollups (granularity, period, user_id, borrows)
+                SELECT g, rollup_period(g, NEW.borrow_date), NEW.user_id, 1
+                FROM unnest(ARRAY['day', 'week', 'month']) AS g
+                ON CONFLICT (granularity, period, user_id) DO UPDATE SET borrows = borrower_rollups.borrows + 1
+                RETURNING granularity, period, xmax = 0 AS inserted
+            )
+            UPDATE loan_rollups r SET borrowers = r.borrowers + 1
+            FROM counted
+            WHERE counted.inserted AND r.granularity = counted.granularity AND r.period = counted.period;
+            INSERT INTO book_rollups (granularity, period, book_id, borrows)
+            SELECT g, rollup_period(g, NEW.borrow_date), NEW.book_id, 1
+            FROM unnest(ARRAY['day', 'week', 'month']) AS g
+            ON CONFLICT (granularity, period, book_id) DO UPDATE SET borrows = book_rollups.borrows + 1;
+        END IF;
+        IF NEW.status = 'returned' AND NEW.return_date IS NOT NULL
+            AND (TG_OP = 'INSERT' OR OLD.status = 'active') THEN
+            INSERT INTO loan_rollups (granularity, period, borrows, returns, borrowers)
+            SELECT g, rollup_period(g, NEW.return_date), 0, 1, 0
+            FROM unnest(ARRAY['hour', 'day', 'week', 'month']) AS g
+            ON CONFLICT (granularity, period) DO UPDATE SET returns = loan_rollups.returns + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS loan_rollups_loans ON loans;
+    CREATE TRIGGER loan_rollups_loans AFTER INSERT OR UPDATE OF status ON loans
+        FOR EACH ROW EXECUTE FUNCTION loan_rollups_loans();
+    ''',
+
+    # 6: event log, as SQLite migration 11. TRUNCATE is refused as well;
+    # events.append() locks the table so seq follows commit order.
+    '''
+    CREATE TABLE IF NOT EXISTS events (
+        seq BIGSERIAL PRIMARY KEY,
+        created_at TIMESTAMP DEFAULT LOCALTIMESTAMP(0),
+        actor_id INTEGER,
+        type TEXT NOT NULL,
+        entity_id INTEGER,
+        data TEXT
+    );
+
+    CREATE OR REPLACE FUNCTION events_append_only() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'events are append-only';
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS events_append_only ON events;
+    CREATE TRIGGER events_append_only BEFORE UPDATE OR DELETE ON events
+        FOR EACH ROW EXECUTE FUNCTION events_append_only();
+    DROP TRIGGER IF EXISTS events_no_truncate ON events;
+    CREATE TRIGGER events_no_truncate BEFORE TRUNCATE ON events
+        FOR EACH STATEMENT EXECUTE FUNCTION events_append_only();
+    ''',
+
+    # 7: ready holds by age, as SQLite migration 12
+    '''
+    CREATE INDEX IF NOT EXISTS idx_holds_ready_date ON holds (ready_date) WHERE status = 'ready';
+    ''',
+]
+
+def migrate(conn):
+    """Apply pending migrations, each in its own transaction"""
+    conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    conn.commit()
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    version = row[0] or 0
+
+    for number, script in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        try:
+            conn.executescript(script)
+            conn.execute('INSERT INTO schema_version (version) VALUES (?)', (number,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {number}")
@@ -0,0 +1,304 @@
+"""Per-IP and per-account rate limiting with token buckets
+
+Each limited endpoint (RATE_LIMITS, keyed by endpoint name) has a bucket
+per client IP and, where configured, per account: the email in the JSON
+body, for the auth endpoints. A limit ``"N/S"`` allows bursts of N
+requests, refilled at N per S seconds. A request takes a token from all
+of its buckets or from none, so attempts rejected for one account do not
+also use up the IP's budget. RATE_LIMIT_DEFAULT, when set, is a per-IP
+limit for every other endpoint.
+
+The check runs in a before_request hook, ahead of JWT checks, password
+hashing and the database, so a rejected request costs a dict lookup and
+a 429 with a Retry-After header.
+
+A bucket is stored as a single float, the time at which it will be full
+again (the "theoretical arrival time" form of a token bucket): a request
+moves it one refill interval later, and is allowed while it stays within
+N intervals of now. A bucket whose time has passed is full, the same as
+a missing one, so evicting it loses nothing. MemoryStore keeps the
+buckets of one process in an OrderedDict bounded to RATE_LIMIT_MAX_KEYS
+with LRU eviction. With several worker processes (serve.py), each would
+allow the full rate; set RATE_LIMIT_STORAGE to a SQLite file (separate
+from the library database) to share buckets through FileStore instead.
+"""
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import current_app, jsonify, request
+import metrics
+
+# Delete full buckets from a FileStore every this many writes
+PRUNE_EVERY = 1000
+
+class Limit(namedtuple('Limit', ['capacity', 'period'])):
+    """``capacity`` requests per ``period`` seconds"""
+
+    @property
+    def interval(self):
+        return self.period / self.capacity
+
+def parse_limit(spec):
+    """Limit from ``"N/S"``; None for an empty spec (no limit)"""
+    if not spec:
+        return None
+    try:
+        capacity, period = spec.split('/')
+        limit = Limit(int(capacity), float(period))
+    except ValueError:
+        raise ValueError(f'Invalid rate limit: {spec!r} (expected "requests/seconds")')
+    if limit.capacity <= 0 or limit.period <= 0:
+        raise ValueError(f'Invalid rate limit: {spec!r}')
+    return limit
+
+def _take(buckets, now):
+    """Apply one request to ``buckets``, [(key, limit, full_at or None)]
+
+    Returns (updates, retry_after, denied_index): the new full_at of each
+    key when every bucket has a token, else no updates and the wait.
+    """
+    updates = {}
+    for index, (key, limit, full_at) in enumerate(buckets):
+        after = max(full_at or now, now) + limit.interval
+        wait = after - now - limit.period
+        if wait > 0:
+            return {}, wait, index
+        updates[key] = after
+    return updates, 0, None
+
+class MemoryStore:
+    """Buckets of this process, LRU-bounded to ``max_keys``"""
+
+    def __init__(self, max_keys, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def take(self, limits):
+        """Take a token for each (key, Limit) pair, or none of them
+
+        Returns (retry_after seconds, index of the limit that refused);
+        (0, None) when the request may go ahead.
+        """
+        with self._lock:
+            now = self.clock()
+            buckets = [(key, limit, self._buckets.get(key)) for key, limit in limits]
+            updates, wait, denied = _take(buckets, now)
+            for key, full_at in updates.items():
+                self._buckets[key] = full_at
+            # Refused keys count as used too, or eviction would refill them
+            for key, limit in limits:
+                if key in self._buckets:
+                    self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+            return wait, denied
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        return {'storage': 'memory', 'keys': len(self._buckets), 'evictions': self.evictions}
+
+class FileStore:
+    """Buckets in a SQLite file shared by every process that opens it
+
+    Each take() is one short write transaction on that file. Keys found
+    empty are remembered in-process until they can next succeed (a
+    bucket's time only moves forward), so repeated rejections skip the
+    file altogether.
+    """
+
+    def __init__(self, path, max_keys, clock=time.time):
+        self.path = path
+        self.max_keys = max_keys
+        self.clock = clock
+        self._local = threading.local()
+        self._blocked = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.evictions = 0
+        # Connections are per thread and opened on first use, so none is
+        # inherited by serve.py's forked workers
+        conn = sqlite3.connect(path, timeout=5)
+        try:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, full_at REAL NOT NULL) WITHOUT ROWID'
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = OFF')
+            self._local.conn = conn
+        return conn
+
+    def _blocked_wait(self, limits, now):
+        with self._lock:
+            for index, (key, limit) in enumerate(limits):
+                until = self._blocked.get(key)
+                if until is not None:
+                    if until > now:
+                        return until - now, index
+                    del self._blocked[key]
+        return 0, None
+
+    def take(self, limits):
+        """Same contract as MemoryStore.take()"""
+        now = self.clock()
+        wait, denied = self._blocked_wait(limits, now)
+        if denied is not None:
+            return wait, denied
+
+        keys = [key for key, limit in limits]
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            stored = dict(conn.execute(
+                f"SELECT key, full_at FROM rate_limits WHERE key IN ({', '.join('?' for _ in keys)})", keys
+            ).fetchall())
+            updates, wait, denied = _take([(key, limit, stored.get(key)) for key, limit in limits], now)
+            conn.executemany(
+                'INSERT INTO rate_limits (key, full_at) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET full_at = excluded.full_at',
+                list(updates.items())
+            )
+            if updates:
+                self._writes += 1
+                if self._writes % PRUNE_EVERY == 0:
+                    self._prune(conn, now)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        if denied is not None:
+            with self._lock:
+                self._blocked[keys[denied]] = now + wait
+                if len(self._blocked) > self.max_keys:
+                    self._blocked.popitem(last=False)
+        return wait, denied
+
+    def _prune(self, conn, now):
+        """Drop full buckets, then the oldest ones beyond max_keys"""
+        conn.execute('DELETE FROM rate_limits WHERE full_at <= ?', (now,))
+        excess = conn.execute('SELECT COUNT(*) FROM rate_limits').fetchone()[0] - self.max_keys
+        if excess > 0:
+            conn.execute(
+                'DELETE FROM rate_limits WHERE key IN (SELECT key FROM rate_limits ORDER BY full_at LIMIT ?)',
+                (excess,)
+            )
+            self.evictions += excess
+
+    def clear(self):
+        with self._lock:
+            self._blocked.clear()
+        self._connect().execute('DELETE FROM rate_limits')
+
+    def stats(self):
+        keys = self._connect().execute('SELECT COUNT(*) FROM rate_limits').fetchone()[0]
+        return {'storage': 'file', 'keys': keys, 'evictions': self.evictions}
+
+def open_store(storage, max_keys):
+    """MemoryStore for ``'memory'``, else a FileStore at the SQLite path or
+    ``sqlite:///`` URL ``storage``"""
+    if storage == 'memory':
+        return MemoryStore(max_keys)
+    if storage.startswith('sqlite:///'):
+        storage = storage[len('sqlite:///'):]
+    elif '://' in storage:
+        raise ValueError(f'Unsupported RATE_LIMIT_STORAGE: {storage}')
+    return FileStore(storage, max_keys)
+
+class RateLimiter:
+    """Checks requests against the configured limits of their endpoint"""
+
+    def __init__(self, limits, default=None, store=None, trusted_proxies=0):
+        self.limits = {
+            endpoint: [(scope, parse_limit(spec)) for scope, spec in scopes.items() if spec]
+            for endpoint, scopes in limits.items()
+        }
+        self.default = parse_limit(default)
+        self.store = store or MemoryStore(100000)
+        self.trusted_proxies = trusted_proxies
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config['RATE_LIMITS'], config['RATE_LIMIT_DEFAULT'],
+            open_store(config['RATE_LIMIT_STORAGE'], config['RATE_LIMIT_MAX_KEYS']),
+            config['RATE_LIMIT_TRUSTED_PROXIES']
+        )
+
+    def client_ip(self):
+        """remote_addr, or the address the outermost trusted proxy saw"""
+        if self.trusted_proxies:
+            route = request.access_route
+            return route[max(0, len(route) - self.trusted_proxies)]
+        return request.remote_addr
+
+    def _account(self):
+        data = request.get_json(silent=True)
+        email = data.get('email') if isinstance(data, dict) else None
+        return email.strip().lower() if isinstance(email, str) else None
+
+    def check(self, endpoint):
+        """(retry_after, refusing scope) for the current request; (0, None)
+        when it may go ahead"""
+        scopes = self.limits.get(endpoint)
+        if scopes is None:
+            scopes = [('ip', self.default)] if self.default else []
+        names, limits = [], []
+        for scope, limit in scopes:
+            value = self.client_ip() if scope == 'ip' else self._account()
+            if value:
+                names.append(scope)
+                limits.append((f'{endpoint}:{scope}:{value}', limit))
+        if not limits:
+            return 0, None
+        wait, denied = self.store.take(limits)
+        if denied is None:
+            return 0, None
+        self.rejected += 1
+        return wait, names[denied]
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        return dict(self.store.stats(), rejected=self.rejected)
+
+def get_limiter(app=None):
+    """The app's RateLimiter, or None when rate limiting is off"""
+    return (app or current_app).extensions.get('rate_limiter')
+
+def _limit_request():
+    endpoint = request.endpoint
+    if endpoint is None or request.method == 'OPTIONS':
+        return None
+    wait, scope = get_limiter().check(endpoint)
+    if scope is None:
+        return None
+    metrics.RATE_LIMITED.inc(endpoint, scope)
+    response = jsonify({'error': 'Too many requests, please retry later'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response
+
+def init_app(app):
+    """Install the limiter when RATE_LIMIT_ENABLED is on"""
+    if app.config['RATE_LIMIT_ENABLED']:
+        app.extensions['rate_limiter'] = RateLimiter.from_config(app.config)
+        app.before_request(_limit_request)
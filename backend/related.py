@@ -0,0 +1,279 @@
+"""Related books: "borrowers of this also borrowed"
+
+An item-to-item co-occurrence model over the loan history. With B the
+sparse user x book matrix (1 where the user has ever borrowed the book),
+C = B^T B counts, for every pair of books, the borrowers they share. The
+RELATED_TOP_K largest entries of each row of C (the book itself
+excluded) are stored in related_books, so GET /api/books/<id>/related
+reads at most K rows by primary key whatever the size of the history.
+``share`` is the fraction of the book's borrowers who also borrowed the
+related one.
+
+C is never held whole: rows are computed a block of books at a time
+with one sparse product, ranked with one lexsort and written in one
+transaction. Blocks are sized by the number of (borrower, book) pairs
+the product visits, RELATED_BLOCK_PAIRS, rather than by book count, so a
+block of popular books is as cheap as any other.
+
+A refresh only recomputes the rows that loans since the last build can
+change. A loan of book b by user u adds u to the co-borrowers of b and
+of every other book u has borrowed; no other row changes (rows are
+ranked by count, and the share depends only on the row's own book). So
+the affected rows are the histories of the users with new loans. Those
+rows depend on the histories of all their books' borrowers, which for a
+popular book is most of the table, so B is kept in memory (LoanHistory)
+by the long-running refresher and extended with the loans after its
+position, read by primary key. A refresh then reads only new loans and
+computes only affected rows; a one-off ``python related.py`` has to load
+B first. Recomputing a row is idempotent, so refreshes may overlap. On
+PostgreSQL, a borrow that commits after a refresh has read a higher
+loan id is only picked up by the next full build.
+
+numpy and scipy are needed to build the model, not to serve it.
+
+Usage:
+    python related.py          # refresh from new loans (a full build the first time)
+    python related.py --full   # rebuild from the whole loan history
+"""
+import argparse
+import threading
+import traceback
+from datetime import datetime
+import database
+import repository
+from config import Config
+
+try:
+    import numpy as np
+    import scipy.sparse as sp
+except ImportError:
+    np = sp = None
+
+JOB_NAME = 'related_books'
+
+# Ids per DELETE ... IN (...), under SQLite's default host parameter limit
+CHUNK_SIZE = 500
+
+FETCH_SIZE = 100000
+
+def _require_scipy():
+    if sp is None:
+        raise RuntimeError('numpy and scipy are needed to build related books: pip install numpy scipy')
+
+def _chunks(values, size=CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _last_loan_id(conn):
+    return conn.execute('SELECT COALESCE(MAX(id), 0) AS id FROM loans').fetchone()['id']
+
+def _matrix(cursor, shape=(0, 0)):
+    """Binary user x book CSR matrix from a cursor over (user_id, book_id)
+
+    At least ``shape`` in size.
+    """
+    users, books = [], []
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        users.append(np.fromiter((row[0] for row in rows), np.int64, len(rows)))
+        books.append(np.fromiter((row[1] for row in rows), np.int64, len(rows)))
+    users = np.concatenate(users) if users else np.zeros(0, np.int64)
+    books = np.concatenate(books) if books else np.zeros(0, np.int64)
+    shape = (max(shape[0], int(users.max(initial=0)) + 1), max(shape[1], int(books.max(initial=0)) + 1))
+    matrix = sp.csr_matrix((np.ones(len(users), np.int32), (users, books)), shape=shape)
+    matrix.data[:] = 1  # borrowing a book twice still makes one borrower
+    return matrix
+
+class LoanHistory:
+    """The user x book borrow matrix, kept up to date with new loans"""
+
+    def __init__(self):
+        self.matrix = None
+        self.last_loan_id = 0
+
+    def load(self, conn):
+        """Read the whole loan history"""
+        last_loan_id = _last_loan_id(conn)
+        self.matrix = _matrix(repository.execute_streaming(conn, 'SELECT user_id, book_id FROM loans', ()))
+        self.last_loan_id = last_loan_id
+        conn.commit()
+
+    def update(self, conn):
+        """Add the loans made since the last load() or update()"""
+        if self.matrix is None:
+            return self.load(conn)
+        last_loan_id = _last_loan_id(conn)
+        new = _matrix(
+            conn.execute('SELECT user_id, book_id FROM loans WHERE id > ?', (self.last_loan_id,)),
+            self.matrix.shape
+        )
+        conn.commit()
+        self.matrix.resize(new.shape)
+        self.matrix = self.matrix + new
+        self.matrix.data[:] = 1
+        self.last_loan_id = last_loan_id
+
+def _blocks(matrix, book_ids, max_pairs):
+    """Split ``book_ids`` into blocks of about ``max_pairs`` pairs each
+
+    A book's product row visits every loan of every one of its borrowers.
+    A block closes after the book that reaches the limit.
+    """
+    pairs = matrix.T.dot(np.diff(matrix.indptr).astype(np.int64))[book_ids]
+    windows = (np.cumsum(pairs) - pairs) // max_pairs
+    return np.split(book_ids, np.flatnonzero(np.diff(windows)) + 1)
+
+def top_related(matrix, by_book, book_ids, k):
+    """related_books rows for ``book_ids``: each book's k most co-borrowed books
+
+    ``by_book`` is ``matrix`` in CSC form. Returns tuples of (book_id,
+    position, related_id, borrowers, share).
+    """
+    columns = by_book[:, book_ids]
+    counts = (columns.T @ matrix).tocoo()
+    keep = counts.col != book_ids[counts.row]
+    rows, related, shared = counts.row[keep], counts.col[keep], counts.data[keep]
+
+    # Most shared borrowers first, ties by id, then the first k of each row
+    order = np.lexsort((related, -shared, rows))
+    rows, related, shared = rows[order], related[order], shared[order]
+    position = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    top = position < k
+    rows, related, shared, position = rows[top], related[top], shared[top], position[top]
+
+    borrowers = np.diff(columns.indptr)
+    return list(zip(
+        book_ids[rows].tolist(),
+        (position + 1).tolist(),
+        related.tolist(),
+        shared.tolist(),
+        (shared / borrowers[rows]).tolist()
+    ))
+
+def _write(conn, book_ids, rows):
+    """Replace the related_books rows of ``book_ids`` in one transaction"""
+    def write(conn):
+        for chunk in _chunks(book_ids):
+            conn.execute(
+                f"DELETE FROM related_books WHERE book_id IN ({', '.join('?' for _ in chunk)})", chunk
+            )
+        conn.executemany(
+            'INSERT INTO related_books (book_id, position, related_id, borrowers, share) VALUES (?, ?, ?, ?, ?)',
+            rows
+        )
+    database.run_immediate(conn, write)
+
+def _update(conn, matrix, book_ids, k, max_pairs):
+    """Recompute and store the rows of ``book_ids``; returns how many there were"""
+    by_book = matrix.tocsc()
+    for block in _blocks(matrix, np.asarray(book_ids, np.int64), max_pairs):
+        if len(block):
+            _write(conn, block.tolist(), top_related(matrix, by_book, block, k))
+    return len(book_ids)
+
+def _save_position(conn, last_loan_id):
+    def save(conn):
+        conn.execute('''
+            INSERT INTO scheduler_state (name, last_loan_id, last_run)
+            VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                last_loan_id = excluded.last_loan_id,
+                last_run = excluded.last_run
+        ''', (JOB_NAME, last_loan_id, datetime.now()))
+    database.run_immediate(conn, save)
+
+def build(conn, k=Config.RELATED_TOP_K, max_pairs=Config.RELATED_BLOCK_PAIRS, history=None):
+    """Recompute every book's row from the whole loan history
+
+    Reloads ``history`` (a LoanHistory) when given. Returns the number of
+    books with related rows.
+    """
+    _require_scipy()
+    history = history or LoanHistory()
+    history.load(conn)
+    matrix = history.matrix
+    count = _update(conn, matrix, np.flatnonzero(matrix.getnnz(axis=0)), k, max_pairs)
+    _save_position(conn, history.last_loan_id)
+    return count
+
+def refresh(conn, k=Config.RELATED_TOP_K, max_pairs=Config.RELATED_BLOCK_PAIRS, history=None):
+    """Recompute the rows that loans since the last build can change
+
+    ``history`` (a LoanHistory) is brought up to date, or loaded when
+    not given. Runs a full build() when there has been none. Returns the
+    number of books recomputed.
+    """
+    _require_scipy()
+    state = conn.execute('SELECT last_loan_id FROM scheduler_state WHERE name = ?', (JOB_NAME,)).fetchone()
+    if state is None:
+        return build(conn, k, max_pairs, history)
+
+    history = history or LoanHistory()
+    history.update(conn)
+    if history.last_loan_id <= state['last_loan_id']:
+        return 0
+    users = [row['user_id'] for row in conn.execute(
+        'SELECT DISTINCT user_id FROM loans WHERE id > ? AND id <= ?', (state['last_loan_id'], history.last_loan_id)
+    ).fetchall()]
+    conn.commit()
+
+    matrix = history.matrix
+    count = _update(conn, matrix, np.flatnonzero(matrix[users].getnnz(axis=0)), k, max_pairs)
+    _save_position(conn, history.last_loan_id)
+    return count
+
+class RelatedBooksRefresher:
+    """Runs refresh() every ``interval`` seconds on a daemon thread
+
+    Keeps the loan history in memory between runs, so only the first run
+    reads the whole loans table.
+    """
+
+    def __init__(self, interval=Config.RELATED_REFRESH_INTERVAL_SECONDS, full=False):
+        self.interval = interval
+        self.full = full
+        self.history = LoanHistory()
+        self.runs = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='related-books', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        conn = database.get_db()
+        try:
+            count = build(conn, history=self.history) if self.full else refresh(conn, history=self.history)
+        finally:
+            database.release_db(conn)
+        self.runs += 1
+        return count
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                count = self.run_once()
+                if count:
+                    print(f"[Related] Recomputed related books for {count} books")
+            except Exception:
+                print("[Related] Refresh failed")
+                traceback.print_exc()
+            self._stop.wait(self.interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the related-books table from the loan history')
+    parser.add_argument('--full', action='store_true', help='rebuild from the whole history')
+    args = parser.parse_args()
+
+    database.init_db()
+    print(f"Recomputed related books for {RelatedBooksRefresher(full=args.full).run_once()} books")
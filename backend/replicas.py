@@ -0,0 +1,207 @@
+"""Read replicas for read-only handlers
+
+With DATABASE_REPLICA_URLS set, get_read_db() hands read-only handlers a
+connection from one of the replica pools, chosen round-robin. Writes keep
+going to the primary through database.get_db(). A user who has just
+written (mark_written()) is sent to the primary for the next
+REPLICA_STICKY_SECONDS, so they read their own borrow or return even
+while the replicas lag. Stickiness is per process, like the caches.
+
+Replicas can be real PostgreSQL standbys or, with SQLite, snapshot copies
+of the primary file that SnapshotRefresher rewrites every
+REPLICA_SNAPSHOT_INTERVAL_SECONDS using SQLite's online backup.
+
+Usage:
+    python replicas.py      # refresh the SQLite snapshots once and exit
+"""
+import itertools
+import sqlite3
+import threading
+import time
+import traceback
+from flask import g, has_app_context
+from config import Config
+import database
+
+# Replica database URLs, in the same forms as database.DATABASE
+REPLICAS = Config.DATABASE_REPLICA_URLS
+
+class ReplicaSet:
+    """Connection pools for the replicas plus the recent writers"""
+
+    def __init__(self, urls, sticky_seconds=Config.REPLICA_STICKY_SECONDS):
+        self.pools = [database.ConnectionPool(url) for url in urls]
+        self.sticky_seconds = sticky_seconds
+        self._next = itertools.count()
+        self._writers = {}
+        self._lock = threading.Lock()
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    def mark_written(self, key):
+        """Send ``key``'s reads to the primary for the next sticky_seconds"""
+        now = time.monotonic()
+        with self._lock:
+            self._writers[key] = now + self.sticky_seconds
+            if len(self._writers) > 1024:
+                self._writers = {
+                    writer: until for writer, until in self._writers.items() if until > now
+                }
+
+    def is_sticky(self, key):
+        with self._lock:
+            until = self._writers.get(key)
+            if until is not None and until <= time.monotonic():
+                del self._writers[key]
+                until = None
+            return until is not None
+
+    def choose(self, key=None):
+        """The next replica pool, or None when ``key`` must read the primary"""
+        sticky = key is not None and self.is_sticky(key)
+        with self._lock:
+            if not self.pools or sticky:
+                self.primary_reads += 1
+                return None
+            self.replica_reads += 1
+            return self.pools[next(self._next) % len(self.pools)]
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+    def stats(self):
+        return {
+            'replicas': [pool.stats() for pool in self.pools],
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads,
+            'sticky_users': len(self._writers)
+        }
+
+_replicas = None
+_replicas_lock = threading.Lock()
+
+def get_replicas():
+    """Get the process-wide ReplicaSet, creating it on first use"""
+    global _replicas
+    if _replicas is None:
+        with _replicas_lock:
+            if _replicas is None:
+                _replicas = ReplicaSet(REPLICAS)
+    return _replicas
+
+def close_replicas():
+    """Close the replica pools so the next read opens fresh connections"""
+    global _replicas
+    with _replicas_lock:
+        if _replicas is not None:
+            _replicas.close()
+            _replicas = None
+
+def _key(user_id):
+    return None if user_id is None else str(user_id)
+
+def mark_written(user_id):
+    """Record that ``user_id`` just wrote, for read-your-writes"""
+    if REPLICAS:
+        get_replicas().mark_written(_key(user_id))
+
+def is_sticky(user_id):
+    """True while ``user_id``'s reads go to the primary after a write"""
+    return bool(REPLICAS) and get_replicas().is_sticky(_key(user_id))
+
+def get_read_db(user_id=None):
+    """Get a connection for a read-only handler
+
+    A replica connection, held for the rest of the app context, unless
+    there are no replicas, ``user_id`` wrote recently, or the context has
+    already checked out the primary. Outside an app context this is
+    database.get_db().
+    """
+    if not REPLICAS or not has_app_context():
+        return database.get_db()
+    if 'read_db' in g:
+        return g.read_db
+    if 'db' in g:
+        return g.db
+
+    pool = get_replicas().choose(_key(user_id))
+    if pool is None:
+        return database.get_db()
+    g.read_db = pool.acquire()
+    g.read_pool = pool
+    return g.read_db
+
+def close_read_db(exception=None):
+    """Teardown handler: give the context's replica connection back"""
+    conn = g.pop('read_db', None)
+    if conn is not None:
+        g.pop('read_pool').release(conn)
+
+def init_app(app):
+    app.teardown_appcontext(close_read_db)
+
+# SQLite snapshot replicas
+def snapshot(source, target):
+    """Copy the SQLite database at ``source`` over ``target`` consistently
+
+    Uses the online backup API in a single step. The primary is in WAL
+    mode, so its writers are not blocked while it is read. Readers of
+    ``target`` see either the old snapshot or the new one.
+    """
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+def snapshot_targets():
+    """(primary path, [replica paths]) when all of them are SQLite files"""
+    primary, path = database.parse_database_url(database.DATABASE)
+    targets = [database.parse_database_url(url) for url in REPLICAS]
+    if primary != 'sqlite' or any(name != 'sqlite' for name, _ in targets):
+        return None, []
+    return path, [target for _, target in targets]
+
+class SnapshotRefresher:
+    """Rewrites the SQLite replicas from the primary every ``interval``
+    seconds on a daemon thread"""
+
+    def __init__(self, interval=Config.REPLICA_SNAPSHOT_INTERVAL_SECONDS):
+        self.interval = interval
+        self.runs = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.run_once()
+            self._thread = threading.Thread(target=self._run, name='replica-snapshots', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        """Refresh every replica; returns how many were written"""
+        primary, targets = snapshot_targets()
+        for target in targets:
+            snapshot(primary, target)
+        self.runs += 1
+        return len(targets)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                print("[Replicas] Snapshot refresh failed")
+                traceback.print_exc()
+
+if __name__ == '__main__':
+    print(f"Refreshed {SnapshotRefresher().run_once()} replica snapshots")
@@ -0,0 +1,440 @@
+"""Queries behind the API handlers in app.py
+
+Every function takes a pooled connection from database.get_db() and
+leaves committing to the caller, like circulation.py. SQL is written
+once where SQLite and PostgreSQL agree (qmark placeholders are
+translated by postgres.py, and both support row values, partial indexes,
+RETURNING and ON CONFLICT); where they do not (full-text search,
+case-insensitive LIKE) the query is chosen by database.dialect().
+"""
+import re
+from database import dialect
+from pagination import select_list, keyset_clause, order_clause, limit_clause
+
+BOOK_COLUMNS = {
+    name: f'b.{name}'
+    for name in ['id', 'isbn', 'title', 'author', 'category', 'total_copies',
+                 'available_copies', 'description', 'created_at']
+}
+BOOK_KEY = ['title', 'id']
+BOOK_SEARCH_KEY = ['rank', 'id']
+
+# Relevance, lowest first, so the keyset order is ascending on both
+# backends: bm25 over books_fts on SQLite, ts_rank over books.search_vector
+# on PostgreSQL (as float8, since a real does not survive the round trip
+# through the cursor token exactly)
+BOOK_SEARCH_COLUMNS = {
+    'sqlite': dict(BOOK_COLUMNS, rank='bm25(books_fts, 10.0, 5.0)'),
+    'postgresql': dict(BOOK_COLUMNS, rank='-ts_rank(b.search_vector, query)::float8')
+}
+
+LOAN_COLUMNS = {
+    'id': 'l.id',
+    'user_id': 'l.user_id',
+    'book_id': 'l.book_id',
+    'borrow_date': 'l.borrow_date',
+    'due_date': 'l.due_date',
+    'return_date': 'l.return_date',
+    'status': 'l.status',
+    'overdue_at': 'l.overdue_at',
+    'title': 'b.title',
+    'author': 'b.author'
+}
+ADMIN_LOAN_COLUMNS = dict(LOAN_COLUMNS, email='u.email', full_name='u.full_name')
+LOAN_KEY = ['borrow_date', 'id']
+
+USER_COLUMNS = {name: f'u.{name}' for name in ['id', 'email', 'full_name', 'role', 'created_at']}
+USER_KEY = ['created_at', 'id']
+
+BOOK_FACETS = ['category', 'availability', 'author']
+
+BOOK_UPDATE_FIELDS = ['isbn', 'title', 'author', 'category', 'total_copies', 'available_copies', 'description']
+
+ISBN_PATTERN = re.compile(r'^[0-9][0-9-]{8,16}[0-9Xx]$')
+
+def execute_streaming(conn, sql, params):
+    """Execute a query whose rows will be streamed out with fetchmany()
+
+    SQLite steps through rows as they are fetched; on PostgreSQL a
+    server-side cursor keeps the result off the client until then.
+    """
+    if dialect(conn) == 'postgresql':
+        return conn.server_cursor().execute(sql, params)
+    return conn.execute(sql, params)
+
+def fts_match_expression(search, dialect_name='sqlite'):
+    """Turn free-text search input into a prefix query: an FTS5 MATCH
+    expression on SQLite, a tsquery on PostgreSQL"""
+    terms = re.findall(r'\w+', search)
+    if dialect_name == 'postgresql':
+        return ' & '.join(f'{term}:*' for term in terms)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+# Users
+def find_user_by_email(conn, email):
+    return conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+
+def create_user(conn, email, password, full_name, role):
+    """Insert a user and return the new id"""
+    return conn.execute(
+        'INSERT INTO users (email, password, full_name, role) VALUES (?, ?, ?, ?) RETURNING id',
+        (email, password, full_name, role)
+    ).fetchone()['id']
+
+def replace_password(conn, user_id, new_hash, old_hash):
+    """Swap in a rehashed password unless it changed in the meantime"""
+    conn.execute(
+        'UPDATE users SET password = ? WHERE id = ? AND password = ?',
+        (new_hash, user_id, old_hash)
+    )
+
+def get_user_profile(conn, user_id):
+    return conn.execute('SELECT id, email, full_name, role FROM users WHERE id = ?', (user_id,)).fetchone()
+
+def user_exists(conn, user_id):
+    return conn.execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone() is not None
+
+def set_user_role(conn, user_id, role):
+    conn.execute('UPDATE users SET role = ? WHERE id = ?', (role, user_id))
+
+def list_users(conn, fields, after, limit):
+    """Cursor over users, newest first; raises ValueError for a bad cursor"""
+    keyset, keyset_params = keyset_clause(USER_COLUMNS, USER_KEY, after, descending=True)
+    limit_sql, limit_params = limit_clause(limit)
+
+    return execute_streaming(
+        conn,
+        f'''
+        SELECT {select_list(USER_COLUMNS, fields, USER_KEY)}
+        FROM users u
+        WHERE 1=1{keyset}
+        {order_clause(USER_COLUMNS, USER_KEY, descending=True)}{limit_sql}
+        ''',
+        keyset_params + limit_params
+    )
+
+# Books
+def _search_source(conn, search, search_mode):
+    """FROM and WHERE clauses, and their params, selecting the books that
+    match ``search``; None when nothing can match"""
+    name = dialect(conn)
+    if search_mode == 'fts':
+        match = fts_match_expression(search, name)
+        if not match:
+            return None
+        if name == 'postgresql':
+            return "books b CROSS JOIN to_tsquery('simple', ?) AS query", 'b.search_vector @@ query', [match]
+        return 'books_fts JOIN books b ON b.id = books_fts.rowid', 'books_fts MATCH ?', [match]
+
+    # SQLite's LIKE ignores ASCII case; PostgreSQL needs ILIKE for that
+    like = 'ILIKE' if name == 'postgresql' else 'LIKE'
+    return 'books b', f'(b.title {like} ? OR b.author {like} ? OR b.isbn {like} ?)', [f'%{search}%'] * 3
+
+def _filter_clause(category, available_only):
+    filters = ''
+    params = []
+    if category:
+        filters += ' AND b.category = ?'
+        params.append(category)
+    if available_only:
+        filters += ' AND b.available_copies > 0'
+    return filters, params
+
+def search_books(conn, search, search_mode, category, available_only, fields, after, limit):
+    """Run a catalogue query
+
+    Returns (rows, key_fields) for page_response(). Raises ValueError for
+    a bad cursor.
+    """
+    filters, filter_params = _filter_clause(category, available_only)
+
+    if search and search_mode == 'fts':
+        # Exact ISBN lookup uses the unique index on books.isbn
+        if ISBN_PATTERN.match(search) and after is None:
+            books = conn.execute(
+                f'SELECT {select_list(BOOK_COLUMNS, fields, BOOK_KEY)} FROM books b WHERE b.isbn = ?{filters}',
+                [search] + filter_params
+            ).fetchall()
+            if books:
+                return books, BOOK_KEY
+
+        source = _search_source(conn, search, search_mode)
+        if source is None:
+            return [], BOOK_SEARCH_KEY
+        tables, match, match_params = source
+
+        columns = BOOK_SEARCH_COLUMNS[dialect(conn)]
+        keyset, keyset_params = keyset_clause(columns, BOOK_SEARCH_KEY, after)
+        limit_sql, limit_params = limit_clause(limit)
+
+        return conn.execute(
+            f'''
+            SELECT {select_list(columns, fields, BOOK_SEARCH_KEY)}
+            FROM {tables}
+            WHERE {match}{filters}{keyset}
+            {order_clause(columns, BOOK_SEARCH_KEY)}{limit_sql}
+            ''',
+            match_params + filter_params + keyset_params + limit_params
+        ).fetchall(), BOOK_SEARCH_KEY
+
+    tables, match, params = _search_source(conn, search, search_mode) if search else ('books b', '1=1', [])
+    keyset, keyset_params = keyset_clause(BOOK_COLUMNS, BOOK_KEY, after)
+    limit_sql, limit_params = limit_clause(limit)
+
+    query = (
+        f'SELECT {select_list(BOOK_COLUMNS, fields, BOOK_KEY)} FROM {tables} WHERE {match}'
+        + filters + keyset + order_clause(BOOK_COLUMNS, BOOK_KEY) + limit_sql
+    )
+    return conn.execute(query, params + filter_params + keyset_params + limit_params).fetchall(), BOOK_KEY
+
+def _ranked(counts, limit):
+    """[{'value', 'count'}] for the ``limit`` largest counts, ties by value"""
+    ranked = sorted(((value, count) for value, count in counts.items() if count), key=lambda item: (-item[1], item[0]))
+    return [{'value': value, 'count': count} for value, count in ranked[:limit]]
+
+def _availability(books, available):
+    return {'available': available, 'unavailable': books - available}
+
+def book_facets(conn, search, search_mode, category, available_only, names, limit):
+    """Category, availability and author counts for a catalogue query
+
+    Each facet ignores its own filter, so the category counts stay the
+    same when a category is chosen. Category and author facets hold the
+    ``limit`` largest counts. Searches count their matches in one grouped
+    pass; browsing without a search reads facet_counts, except for the
+    authors within one category, which are one pass over that category.
+    """
+    if search:
+        return _search_facets(conn, search, search_mode, category, available_only, names, limit)
+
+    column = 'available' if available_only else 'books'
+    facets = {}
+    if 'category' in names:
+        rows = conn.execute(f'''
+            SELECT value, {column} AS count FROM facet_counts
+            WHERE facet = 'category' AND {column} > 0
+            ORDER BY {column} DESC, value LIMIT ?
+        ''', (limit,)).fetchall()
+        facets['category'] = [{'value': row['value'], 'count': row['count']} for row in rows]
+    if 'availability' in names:
+        row = conn.execute(
+            'SELECT books, available FROM facet_counts WHERE facet = ? AND value = ?',
+            ('category', category) if category else ('all', '')
+        ).fetchone()
+        facets['availability'] = _availability(row['books'], row['available']) if row else _availability(0, 0)
+    if 'author' in names:
+        if category:
+            filters, params = _filter_clause(category, available_only)
+            rows = conn.execute(f'''
+                SELECT b.author AS value, COUNT(*) AS count FROM books b
+                WHERE b.author != ''{filters}
+                GROUP BY b.author
+                ORDER BY count DESC, b.author LIMIT ?
+            ''', params + [limit]).fetchall()
+        else:
+            rows = conn.execute(f'''
+                SELECT value, {column} AS count FROM facet_counts
+                WHERE facet = 'author' AND {column} > 0
+                ORDER BY {column} DESC, value LIMIT ?
+            ''', (limit,)).fetchall()
+        facets['author'] = [{'value': row['value'], 'count': row['count']} for row in rows]
+    return facets
+
+def book_categories(conn):
+    """Every category with its book count, by name; one facet_counts row
+    per category, so this does not read the books"""
+    return conn.execute('''
+        SELECT value, books AS count FROM facet_counts
+        WHERE facet = 'category' AND books > 0
+        ORDER BY value
+    ''').fetchall()
+
+def _search_facets(conn, search, search_mode, category, available_only, names, limit):
+    groups = []
+    isbn = ISBN_PATTERN.match(search) and search_mode == 'fts'
+    if isbn and book_isbn_exists(conn, search):
+        source = 'books b', 'b.isbn = ?', [search]
+    else:
+        source = _search_source(conn, search, search_mode)
+    if source is not None:
+        tables, match, params = source
+        groups = conn.execute(f'''
+            SELECT b.category AS category, b.author AS author,
+                   CASE WHEN b.available_copies > 0 THEN 1 ELSE 0 END AS available, COUNT(*) AS books
+            FROM {tables}
+            WHERE {match}
+            GROUP BY b.category, b.author, CASE WHEN b.available_copies > 0 THEN 1 ELSE 0 END
+        ''', params).fetchall()
+
+    categories, authors = {}, {}
+    books = available = 0
+    for group in groups:
+        in_category = not category or group['category'] == category
+        if group['category'] and (group['available'] or not available_only):
+            categories[group['category']] = categories.get(group['category'], 0) + group['books']
+        if in_category:
+            books += group['books']
+            available += group['books'] if group['available'] else 0
+            if group['author'] and (group['available'] or not available_only):
+                authors[group['author']] = authors.get(group['author'], 0) + group['books']
+
+    facets = {}
+    if 'category' in names:
+        facets['category'] = _ranked(categories, limit)
+    if 'availability' in names:
+        facets['availability'] = _availability(books, available)
+    if 'author' in names:
+        facets['author'] = _ranked(authors, limit)
+    return facets
+
+def get_book(conn, book_id):
+    return conn.execute(
+        f'SELECT {select_list(BOOK_COLUMNS, list(BOOK_COLUMNS), [])} FROM books b WHERE b.id = ?', (book_id,)
+    ).fetchone()
+
+def book_exists(conn, book_id):
+    return conn.execute('SELECT 1 FROM books WHERE id = ?', (book_id,)).fetchone() is not None
+
+def book_isbn_exists(conn, isbn):
+    return conn.execute('SELECT 1 FROM books WHERE isbn = ?', (isbn,)).fetchone() is not None
+
+def insert_book(conn, data):
+    """Insert a book from request data and return the new id"""
+    return conn.execute(
+        '''INSERT INTO books (isbn, title, author, category, total_copies, available_copies, description)
+           VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id''',
+        (
+            data.get('isbn'),
+            data['title'],
+            data['author'],
+            data.get('category'),
+            data.get('total_copies', 1),
+            data.get('available_copies', 1),
+            data.get('description')
+        )
+    ).fetchone()['id']
+
+def update_book(conn, book_id, changes):
+    """Set the BOOK_UPDATE_FIELDS present in ``changes``
+
+    Returns False when there was nothing to update.
+    """
+    fields = [field for field in BOOK_UPDATE_FIELDS if field in changes]
+    if not fields:
+        return False
+
+    conn.execute(
+        f"UPDATE books SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+        [changes[field] for field in fields] + [book_id]
+    )
+    return True
+
+def delete_book(conn, book_id):
+    conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
+
+def related_books(conn, book_id, limit):
+    """The first ``limit`` precomputed related books (see related.py)"""
+    return conn.execute('''
+        SELECT b.id, b.title, b.author, b.category, b.available_copies, r.borrowers, r.share
+        FROM related_books r
+        JOIN books b ON b.id = r.related_id
+        WHERE r.book_id = ? AND r.position <= ?
+        ORDER BY r.position
+    ''', (book_id, limit)).fetchall()
+
+def table_version(conn, name):
+    """(version, updated_at) of a table, bumped by triggers on every change"""
+    row = conn.execute('SELECT version, updated_at FROM table_versions WHERE name = ?', (name,)).fetchone()
+    return row['version'], row['updated_at']
+
+# Loans
+def list_loans(conn, user_id, fields, after, limit):
+    """Cursor over loans, newest first
+
+    All loans (with borrower details) when ``user_id`` is None, otherwise
+    that user's. Raises ValueError for a bad cursor.
+    """
+    columns = ADMIN_LOAN_COLUMNS if user_id is None else LOAN_COLUMNS
+    keyset, keyset_params = keyset_clause(columns, LOAN_KEY, after, descending=True)
+    limit_sql, limit_params = limit_clause(limit)
+    order = order_clause(columns, LOAN_KEY, descending=True)
+
+    if user_id is None:
+        return execute_streaming(conn, f'''
+            SELECT {select_list(columns, fields, LOAN_KEY)}
+            FROM loans l
+            JOIN books b ON l.book_id = b.id
+            JOIN users u ON l.user_id = u.id
+            WHERE 1=1{keyset}
+            {order}{limit_sql}
+        ''', keyset_params + limit_params)
+
+    return execute_streaming(conn, f'''
+        SELECT {select_list(columns, fields, LOAN_KEY)}
+        FROM loans l
+        JOIN books b ON l.book_id = b.id
+        WHERE l.user_id = ?{keyset}
+        {order}{limit_sql}
+    ''', [user_id] + keyset_params + limit_params)
+
+def overdue_summary(conn, user_id=None):
+    """Per-user overdue counts (one user's when ``user_id`` is given) and
+    the time of the last scheduler run"""
+    query = '''
+        SELECT s.user_id, u.email, u.full_name, s.overdue_count, s.oldest_due_date, s.updated_at
+        FROM overdue_summary s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.overdue_count > 0
+    '''
+    params = []
+
+    if user_id is not None:
+        query += ' AND s.user_id = ?'
+        params.append(user_id)
+
+    summary = conn.execute(query + ' ORDER BY s.overdue_count DESC, s.user_id', params).fetchall()
+    state = conn.execute("SELECT last_run FROM scheduler_state WHERE name = 'overdue'").fetchone()
+    return summary, state['last_run'] if state else None
+
+# Statistics
+def library_stats(conn):
+    """Counters kept current by triggers, see library_stats in database.py"""
+    return conn.execute(
+        'SELECT total_books, available_books, total_users, active_loans FROM library_stats WHERE id = 1'
+    ).fetchone()
+
+def loan_rollups(conn, interval, start, end):
+    """Rollup rows of ``interval`` for the periods from ``start`` up to ``end``"""
+    return conn.execute('''
+        SELECT period, borrows, returns, borrowers FROM loan_rollups
+        WHERE granularity = ? AND period >= ? AND period < ?
+        ORDER BY period
+    ''', (interval, start, end)).fetchall()
+
+def loan_rollup(conn, interval, period):
+    return conn.execute(
+        'SELECT borrows, returns, borrowers FROM loan_rollups WHERE granularity = ? AND period = ?',
+        (interval, period)
+    ).fetchone()
+
+def top_books(conn, interval, period, limit):
+    """The most borrowed books of a period; deleted books keep their id"""
+    return conn.execute('''
+        SELECT r.book_id AS id, b.title, b.author, r.borrows
+        FROM book_rollups r
+        LEFT JOIN books b ON b.id = r.book_id
+        WHERE r.granularity = ? AND r.period = ?
+        ORDER BY r.borrows DESC, r.book_id
+        LIMIT ?
+    ''', (interval, period, limit)).fetchall()
+
+def top_borrowers(conn, interval, period, limit):
+    """The users with the most loans in a period"""
+    return conn.execute('''
+        SELECT r.user_id AS id, u.full_name, u.email, r.borrows
+        FROM borrower_rollups r
+        LEFT JOIN users u ON u.id = r.user_id
+        WHERE r.granularity = ? AND r.period = ?
+        ORDER BY r.borrows DESC, r.user_id
+        LIMIT ?
+    ''', (interval, period, limit)).fetchall()
@@ -0,0 +1,182 @@
+"""Background detection of overdue loans
+
+Overdue loans keep status 'active' (so the copy counts and the one active
+loan per book rule are unaffected) and get ``overdue_at`` set. Each run
+only looks at loans that fell due since the previous run: the position
+reached is kept in scheduler_state and the window is read through
+idx_loans_status_due_date in batches, one short transaction per batch.
+overdue_summary keeps a per-user count for reports, and each marked loan
+gets a ``loan.overdue`` event.
+
+The same pass expires ready holds that were not collected within
+HOLD_PICKUP_DAYS, through idx_holds_ready_date; each expired hold's copy
+goes to the next waiting hold or back on the shelf.
+
+Usage:
+    python scheduler.py      # run one pass and exit (e.g. from cron)
+"""
+import threading
+import traceback
+from datetime import timedelta
+import circulation
+import database
+import events
+from config import Config
+from timeseries import utcnow
+
+JOB_NAME = 'overdue'
+
+# Recompute one user's overdue_summary row (the return trigger in
+# database.py does the same for the borrower of a returned overdue loan)
+REFRESH_SUMMARY = '''
+    INSERT INTO overdue_summary (user_id, overdue_count, oldest_due_date, updated_at)
+    SELECT ?, COUNT(*), MIN(due_date), CURRENT_TIMESTAMP
+    FROM loans
+    WHERE user_id = ? AND status = 'active' AND overdue_at IS NOT NULL
+    ON CONFLICT (user_id) DO UPDATE SET
+        overdue_count = excluded.overdue_count,
+        oldest_due_date = excluded.oldest_due_date,
+        updated_at = excluded.updated_at
+'''
+
+# Start of the first window; sorts before any due date on both backends
+START = '0001-01-01 00:00:00'
+
+def _mark_batch(conn, now, batch_size):
+    """Mark the next batch of newly due loans; returns how many were marked"""
+    state = conn.execute(
+        'SELECT last_due_date, last_loan_id FROM scheduler_state WHERE name = ?', (JOB_NAME,)
+    ).fetchone()
+    last_due_date = state['last_due_date'] if state else START
+    last_loan_id = state['last_loan_id'] if state else 0
+
+    loans = conn.execute('''
+        SELECT id, user_id, due_date, overdue_at FROM loans
+        WHERE status = 'active' AND (due_date, id) > (?, ?) AND due_date <= ?
+        ORDER BY due_date, id
+        LIMIT ?
+    ''', (last_due_date, last_loan_id, now, batch_size)).fetchall()
+
+    cursor = conn.executemany(
+        'UPDATE loans SET overdue_at = ? WHERE id = ? AND overdue_at IS NULL',
+        [(now, loan['id']) for loan in loans]
+    )
+    marked = max(cursor.rowcount, 0)
+    events.append(conn, None, [
+        ('loan.overdue', loan['id'], {'user_id': loan['user_id'], 'due_date': loan['due_date']})
+        for loan in loans if loan['overdue_at'] is None
+    ])
+    for user_id in {loan['user_id'] for loan in loans}:
+        conn.execute(REFRESH_SUMMARY, (user_id, user_id))
+
+    if len(loans) == batch_size:
+        position = (loans[-1]['due_date'], loans[-1]['id'])
+    else:
+        # Window exhausted; the next run starts from now
+        position = (now, 0)
+
+    conn.execute('''
+        INSERT INTO scheduler_state (name, last_due_date, last_loan_id, last_run)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET
+            last_due_date = excluded.last_due_date,
+            last_loan_id = excluded.last_loan_id,
+            last_run = excluded.last_run
+    ''', (JOB_NAME, position[0], position[1], now))
+
+    return marked, len(loans) == batch_size
+
+def mark_overdue(conn, batch_size=Config.OVERDUE_BATCH_SIZE, now=None):
+    """Mark every loan that fell due since the last run; returns the count"""
+    now = now or utcnow()
+    marked = 0
+    more = True
+    while more:
+        count, more = database.run_immediate(conn, lambda conn: _mark_batch(conn, now, batch_size))
+        marked += count
+    return marked
+
+def _expire_batch(conn, cutoff, batch_size):
+    """Expire the next batch of holds ready since before ``cutoff``"""
+    holds = conn.execute('''
+        SELECT id, user_id, book_id FROM holds
+        WHERE status = 'ready' AND ready_date <= ?
+        ORDER BY ready_date, id
+        LIMIT ?
+    ''', (cutoff, batch_size)).fetchall()
+
+    # Book rows are locked in id order, as a batch checkout locks them
+    expired, ready = [], []
+    for hold in sorted(holds, key=lambda hold: hold['book_id']):
+        body = circulation.expire_hold(conn, hold['id'], hold['book_id'])
+        if body is not None:
+            expired.append(('hold.expired', hold['id'], {'user_id': hold['user_id'], 'book_id': hold['book_id']}))
+            ready += events.copy_released(body)
+    events.append(conn, None, expired + ready)
+    return len(expired), len(holds) == batch_size
+
+def expire_holds(conn, batch_size=Config.OVERDUE_BATCH_SIZE, now=None):
+    """Expire every ready hold older than HOLD_PICKUP_DAYS; returns the count"""
+    cutoff = (now or utcnow()) - timedelta(days=Config.HOLD_PICKUP_DAYS)
+    expired = 0
+    more = True
+    while more:
+        count, more = database.run_immediate(conn, lambda conn: _expire_batch(conn, cutoff, batch_size))
+        expired += count
+    return expired
+
+class OverdueScheduler:
+    """Runs mark_overdue() and expire_holds() every ``interval`` seconds on a
+    daemon thread"""
+
+    def __init__(self, interval=Config.OVERDUE_INTERVAL_SECONDS, batch_size=Config.OVERDUE_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.runs = 0
+        self.marked = 0
+        self.expired = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='overdue-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        """One pass; returns the number of loans marked overdue"""
+        conn = database.get_db()
+        try:
+            marked = mark_overdue(conn, self.batch_size)
+            expired = expire_holds(conn, self.batch_size)
+        finally:
+            database.release_db(conn)
+        self.runs += 1
+        self.marked += marked
+        self.expired += expired
+        return marked
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                expired = self.expired
+                marked = self.run_once()
+                if marked:
+                    print(f"[Scheduler] Marked {marked} loans overdue")
+                if self.expired > expired:
+                    print(f"[Scheduler] Expired {self.expired - expired} uncollected holds")
+            except Exception:
+                print("[Scheduler] Overdue pass failed")
+                traceback.print_exc()
+            self._stop.wait(self.interval)
+
+if __name__ == '__main__':
+    database.init_db()
+    scheduler = OverdueScheduler()
+    print(f"Marked {scheduler.run_once()} loans overdue, expired {scheduler.expired} holds")
@@ -0,0 +1,189 @@
+"""Production entry point: pre-forked workers with bounded thread pools
+
+The master process runs init_db() once, opens the listening socket and
+forks ``--workers`` processes that accept from it. Each worker handles
+up to ``--threads`` requests at a time; while all its threads are busy
+it stops accepting, so connections wait in the kernel backlog for
+another worker rather than queueing inside a busy one. The background
+jobs (overdue scheduler, related books, replica snapshots) run in one
+extra process, so there is one of each per deployment rather than per
+worker. The master forwards SIGTERM/SIGINT to its children and replaces
+any that die. Without fork() (Windows) it serves from a single process.
+
+Other servers can import the app from here instead:
+    gunicorn --workers 4 --threads 8 serve:application
+    uvicorn --workers 4 serve:asgi_application     # DB work on a bounded executor (asgi.py)
+They do not run init_db(), so run ``python database.py`` once per
+deployment first. Metrics are per process, as are rate limits unless
+RATE_LIMIT_STORAGE names a shared file.
+
+The catalogue and user caches, replica stickiness and the in-memory
+rate limiter live in each process, so one worker is the default. More
+workers are refused while rate limits are kept in memory, where each
+worker would allow the full rate; caches and stickiness are then only
+consistent across workers up to BOOK_CACHE_TTL/USER_CACHE_TTL and
+REPLICA_STICKY_SECONDS.
+
+Usage:
+    python serve.py --host 0.0.0.0 --port 5000 --threads 8
+    RATE_LIMIT_STORAGE=/var/lib/library/ratelimit.db python serve.py --workers 4
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from config import Config
+import database
+import replicas
+from app import app as application, start_background_jobs
+from asgi import WsgiToAsgi
+
+asgi_application = WsgiToAsgi(application)
+
+class RequestHandler(WSGIRequestHandler):
+    # One request per connection, so an idle keep-alive client cannot
+    # hold on to one of a worker's threads
+    protocol_version = 'HTTP/1.0'
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server that handles connections on a bounded thread pool"""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd=None):
+        self._executor = None
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.threads = threads
+        self._slots = threading.BoundedSemaphore(threads)
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        self._executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def run_worker(app, sock, threads):
+    """Serve requests from ``sock`` until SIGTERM or SIGINT"""
+    signal.signal(signal.SIGTERM, _interrupt)
+    signal.signal(signal.SIGINT, _interrupt)
+    host, port = sock.getsockname()[:2]
+    server = PooledWSGIServer(host, port, app, threads, fd=sock.fileno())
+    server.serve_forever()
+
+def run_jobs(app):
+    """Run the background jobs until SIGTERM or SIGINT"""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    jobs = start_background_jobs(app)
+    stop.wait()
+    for job in jobs:
+        job.stop()
+
+def _spawn(target, *args):
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        target(*args)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        os._exit(status)
+
+def check_workers(app, workers):
+    """Refuse several workers while each would keep its own rate limits"""
+    config = app.config
+    if workers > 1 and config['RATE_LIMIT_ENABLED'] and config['RATE_LIMIT_STORAGE'] == 'memory':
+        raise SystemExit(
+            f'{workers} workers would each apply the rate limits separately; set RATE_LIMIT_STORAGE '
+            'to a shared SQLite file (or RATE_LIMIT_ENABLED=false) to run more than one'
+        )
+
+def serve(app, host, port, workers, threads, init=True):
+    check_workers(app, workers)
+    if init:
+        database.init_db()
+    # Children open their own connections; none may be inherited
+    database.close_pool()
+    replicas.close_replicas()
+
+    sock = socket.create_server((host, port), backlog=max(128, workers * threads * 4))
+    sock.set_inheritable(True)
+    print(f"Serving on http://{host}:{sock.getsockname()[1]} with {workers} workers x {threads} threads")
+
+    if not hasattr(os, 'fork'):
+        jobs = start_background_jobs(app)
+        try:
+            run_worker(app, sock, threads)
+        finally:
+            for job in jobs:
+                job.stop()
+        return
+
+    has_jobs = app.config['OVERDUE_SCHEDULER_ENABLED'] or app.config['RELATED_REFRESH_INTERVAL_SECONDS'] > 0 or (
+        replicas.REPLICAS and app.config['REPLICA_SNAPSHOT_INTERVAL_SECONDS'] > 0
+    )
+    children = {_spawn(run_worker, app, sock, threads): 'worker' for _ in range(workers)}
+    if has_jobs:
+        children[_spawn(run_jobs, app)] = 'jobs'
+
+    stopping = []
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(signum)
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        pid, status = os.wait()
+        role = children.pop(pid, None)
+        if role is None or stopping:
+            continue
+        print(f"[Serve] {role} {pid} exited with status {status}; restarting", file=sys.stderr)
+        if role == 'worker':
+            children[_spawn(run_worker, app, sock, threads)] = role
+        else:
+            children[_spawn(run_jobs, app)] = role
+    sock.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the library API with pre-forked workers')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=Config.SERVE_WORKERS, help='worker processes')
+    parser.add_argument('--threads', type=int, default=Config.SERVE_THREADS, help='threads per worker')
+    parser.add_argument('--skip-init-db', action='store_true', help='the database is already initialized')
+    args = parser.parse_args()
+
+    serve(application, args.host, args.port, args.workers, args.threads, init=not args.skip_init_db)
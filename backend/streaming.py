@@ -0,0 +1,74 @@
+"""Streaming list responses for large exports
+
+Rows are read from the cursor with fetchmany() and written out one batch
+at a time as a JSON array, NDJSON or CSV, so memory use does not grow
+with the size of the table and the first bytes go out straight away.
+"""
+import csv
+import io
+import json
+from flask import Response, request, stream_with_context
+from config import Config
+
+FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+def parse_format():
+    """Read the ``format`` argument (json, ndjson or csv)"""
+    name = request.args.get('format', 'json')
+    if name not in FORMATS:
+        raise ValueError(f'Unknown format: {name}')
+    return name
+
+def _batches(cursor, fields, size):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield [{name: row[name] for name in fields} for row in rows]
+
+def _json_array(batches):
+    yield '['
+    separator = ''
+    for batch in batches:
+        yield separator + ','.join(json.dumps(item, separators=(',', ':')) for item in batch)
+        separator = ','
+    yield ']'
+
+def _ndjson(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(item, separators=(',', ':')) + '\n' for item in batch)
+
+def _csv(batches, fields):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def stream_rows(cursor, fields, output_format='json', filename='export', size=None):
+    """Stream the rows of an executed cursor in the given format
+
+    The request context (and with it the pooled connection) stays open
+    until the last row has been sent. NDJSON and CSV are sent as
+    downloads named ``filename``.
+    """
+    batches = _batches(cursor, fields, size or Config.EXPORT_FETCH_SIZE)
+    if output_format == 'csv':
+        body = _csv(batches, fields)
+    elif output_format == 'ndjson':
+        body = _ndjson(batches)
+    else:
+        body = _json_array(batches)
+
+    response = Response(stream_with_context(body), mimetype=FORMATS[output_format])
+    if output_format != 'json':
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}.{output_format}'
+    return response
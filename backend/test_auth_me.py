@@ -0,0 +1,73 @@
+"""GET /api/auth/me: the cached profile lookup and the claims fast path
+
+Repeated calls are served from user_cache until a role change drops the
+entry; with AUTH_ME_FROM_CLAIMS the token answers on its own. Runs
+against each backend in test_storage.backends(). Run with
+``python -m pytest test_auth_me.py`` or ``python test_auth_me.py``.
+"""
+from flask_jwt_extended import create_access_token
+import app as app_module
+import metrics
+from config import Config
+from test_storage import backends, fresh_client, login
+
+def statements():
+    return sum(metrics.SQL_STATEMENTS._values.values())
+
+def cached_profile(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    reader_id = client.post('/api/auth/register', json={
+        'email': 'me@library.com', 'password': 'secret', 'full_name': 'Me Me'
+    }).get_json()['user']['id']
+    reader = login(client, 'me@library.com', 'secret')
+    users = app_module.user_cache
+
+    profile = client.get('/api/auth/me', headers=reader).get_json()
+    assert profile == {'id': reader_id, 'email': 'me@library.com', 'full_name': 'Me Me', 'role': 'student'}
+
+    # The second call is a hit and runs no SQL
+    hits, before = users.hits, statements()
+    assert client.get('/api/auth/me', headers=reader).get_json() == profile
+    assert users.hits == hits + 1
+    assert statements() == before
+
+    # A role change is seen on the next call, with the same token
+    client.put(f'/api/users/{reader_id}', json={'role': 'admin'}, headers=admin)
+    assert client.get('/api/auth/me', headers=reader).get_json()['role'] == 'admin'
+
+    # A token for a user that does not exist
+    with app_module.app.app_context():
+        ghost = {'Authorization': f"Bearer {create_access_token(identity='99999')}"}
+    assert client.get('/api/auth/me', headers=ghost).status_code == 404
+
+def test_me_is_cached_and_invalidated():
+    for url in backends():
+        cached_profile(url)
+
+def test_me_from_claims():
+    fresh_client(backends()[0])
+
+    class ClaimsConfig(Config):
+        AUTH_ME_FROM_CLAIMS = True
+
+    app = app_module.create_app(ClaimsConfig)
+    client = app.test_client()
+    admin = login(client, 'admin@library.com', 'admin123')
+
+    before = statements()
+    profile = client.get('/api/auth/me', headers=admin).get_json()
+    assert profile['email'] == 'admin@library.com' and profile['role'] == 'admin'
+    assert statements() == before
+
+    # Tokens without full_name in their claims fall back to the lookup
+    with app.app_context():
+        old = {'Authorization': 'Bearer ' + create_access_token(
+            identity='1', additional_claims={'email': 'admin@library.com', 'role': 'admin'}
+        )}
+    assert client.get('/api/auth/me', headers=old).get_json() == profile
+
+if __name__ == '__main__':
+    test_me_is_cached_and_invalidated()
+    test_me_from_claims()
+    print('/api/auth/me works')
@@ -0,0 +1,89 @@
+"""Batch borrow and return behind POST /api/loans/batch and
+POST /api/loans/return/batch
+
+Items fail one at a time, ids must be positive JSON integers that fit
+64 bits, and only a batch that changed something sends its users' reads
+to the primary. Runs against each backend in test_storage.backends(). Run with
+``python -m pytest test_batch_loans.py`` or ``python test_batch_loans.py``.
+"""
+import replicas
+from test_storage import backends, fresh_client, login
+
+def batches(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    reader_id = client.post('/api/auth/register', json={
+        'email': 'desk@library.com', 'password': 'secret', 'full_name': 'De Sk'
+    }).get_json()['user']['id']
+    reader = login(client, 'desk@library.com', 'secret')
+
+    def borrow(body, headers=reader):
+        return client.post('/api/loans/batch', json=body, headers=headers)
+
+    def give_back(body, headers=reader):
+        return client.post('/api/loans/return/batch', json=body, headers=headers)
+
+    # Bad items fail on their own; the rest are borrowed
+    response = borrow({'book_ids': [1, '2', True, 1.5, None, 1, 999, 0, 10 ** 30, 3]})
+    assert response.status_code == 200
+    result = response.get_json()
+    assert (result['succeeded'], result['failed']) == (2, 8)
+    assert [(item['book_id'], item['status_code']) for item in result['results']] == [
+        (1, 201), ('2', 400), (True, 400), (1.5, 400), (None, 400), (1, 400), (999, 404), (0, 400), (10 ** 30, 400),
+        (3, 201)
+    ]
+    assert result['results'][8]['error'] == 'Invalid book_id'
+    assert result['results'][1]['error'] == 'Invalid book_id'
+    assert result['results'][5]['error'] == 'You already have this book borrowed'
+    loan_ids = [item['id'] for item in result['results'] if item['status_code'] == 201]
+
+    # user_id must be an integer, and only admins may name another user
+    for body, status in [
+        ({'book_ids': [2], 'user_id': str(reader_id)}, 400),
+        ({'book_ids': [2], 'user_id': True}, 400),
+        ({'book_ids': [2], 'user_id': 2 ** 63}, 400),
+        ({'book_ids': [2], 'user_id': 1}, 403),
+        ({'book_ids': [2], 'user_id': reader_id}, 200),
+        ({'book_ids': []}, 400),
+        ({'book_ids': '2'}, 400),
+        ({'book_ids': list(range(1000))}, 400)
+    ]:
+        assert borrow(body).status_code == status, body
+    assert borrow({'book_ids': [4], 'user_id': 999}, admin).status_code == 404
+    on_behalf = borrow({'book_ids': [4], 'user_id': reader_id}, admin).get_json()
+    assert on_behalf['results'][0]['user_id'] == reader_id
+
+    response = give_back({'loan_ids': loan_ids + [str(loan_ids[0]), False, loan_ids[0], 999, 10 ** 30]})
+    result = response.get_json()
+    assert (result['succeeded'], result['failed']) == (2, 5)
+    assert [item['status_code'] for item in result['results']] == [200, 200, 400, 400, 400, 404, 400]
+    assert result['results'][6]['error'] == 'Invalid loan_id'
+    assert result['results'][2]['error'] == 'Invalid loan_id'
+    assert give_back({'loan_ids': []}).status_code == 400
+
+def test_batch_endpoints():
+    for url in backends():
+        batches(url)
+
+def test_only_batches_that_wrote_mark_the_user():
+    client = fresh_client(backends()[0])
+    admin = login(client, 'admin@library.com', 'admin123')
+    marked = []
+    mark_written = replicas.mark_written
+    replicas.mark_written = marked.append
+    try:
+        client.post('/api/loans/batch', json={'book_ids': [999, 'x']}, headers=admin)
+        client.post('/api/loans/return/batch', json={'loan_ids': [999]}, headers=admin)
+        assert marked == []
+        loan = client.post('/api/loans/batch', json={'book_ids': [1]}, headers=admin).get_json()
+        assert marked
+        marked.clear()
+        client.post('/api/loans/return/batch', json={'loan_ids': [loan['results'][0]['id']]}, headers=admin)
+        assert marked
+    finally:
+        replicas.mark_written = mark_written
+
+if __name__ == '__main__':
+    test_batch_endpoints()
+    test_only_batches_that_wrote_mark_the_user()
+    print('Batch loans work')
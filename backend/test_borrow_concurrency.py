@@ -0,0 +1,129 @@
+"""Multi-threaded stress test for the borrow and return paths
+
+Hammers POST /api/loans and POST /api/loans/<id>/return from many threads
+and checks that the copy counts and the one-active-loan-per-book rule
+still hold. Run with ``python -m pytest test_borrow_concurrency.py`` or
+``python test_borrow_concurrency.py``; set TEST_DATABASE_URL to run it
+against PostgreSQL (see test_storage.py).
+"""
+import random
+import threading
+import database
+from test_storage import use_database
+
+THREADS = 16
+BORROWS_PER_THREAD = 150
+USERS = 40
+BOOKS = 5
+COPIES = 12
+
+def fresh_app():
+    """Import the app against a fresh database"""
+    from app import app
+    use_database()
+    return app
+
+def seed(app):
+    """Create books and users; returns (book_ids, auth headers per user)"""
+    from flask_jwt_extended import create_access_token
+
+    conn = database.get_db()
+    try:
+        book_ids = []
+        for i in range(BOOKS):
+            book_ids.append(conn.execute(
+                'INSERT INTO books (isbn, title, author, total_copies, available_copies) '
+                'VALUES (?, ?, ?, ?, ?) RETURNING id',
+                (f'stress-{i}', f'Stress Book {i}', 'Load Tester', COPIES, COPIES)
+            ).fetchone()['id'])
+
+        headers = []
+        for i in range(USERS):
+            user_id = conn.execute(
+                'INSERT INTO users (email, password, full_name) VALUES (?, ?, ?) RETURNING id',
+                (f'stress{i}@library.com', 'x', f'Stress User {i}')
+            ).fetchone()['id']
+            with app.app_context():
+                token = create_access_token(
+                    identity=str(user_id),
+                    additional_claims={'email': f'stress{i}@library.com', 'role': 'student'}
+                )
+            headers.append({'Authorization': f'Bearer {token}'})
+        conn.commit()
+        return book_ids, headers
+    finally:
+        database.release_db(conn)
+
+def worker(app, book_ids, headers, seed_value, outcomes):
+    rng = random.Random(seed_value)
+    client = app.test_client()
+    for _ in range(BORROWS_PER_THREAD):
+        user = rng.choice(headers)
+        response = client.post('/api/loans', json={'book_id': rng.choice(book_ids)}, headers=user)
+        outcomes.append(response.status_code)
+        # Return most of the successful borrows to keep copies moving
+        if response.status_code == 201 and rng.random() < 0.8:
+            loan_id = response.get_json()['id']
+            outcomes.append(client.post(f'/api/loans/{loan_id}/return', headers=user).status_code)
+
+def check_invariants():
+    """Return a list of invariant violations (empty when consistent)"""
+    conn = database.get_db()
+    try:
+        problems = []
+        rows = conn.execute('''
+            SELECT b.id, b.total_copies, b.available_copies,
+                   (SELECT COUNT(*) FROM loans l WHERE l.book_id = b.id AND l.status = 'active') AS active
+            FROM books b WHERE b.isbn LIKE 'stress-%'
+        ''').fetchall()
+        for row in rows:
+            if row['available_copies'] < 0:
+                problems.append(f"book {row['id']}: negative available_copies {row['available_copies']}")
+            if row['available_copies'] + row['active'] != row['total_copies']:
+                problems.append(
+                    f"book {row['id']}: {row['available_copies']} available + {row['active']} on loan "
+                    f"!= {row['total_copies']} copies"
+                )
+
+        duplicates = conn.execute('''
+            SELECT user_id, book_id, COUNT(*) AS count FROM loans
+            WHERE status = 'active' GROUP BY user_id, book_id HAVING COUNT(*) > 1
+        ''').fetchall()
+        for row in duplicates:
+            problems.append(f"user {row['user_id']} has {row['count']} active loans of book {row['book_id']}")
+
+        if database.verify_stats(conn):
+            problems.append(f'library_stats drifted: {database.verify_stats(conn)}')
+        return problems
+    finally:
+        database.release_db(conn)
+
+def run_stress():
+    app = fresh_app()
+    book_ids, headers = seed(app)
+    outcomes = []
+    threads = [
+        threading.Thread(target=worker, args=(app, book_ids, headers, i, outcomes))
+        for i in range(THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+def test_parallel_borrows_keep_invariants():
+    outcomes = run_stress()
+    assert len([status for status in outcomes if status == 201]) > 0
+    assert set(outcomes) <= {200, 201, 400}, f'unexpected statuses: {set(outcomes)}'
+    problems = check_invariants()
+    assert not problems, '\n'.join(problems)
+
+if __name__ == '__main__':
+    outcomes = run_stress()
+    for status in sorted(set(outcomes)):
+        print(f"HTTP {status}: {outcomes.count(status)}")
+    problems = check_invariants()
+    for problem in problems:
+        print(problem)
+    print('FAIL' if problems else 'All invariants hold')
@@ -0,0 +1,117 @@
+"""In-process book and book list caches
+
+Reads are served from the cache until a write that affects them; every
+kind of book write is checked to show up on the next read. Runs against
+each backend in test_storage.backends(). Run with
+``python -m pytest test_cache.py`` or ``python test_cache.py``.
+"""
+import json
+import app as app_module
+from cache import LRUCache
+from test_storage import backends, fresh_client, login
+
+def test_lru_and_tags():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set('a', 1, ['book:1'])
+    cache.set('b', 2, ['book:2'])
+    assert cache.get('a') == 1
+    cache.set('c', 3, ['book:1'])
+    assert cache.get('b') is None and cache.evictions == 1
+    cache.invalidate('book:1')
+    assert cache.get('a') is None and cache.get('c') is None
+
+    # A value read before an invalidation is not stored after it
+    generation = cache.generation()
+    cache.invalidate('book:9')
+    cache.set('d', 4, [], generation)
+    assert cache.get('d') is None
+
+    expired = LRUCache(maxsize=2, ttl=-1)
+    expired.set('a', 1)
+    assert expired.get('a') is None
+
+def invalidation(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    client.post('/api/auth/register', json={
+        'email': 'cache@library.com', 'password': 'secret', 'full_name': 'Cac He'
+    })
+    reader = login(client, 'cache@library.com', 'secret')
+    lists = app_module.book_list_cache
+
+    def titles(query=''):
+        return [book['title'] for book in client.get(f'/api/books{query}', headers=admin).get_json()]
+
+    def copies(book_id, query='?available_only=true'):
+        books = client.get(f'/api/books{query}', headers=admin).get_json()
+        single = client.get(f'/api/books/{book_id}', headers=admin).get_json()
+        listed = [book['available_copies'] for book in books if book['id'] == book_id]
+        return single['available_copies'], listed[0] if listed else None
+
+    # A repeated query is a hit
+    titles()
+    hits = lists.hits
+    titles()
+    assert lists.hits == hits + 1
+
+    book_id = client.post('/api/books', json={
+        'title': 'Cached Book', 'author': 'Cac He', 'category': 'Caching', 'total_copies': 1
+    }, headers=admin).get_json()['id']
+    assert 'Cached Book' in titles()
+    assert copies(book_id) == (1, 1)
+
+    client.put(f'/api/books/{book_id}', json={'title': 'Renamed Book'}, headers=admin)
+    assert 'Renamed Book' in titles() and 'Cached Book' not in titles()
+    assert client.get(f'/api/books/{book_id}', headers=admin).get_json()['title'] == 'Renamed Book'
+    assert titles('?search=renamed') == ['Renamed Book']
+
+    # Borrowing the last copy drops it from available_only lists
+    loan = client.post('/api/loans', json={'book_id': book_id}, headers=reader).get_json()
+    assert copies(book_id) == (0, None)
+    client.post(f"/api/loans/{loan['id']}/return", headers=reader)
+    assert copies(book_id) == (1, 1)
+    batch = client.post('/api/loans/batch', json={'book_ids': [book_id]}, headers=reader).get_json()
+    assert copies(book_id) == (0, None)
+    client.post('/api/loans/return/batch', json={'loan_ids': [batch['results'][0]['id']]}, headers=reader)
+    assert copies(book_id) == (1, 1)
+
+    facets = client.get('/api/books?facets=category&limit=50', headers=admin).get_json()['facets']
+    assert {'value': 'Caching', 'count': 1} in facets['category']
+
+    client.post('/api/books/import', data=json.dumps({
+        'title': 'Imported Book', 'author': 'Imp Orter', 'category': 'Importing'
+    }), content_type='application/x-ndjson', headers=admin)
+    assert 'Imported Book' in titles()
+
+    # Deleted books, which have no loans here, leave lists and facets
+    imported_id = client.get('/api/books?search=imported', headers=admin).get_json()[0]['id']
+    assert client.delete(f'/api/books/{imported_id}', headers=admin).status_code == 200
+    assert 'Imported Book' not in titles()
+    assert client.get(f'/api/books/{imported_id}', headers=admin).status_code == 404
+    facets = client.get('/api/books?facets=category&limit=50', headers=admin).get_json()['facets']
+    assert 'Importing' not in [facet['value'] for facet in facets['category']]
+
+def test_writes_invalidate_cached_reads():
+    for url in backends():
+        invalidation(url)
+
+def test_substring_spacing_is_part_of_the_key():
+    client = fresh_client(backends()[0])
+    admin = login(client, 'admin@library.com', 'admin123')
+
+    single = client.get('/api/books?search=ean co&search_mode=substring', headers=admin)
+    double = client.get('/api/books?search=ean  co&search_mode=substring', headers=admin)
+    assert [book['title'] for book in single.get_json()] == ['Clean Code']
+    assert double.get_json() == []
+    assert single.headers['ETag'] != double.headers['ETag']
+
+    # Surrounding spaces are not part of the query, so they share an entry
+    padded = client.get('/api/books?search=%20ean co%20&search_mode=substring', headers=admin)
+    assert padded.get_json() == single.get_json()
+    assert padded.headers['ETag'] == single.headers['ETag']
+
+if __name__ == '__main__':
+    test_lru_and_tags()
+    test_writes_invalidate_cached_reads()
+    test_substring_spacing_is_part_of_the_key()
+    print('Caches work')
@@ -0,0 +1,75 @@
+"""ETag / Last-Modified revalidation of the catalogue endpoints
+
+Runs against each backend in test_storage.backends(). Run with
+``python -m pytest test_conditional.py`` or ``python test_conditional.py``.
+"""
+import app as app_module
+import repository
+from test_storage import backends, fresh_client, login
+
+def clear_caches():
+    app_module.book_cache.clear()
+    app_module.book_list_cache.clear()
+
+def without_book_queries(request):
+    """Run ``request`` with the book queries made to fail"""
+    saved = repository.search_books, repository.get_book
+
+    def fail(*args):
+        raise AssertionError('books table queried')
+
+    repository.search_books = repository.get_book = fail
+    try:
+        return request()
+    finally:
+        repository.search_books, repository.get_book = saved
+
+def revalidation(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+
+    for path in ['/api/books?limit=2', '/api/books/1']:
+        response = client.get(path, headers=admin)
+        assert response.status_code == 200
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        assert etag.startswith('"books-') and response.headers['Cache-Control'] == 'private, no-cache'
+
+        # Answered from the cache, then from the version row alone
+        conditional = dict(admin, **{'If-None-Match': etag})
+        for _ in range(2):
+            response = without_book_queries(lambda: client.get(path, headers=conditional))
+            assert response.status_code == 304 and response.data == b''
+            assert response.headers['ETag'] == etag
+            clear_caches()
+        response = without_book_queries(
+            lambda: client.get(path, headers=dict(admin, **{'If-Modified-Since': last_modified}))
+        )
+        assert response.status_code == 304
+
+    # Different queries get different tags for the same table version
+    first = client.get('/api/books?limit=1', headers=admin).headers['ETag']
+    assert client.get('/api/books?limit=2', headers=admin).headers['ETag'] != first
+
+    # Any change to books moves every tag on
+    list_etag = client.get('/api/books', headers=admin).headers['ETag']
+    book_etag = client.get('/api/books/2', headers=admin).headers['ETag']
+    assert client.put('/api/books/1', json={'total_copies': 9}, headers=admin).status_code == 200
+    clear_caches()
+    response = client.get('/api/books', headers=dict(admin, **{'If-None-Match': list_etag}))
+    assert response.status_code == 200 and response.headers['ETag'] != list_etag
+    response = client.get('/api/books/2', headers=dict(admin, **{'If-None-Match': book_etag}))
+    assert response.status_code == 200 and response.headers['ETag'] != book_etag
+
+    # Borrowing changes availability, so it changes the tag too
+    etag = client.get('/api/books/1', headers=admin).headers['ETag']
+    assert client.post('/api/loans', json={'book_id': 1}, headers=admin).status_code == 201
+    response = client.get('/api/books/1', headers=dict(admin, **{'If-None-Match': etag}))
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+
+def test_revalidation():
+    for url in backends():
+        revalidation(url)
+
+if __name__ == '__main__':
+    test_revalidation()
+    print('Conditional GET works')
@@ -0,0 +1,186 @@
+"""Event log and GET /api/events change feed
+
+Mutations go through the API and the events they leave behind are read
+back from the feed, in order, with their actors. Runs against each
+backend in test_storage.backends(). Run with
+``python -m pytest test_events.py`` or ``python test_events.py``.
+"""
+import json
+import threading
+import time
+from datetime import timedelta
+import database
+import events
+import scheduler
+from timeseries import utcnow
+from test_storage import backends, fresh_client, login
+
+def feed(client, headers, query=''):
+    response = client.get(f'/api/events?{query}', headers=headers)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+def event_log(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    assert feed(client, admin) == {'events': [], 'last_seq': 0, 'more': False}
+
+    response = client.post('/api/auth/register', json={
+        'email': 'events@library.com', 'password': 'secret', 'full_name': 'Ev Ents'
+    })
+    reader_id = response.get_json()['user']['id']
+    reader = login(client, 'events@library.com', 'secret')
+    admin_id = client.get('/api/auth/me', headers=admin).get_json()['id']
+
+    book_id = client.post('/api/books', json={
+        'isbn': '978-0-00-000009-9', 'title': 'Logged', 'author': 'Ann Author', 'total_copies': 1,
+        'available_copies': 1
+    }, headers=admin).get_json()['id']
+    assert client.put(f'/api/books/{book_id}', json={'title': 'Logged Again', 'author': 'Ann Author'},
+                      headers=admin).status_code == 200
+    loan = client.post('/api/loans', json={'book_id': book_id}, headers=reader).get_json()
+    # Failed changes leave no events
+    assert client.post('/api/loans', json={'book_id': book_id}, headers=admin).status_code == 400
+    hold = client.post('/api/holds', json={'book_id': book_id}, headers=admin).get_json()
+    assert client.delete(f"/api/holds/{hold['id']}", headers=admin).status_code == 200
+    batch = client.post('/api/loans/batch', json={'book_ids': [1, 2, book_id]}, headers=reader).get_json()
+    assert batch['succeeded'] == 2
+    assert client.post('/api/loans/return/batch', json={'loan_ids': [loan['id']]}, headers=reader).status_code == 200
+    assert client.put(f'/api/users/{reader_id}', json={'role': 'admin'}, headers=admin).status_code == 200
+    body = '\n'.join(json.dumps(book) for book in [
+        {'isbn': '978-0-00-000010-5', 'title': 'Imported', 'author': 'Bea Author'},
+        {'title': 'No ISBN', 'author': 'Bea Author'}
+    ])
+    assert client.post('/api/books/import', data=body, content_type='application/x-ndjson',
+                       headers=admin).status_code == 200
+    assert client.delete('/api/books/3', headers=admin).status_code == 200
+
+    log = feed(client, admin, 'limit=1000')
+    found = log['events']
+    assert [(event['type'], event['actor_id'], event['entity_id']) for event in found] == [
+        ('user.created', reader_id, reader_id),
+        ('book.created', admin_id, book_id),
+        ('book.updated', admin_id, book_id),
+        ('loan.created', reader_id, loan['id']),
+        ('hold.created', admin_id, hold['id']),
+        ('hold.cancelled', admin_id, hold['id']),
+        ('loan.created', reader_id, batch['results'][0]['id']),
+        ('loan.created', reader_id, batch['results'][1]['id']),
+        ('loan.returned', reader_id, loan['id']),
+        ('user.updated', admin_id, reader_id),
+        ('books.imported', admin_id, None),
+        ('book.deleted', admin_id, 3)
+    ]
+    assert [event['seq'] for event in found] == sorted({event['seq'] for event in found})
+    assert log['last_seq'] == found[-1]['seq'] and not log['more']
+    assert found[0]['data'] == {'email': 'events@library.com', 'full_name': 'Ev Ents', 'role': 'student'}
+    assert found[1]['data']['title'] == 'Logged'
+    assert found[2]['data'] == {'before': {'title': 'Logged'}, 'after': {'title': 'Logged Again'}}
+    assert found[3]['data']['book_id'] == book_id and found[3]['data']['user_id'] == reader_id
+    assert found[8]['data'] == {'book_id': book_id}
+    assert found[9]['data'] == {'before': {'role': 'student'}, 'after': {'role': 'admin'}}
+    assert found[10]['data'] == {'count': 2, 'isbns': ['978-0-00-000010-5']}
+    assert found[11]['data']['title'] == 'Clean Architecture'
+
+    # Pages resume from last_seq
+    first = feed(client, admin, 'limit=5')
+    assert len(first['events']) == 5 and first['more']
+    rest = feed(client, admin, f"since={first['last_seq']}&limit=1000")
+    assert first['events'] + rest['events'] == found
+
+    # The scheduler logs the loans it marks overdue
+    conn = database.get_db()
+    try:
+        scheduler.mark_overdue(conn, now=utcnow() + timedelta(days=30))
+    finally:
+        database.release_db(conn)
+    overdue = feed(client, admin, f"since={log['last_seq']}")['events']
+    assert sorted(event['entity_id'] for event in overdue) == sorted(result['id'] for result in batch['results'][:2])
+    assert {(event['type'], event['actor_id']) for event in overdue} == {('loan.overdue', None)}
+    last_seq = overdue[-1]['seq']
+
+    # Events cannot be changed or removed
+    conn = database.get_db()
+    try:
+        for statement in ['DELETE FROM events', "UPDATE events SET type = 'edited'"]:
+            try:
+                conn.execute(statement)
+            except database.DatabaseError:
+                conn.rollback()
+                continue
+            raise AssertionError(statement)
+    finally:
+        database.release_db(conn)
+    assert len(feed(client, admin, 'limit=1000')['events']) == len(found) + len(overdue)
+
+    # Long polling: an empty feed waits, and returns as soon as an event
+    # is committed
+    started = time.monotonic()
+    assert feed(client, admin, f'since={last_seq}&wait=0.3') == {'events': [], 'last_seq': last_seq, 'more': False}
+    assert time.monotonic() - started >= 0.3
+
+    def write_later():
+        time.sleep(0.3)
+        conn = database.get_db()
+        try:
+            events.append(conn, admin_id, [('test.ping', None, None)])
+            conn.commit()
+        finally:
+            database.release_db(conn)
+
+    writer = threading.Thread(target=write_later)
+    started = time.monotonic()
+    writer.start()
+    polled = feed(client, admin, f'since={last_seq}&wait=10')
+    writer.join()
+    assert [event['type'] for event in polled['events']] == ['test.ping']
+    assert time.monotonic() - started < 5
+
+    for query in ['since=-1', 'since=x', 'limit=0', 'wait=-1', 'wait=nan']:
+        assert client.get(f'/api/events?{query}', headers=admin).status_code == 400, query
+    assert client.get('/api/events', headers=login(client, 'events@library.com', 'secret')).status_code == 200
+    client.put(f'/api/users/{reader_id}', json={'role': 'student'}, headers=admin)
+    assert client.get('/api/events', headers=login(client, 'events@library.com', 'secret')).status_code == 403
+
+def test_event_log():
+    for url in backends():
+        event_log(url)
+
+def test_waiters_are_capped():
+    client = fresh_client(backends()[0])
+    admin = login(client, 'admin@library.com', 'admin123')
+    waiters = events._waiters
+    events._waiters = threading.BoundedSemaphore(1)
+    try:
+        polled = []
+        waiter = threading.Thread(target=lambda: polled.append(feed(client, admin, 'wait=10')))
+        waiter.start()
+        deadline = time.monotonic() + 5
+        while events._waiters._value and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # The slot is taken: a second long poll is refused at once, while
+        # requests that do not wait, or find events, are still answered
+        started = time.monotonic()
+        busy = client.get('/api/events?wait=10', headers=admin)
+        assert busy.status_code == 503 and busy.headers['Retry-After'] == '1'
+        assert time.monotonic() - started < 5
+        assert feed(client, admin) == {'events': [], 'last_seq': 0, 'more': False}
+
+        conn = database.get_db()
+        try:
+            events.append(conn, None, [('test.ping', None, None)])
+            conn.commit()
+        finally:
+            database.release_db(conn)
+        waiter.join()
+        assert [event['type'] for event in polled[0]['events']] == ['test.ping']
+        assert [event['type'] for event in feed(client, admin, 'wait=10')['events']] == ['test.ping']
+        assert events._waiters._value == 1
+    finally:
+        events._waiters = waiters
+
+if __name__ == '__main__':
+    test_event_log()
+    test_waiters_are_capped()
+    print('Event log works')
@@ -0,0 +1,83 @@
+"""Streamed exports of GET /api/loans and GET /api/users
+
+The JSON, NDJSON and CSV forms of a list carry the same rows, are sent a
+fetchmany() batch at a time, and give the pooled connection back once
+the last row is out. Runs against each backend in
+test_storage.backends(). Run with ``python -m pytest test_export.py`` or
+``python test_export.py``.
+"""
+import csv
+import io
+import json
+import database
+from config import Config
+from test_storage import backends, fresh_client, login
+
+def as_text(value):
+    return '' if value is None else str(value)
+
+def exports(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    for i in range(3):
+        client.post('/api/auth/register', json={
+            'email': f'export{i}@library.com', 'password': 'secret', 'full_name': f'Ex, "Port" {i}'
+        })
+    reader = login(client, 'export0@library.com', 'secret')
+    client.post('/api/loans/batch', json={'book_ids': [1, 2, 3]}, headers=admin)
+    client.post('/api/loans/batch', json={'book_ids': [4]}, headers=reader)
+
+    for path in ['/api/loans', '/api/users']:
+        rows = client.get(path, headers=admin).get_json()
+        assert len(rows) >= 4
+
+        ndjson = client.get(f'{path}?format=ndjson', headers=admin)
+        assert ndjson.mimetype == 'application/x-ndjson'
+        assert ndjson.headers['Content-Disposition'].endswith(f"{path.rsplit('/', 1)[1]}.ndjson")
+        assert [json.loads(line) for line in ndjson.get_data(as_text=True).splitlines()] == rows
+
+        exported = client.get(f'{path}?format=csv', headers=admin)
+        assert exported.mimetype == 'text/csv'
+        parsed = list(csv.DictReader(io.StringIO(exported.get_data(as_text=True))))
+        assert parsed == [{name: as_text(value) for name, value in row.items()} for row in rows]
+
+        projected = client.get(f'{path}?format=csv&fields=id', headers=admin).get_data(as_text=True)
+        assert projected.splitlines() == ['id'] + [str(row['id']) for row in rows]
+
+        for query in ['format=xml', 'format=csv&limit=2', 'fields=password']:
+            assert client.get(f'{path}?{query}', headers=admin).status_code == 400, query
+
+    # Students export only their own loans, and not the users
+    own = client.get('/api/loans?format=ndjson', headers=reader).get_data(as_text=True).splitlines()
+    assert [json.loads(line)['book_id'] for line in own] == [4]
+    assert client.get('/api/users?format=csv', headers=reader).status_code == 403
+
+def test_export_formats_match():
+    for url in backends():
+        exports(url)
+
+def test_exports_stream_in_batches():
+    client = fresh_client(backends()[0])
+    admin = login(client, 'admin@library.com', 'admin123')
+    for i in range(5):
+        client.post('/api/auth/register', json={
+            'email': f'batch{i}@library.com', 'password': 'secret', 'full_name': f'Bat Ch {i}'
+        })
+
+    fetch_size = Config.EXPORT_FETCH_SIZE
+    Config.EXPORT_FETCH_SIZE = 2
+    try:
+        response = client.get('/api/users?format=ndjson', headers=admin, buffered=False)
+        chunks = [chunk for chunk in response.response if chunk]
+        response.close()
+    finally:
+        Config.EXPORT_FETCH_SIZE = fetch_size
+
+    # 6 users in batches of 2
+    assert [len(chunk.splitlines()) for chunk in chunks] == [2, 2, 2]
+    assert database.get_pool().stats()['in_use'] == 0
+
+if __name__ == '__main__':
+    test_export_formats_match()
+    test_exports_stream_in_batches()
+    print('Exports work')
@@ -0,0 +1,104 @@
+"""Facet counts in GET /api/books and the GET /api/books/categories list
+
+Counts from the API are compared with counts taken over every book in
+Python, for browsing (facet_counts) and searches (one grouped pass),
+after the catalogue changes. Runs against each backend in
+test_storage.backends(). Run with ``python -m pytest test_facets.py`` or
+``python test_facets.py``.
+"""
+import app as app_module
+import database
+from test_storage import backends, fresh_client, login
+
+def expected(books, category='', available_only=False, matches=lambda book: True):
+    books = [book for book in books if matches(book)]
+
+    def ranked(values):
+        counts = {}
+        for value in values:
+            if value:
+                counts[value] = counts.get(value, 0) + 1
+        return [{'value': value, 'count': count}
+                for value, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:20]]
+
+    shelf = [book for book in books if book['available_copies'] > 0 or not available_only]
+    in_category = [book for book in books if book['category'] == category or not category]
+    available = sum(1 for book in in_category if book['available_copies'] > 0)
+    return {
+        'category': ranked(book['category'] for book in shelf),
+        'availability': {'available': available, 'unavailable': len(in_category) - available},
+        'author': ranked(book['author'] for book in shelf if book in in_category)
+    }
+
+def all_books():
+    conn = database.get_db()
+    try:
+        return [dict(row) for row in conn.execute('SELECT * FROM books').fetchall()]
+    finally:
+        database.release_db(conn)
+
+def check(client, headers, **filters):
+    query = '&'.join(f'{name}={value}' for name, value in filters.items())
+    response = client.get(f'/api/books?facets=&{query}', headers=headers)
+    assert response.status_code == 200
+    search = filters.pop('search', '').lower()
+    facets = expected(
+        all_books(), filters.get('category', ''), filters.get('available_only') == 'true',
+        lambda book: search in book['title'].lower() or search in book['author'].lower()
+    )
+    assert response.get_json()['facets'] == facets, filters
+
+def facets(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    for i in range(12):
+        assert client.post('/api/books', json={
+            'title': f'Facet Book {i}', 'author': f'Author {i % 3}', 'category': f'Topic {i % 4}',
+            'total_copies': 1, 'available_copies': i % 2
+        }, headers=admin).status_code == 201
+
+    def check_all():
+        app_module.book_list_cache.clear()
+        for filters in [{}, {'available_only': 'true'}, {'category': 'Topic 1'},
+                        {'category': 'Topic 1', 'available_only': 'true'}, {'search': 'facet'},
+                        {'search': 'facet', 'category': 'Topic 2', 'available_only': 'true'},
+                        {'search': 'facet', 'search_mode': 'substring'}]:
+            check(client, admin, **filters)
+
+    check_all()
+    book_id = client.get('/api/books?search=Facet Book 1&limit=1', headers=admin).get_json()['items'][0]['id']
+    assert client.put(f'/api/books/{book_id}', json={'category': 'Topic 3', 'author': 'Author 9'},
+                      headers=admin).status_code == 200
+    assert client.post('/api/loans', json={'book_id': book_id}, headers=admin).status_code == 201
+    assert client.delete('/api/books/1', headers=admin).status_code == 200
+    check_all()
+
+    # Facets come with the page form, and only the ones asked for
+    page = client.get('/api/books?facets=category&limit=2', headers=admin).get_json()
+    assert set(page['facets']) == {'category'} and len(page['items']) == 2 and page['next_cursor']
+    assert client.get('/api/books?facets=colour', headers=admin).status_code == 400
+    assert isinstance(client.get('/api/books', headers=admin).get_json(), list)
+
+    # The category list for pickers holds every category, past FACET_LIMIT
+    counts = {}
+    for book in all_books():
+        if book['category']:
+            counts[book['category']] = counts.get(book['category'], 0) + 1
+    facet_limit = app_module.app.config['FACET_LIMIT']
+    app_module.app.config['FACET_LIMIT'] = 2
+    try:
+        app_module.book_list_cache.clear()
+        assert len(client.get('/api/books?facets=category', headers=admin).get_json()['facets']['category']) == 2
+        categories = client.get('/api/books/categories', headers=admin).get_json()
+    finally:
+        app_module.app.config['FACET_LIMIT'] = facet_limit
+    assert categories == [{'value': value, 'count': count} for value, count in sorted(counts.items())]
+    assert len(categories) > 2
+
+def test_facets():
+    for url in backends():
+        facets(url)
+
+if __name__ == '__main__':
+    test_facets()
+    print('Facet counts work')
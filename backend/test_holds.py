@@ -0,0 +1,117 @@
+"""Hold queue: positions, copies handed to holds, and expiry
+
+Copies reach waiting holds the same way whether they come from a return,
+a cancelled ready hold, an edit that raises available_copies or an
+import, and each is logged as a hold.ready event; uncollected ready
+holds expire. Runs against each backend in
+test_storage.backends(). Run with ``python -m pytest test_holds.py`` or
+``python test_holds.py``.
+"""
+import json
+from datetime import timedelta
+import app as app_module
+import database
+import scheduler
+from timeseries import utcnow
+from test_storage import backends, fresh_client, login
+
+def queue(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    readers = []
+    for i in range(5):
+        client.post('/api/auth/register', json={
+            'email': f'hold{i}@library.com', 'password': 'secret', 'full_name': f'Hol D {i}'
+        })
+        readers.append(login(client, f'hold{i}@library.com', 'secret'))
+    book_id = client.post('/api/books', json={
+        'isbn': '978-0-00-000050-1', 'title': 'Queued', 'author': 'Que Ued', 'total_copies': 1
+    }, headers=admin).get_json()['id']
+
+    def hold_of(reader):
+        holds = [hold for hold in client.get('/api/holds', headers=reader).get_json()
+                 if hold['book_id'] == book_id]
+        return (holds[0]['status'], holds[0]['position']) if holds else None
+
+    def available():
+        return client.get(f'/api/books/{book_id}', headers=admin).get_json()['available_copies']
+
+    loan = client.post('/api/loans', json={'book_id': book_id}, headers=admin).get_json()
+    holds = [client.post('/api/holds', json={'book_id': book_id}, headers=reader).get_json()
+             for reader in readers]
+    assert [hold['position'] for hold in holds] == [1, 2, 3, 4, 5]
+
+    # A return goes to the first hold, and the queue moves up
+    returned = client.post(f"/api/loans/{loan['id']}/return", headers=admin).get_json()
+    assert returned['ready_hold_id'] == holds[0]['id']
+    assert hold_of(readers[0]) == ('ready', None)
+    assert hold_of(readers[1]) == ('waiting', 1)
+    assert available() == 0
+
+    # A raised available_copies goes to the next waiting hold
+    client.put(f'/api/books/{book_id}', json={'total_copies': 2, 'available_copies': 1}, headers=admin)
+    assert hold_of(readers[1]) == ('ready', None)
+    assert hold_of(readers[2]) == ('waiting', 1)
+    assert available() == 0
+
+    # So does a copy added by an import upsert
+    client.post('/api/books/import', data=json.dumps({
+        'isbn': '978-0-00-000050-1', 'title': 'Queued', 'author': 'Que Ued', 'total_copies': 3
+    }), content_type='application/x-ndjson', headers=admin)
+    assert hold_of(readers[2]) == ('ready', None)
+    assert hold_of(readers[3]) == ('waiting', 1)
+    assert available() == 0
+
+    # A cancelled ready hold passes its copy on
+    cancelled = client.delete(f"/api/holds/{holds[0]['id']}", headers=readers[0]).get_json()
+    assert cancelled['ready_hold_id'] == holds[3]['id']
+    assert hold_of(readers[3]) == ('ready', None)
+    assert hold_of(readers[4]) == ('waiting', 1)
+
+    # Uncollected ready holds expire and pass their copies on
+    conn = database.get_db()
+    try:
+        assert scheduler.expire_holds(conn) == 0
+        expired = scheduler.expire_holds(conn, now=utcnow() + timedelta(days=30))
+    finally:
+        database.release_db(conn)
+    assert expired == 3
+    admin_id = client.get('/api/auth/me', headers=admin).get_json()['id']
+    reader_id = client.get('/api/auth/me', headers=readers[0]).get_json()['id']
+    ready = [(event['entity_id'], event['actor_id'], event['data'])
+             for event in client.get('/api/events?limit=1000', headers=admin).get_json()['events']
+             if event['type'] == 'hold.ready']
+    assert ready == [
+        (holds[0]['id'], admin_id, {'book_id': book_id}),
+        (holds[1]['id'], admin_id, {'book_id': book_id}),
+        (holds[2]['id'], admin_id, {'book_id': book_id}),
+        (holds[3]['id'], reader_id, {'book_id': book_id}),
+        (holds[4]['id'], None, {'book_id': book_id})
+    ]
+    # The scheduler runs outside the request path, so cached books only see
+    # the change once their TTL runs out
+    app_module.book_cache.clear()
+    app_module.book_list_cache.clear()
+    assert [hold_of(reader) for reader in readers] == [None, None, None, None, ('ready', None)]
+    assert available() == 2
+
+    # The expired holder borrows from the shelf; the ready one from their hold
+    assert client.post('/api/loans', json={'book_id': book_id}, headers=readers[1]).status_code == 201
+    assert client.post('/api/loans', json={'book_id': book_id}, headers=readers[4]).status_code == 201
+    assert available() == 1
+    assert database_stats_match()
+
+def database_stats_match():
+    conn = database.get_db()
+    try:
+        return database.verify_stats(conn) == {}
+    finally:
+        database.release_db(conn)
+
+def test_hold_queue():
+    for url in backends():
+        queue(url)
+
+if __name__ == '__main__':
+    test_hold_queue()
+    print('Hold queue works')
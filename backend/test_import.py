@@ -0,0 +1,108 @@
+"""Bulk catalogue import behind POST /api/books/import
+
+Per-row validation errors, rows the database rejects, a busy database
+and input that stops decoding part-way. The endpoint checks run against
+each backend in test_storage.backends(). Run with
+``python -m pytest test_import.py`` or ``python test_import.py``.
+"""
+import json
+import sqlite3
+import database
+from catalogue_import import import_books, read_csv, read_ndjson
+from test_storage import backends, fresh_client, login, use_database
+
+def titles(conn):
+    return {row['title'] for row in conn.execute('SELECT title FROM books').fetchall()}
+
+def row_errors(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    lines = [
+        json.dumps({'isbn': '978-0-00-000040-2', 'title': 'Good One', 'author': 'Goo D', 'total_copies': 2}),
+        '{"title": "Broken',
+        json.dumps(['not', 'an', 'object']),
+        '',
+        json.dumps({'title': 'No Author'}),
+        json.dumps({'title': 'Negative', 'author': 'Neg A', 'total_copies': -1}),
+        json.dumps({'title': 'Too Many', 'author': 'Too M', 'total_copies': 1, 'available_copies': 2}),
+        json.dumps({'title': 'Good Two', 'author': 'Goo D'}),
+        # An existing ISBN updates the book in place
+        json.dumps({'isbn': '978-0-13-468599-1', 'title': 'Clean Code 2e', 'author': 'Robert C. Martin'})
+    ]
+    response = client.post('/api/books/import', data='\n'.join(lines), content_type='application/x-ndjson',
+                           headers=admin)
+    assert response.status_code == 200
+    result = response.get_json()
+    assert (result['processed'], result['imported'], result['failed']) == (8, 3, 5)
+    assert [error['row'] for error in result['errors']] == [2, 3, 5, 6, 7]
+    assert result['errors'][1]['error'] == 'Expected a JSON object'
+    assert result['errors'][2]['error'] == 'Missing title or author'
+    assert 'error' not in result
+
+    titles_found = {book['title'] for book in client.get('/api/books', headers=admin).get_json()}
+    assert {'Good One', 'Good Two', 'Clean Code 2e'} <= titles_found
+    assert not titles_found & {'No Author', 'Negative', 'Too Many', 'Clean Code'}
+
+    # Bad UTF-8 part-way: the rows before it are written and reported
+    body = b'title,author\nFirst,Fir St\nSecond,Sec Ond\n' + b'Th\xffird,Thi Rd\nFourth,Fou Rth\n'
+    response = client.post('/api/books/import?format=csv', data=body, content_type='text/csv', headers=admin)
+    assert response.status_code == 400
+    result = response.get_json()
+    assert (result['processed'], result['imported']) == (2, 2)
+    assert result['error'].startswith('Could not read import')
+    titles_found = {book['title'] for book in client.get('/api/books', headers=admin).get_json()}
+    assert {'First', 'Second'} <= titles_found and 'Fourth' not in titles_found
+
+def test_import_row_errors():
+    for url in backends():
+        row_errors(url)
+
+def test_rejected_rows_are_replayed_one_by_one():
+    use_database()
+    conn = database.get_db()
+    try:
+        if database.dialect(conn) != 'sqlite':
+            return
+        conn.execute('''
+            CREATE TRIGGER reject_books BEFORE INSERT ON books WHEN new.title LIKE 'Rejected%'
+            BEGIN SELECT RAISE(ABORT, 'rejected'); END
+        ''')
+        conn.commit()
+        records = read_csv(['title,author', 'Kept 1,Kee P', 'Rejected 1,Rej E', 'Kept 2,Kee P',
+                            'Kept 3,Kee P', 'Rejected 2,Rej E'])
+        result = import_books(conn, records, batch_size=2)
+        assert (result['processed'], result['imported'], result['failed']) == (5, 3, 2)
+        assert [error['row'] for error in result['errors']] == [3, 6]
+        assert {'Kept 1', 'Kept 2', 'Kept 3'} <= titles(conn)
+        assert not any(title.startswith('Rejected') for title in titles(conn))
+    finally:
+        database.release_db(conn)
+
+def test_busy_database_is_not_reported_as_bad_rows():
+    url = use_database()
+    conn = database.get_db()
+    try:
+        if database.dialect(conn) != 'sqlite':
+            return
+        conn.execute('PRAGMA busy_timeout = 0')
+        writer = sqlite3.connect(url)
+        writer.execute('BEGIN IMMEDIATE')
+        try:
+            import_books(conn, read_ndjson([json.dumps({'title': 'Locked Out', 'author': 'Loc K'})]))
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise AssertionError('import_books() swallowed a busy database')
+        finally:
+            writer.rollback()
+            writer.close()
+        assert not conn.in_transaction
+        assert 'Locked Out' not in titles(conn)
+    finally:
+        database.release_db(conn)
+
+if __name__ == '__main__':
+    test_import_row_errors()
+    test_rejected_rows_are_replayed_one_by_one()
+    test_busy_database_is_not_reported_as_bad_rows()
+    print('Catalogue import works')
@@ -0,0 +1,25 @@
+"""Smoke run of the load-testing harness at a tiny scale
+
+Run with ``python -m pytest test_loadtest.py`` or ``python test_loadtest.py``.
+"""
+import os
+import tempfile
+import loadtest
+
+def test_mixed_workload_reports_every_endpoint():
+    output = os.path.join(tempfile.mkdtemp(), 'run.json')
+    report = loadtest.main([
+        '--books', '200', '--users', '20', '--loans', '500', '--clients', '4',
+        '--threads', '4', '--duration', '1', '--warmup', '0', '--output', output
+    ])
+    endpoints = report['results']['endpoints']
+    assert {'GET /api/books?search', 'GET /api/books?limit', 'GET /api/books/<id>', 'POST /api/loans'} <= set(endpoints)
+    for name, summary in endpoints.items():
+        assert summary['server_errors'] == 0 and summary['exceptions'] == 0, name
+        assert summary['p50_ms'] <= summary['p95_ms'] <= summary['p99_ms'] <= summary['max_ms']
+    assert os.path.exists(output)
+    assert loadtest.compare(report, report)[1].endswith('+0.0%')
+
+if __name__ == '__main__':
+    test_mixed_workload_reports_every_endpoint()
+    print('Load test harness works')
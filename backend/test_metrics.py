@@ -0,0 +1,123 @@
+"""GET /metrics and the request and SQL instrumentation behind it
+
+The exposition is parsed back: every family has HELP and TYPE lines,
+counters end in ``_total``, histogram buckets are cumulative, and the
+counters move with the requests made. Run with
+``python -m pytest test_metrics.py`` or ``python test_metrics.py``.
+"""
+import logging
+import re
+import metrics
+from config import Config
+from test_storage import fresh_client, login, use_database
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+
+def parse(text):
+    """({family: kind}, {(name, labels): value}) of an exposition"""
+    kinds, samples, documented = {}, {}, set()
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            documented.add(line.split()[2])
+        elif line.startswith('# TYPE '):
+            _, _, name, kind = line.split()
+            assert name in documented, name
+            kinds[name] = kind
+        else:
+            match = SAMPLE.match(line)
+            assert match, line
+            samples[match.group(1), match.group(2) or ''] = float(match.group(3))
+    return kinds, samples
+
+def family(kinds, name):
+    for suffix in ['_bucket', '_count', '_sum', '']:
+        if name.endswith(suffix) and name[:len(name) - len(suffix)] in kinds:
+            return name[:len(name) - len(suffix)]
+    raise AssertionError(f'{name} has no TYPE line')
+
+def scrape(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    return parse(response.get_data(as_text=True))
+
+def test_exposition_format():
+    client = fresh_client(use_database())
+    admin = login(client, 'admin@library.com', 'admin123')
+    client.get('/api/books/1', headers=admin)
+    client.get('/api/books/1', headers=admin)
+    kinds, samples = scrape(client)
+
+    for name, _ in samples:
+        family(kinds, name)
+    for name, kind in kinds.items():
+        assert kind in ('counter', 'gauge', 'histogram'), name
+        assert name.endswith('_total') == (kind == 'counter'), name
+    for name in ['cache_books_hits_total', 'cache_books_misses_total', 'cache_books_evictions_total',
+                 'db_pool_waits_total', 'http_requests_total', 'sql_statements_total']:
+        assert kinds[name] == 'counter', name
+    assert kinds['cache_books_size'] == 'gauge'
+    assert kinds['http_request_duration_seconds'] == 'histogram'
+    assert samples['cache_books_hits_total', ''] >= 1
+
+    # Buckets are cumulative and end at +Inf with the count
+    labels = '{method="GET",endpoint="/api/books/<int:book_id>"'
+    buckets = [value for (name, sample_labels), value in samples.items()
+               if name == 'http_request_duration_seconds_bucket' and sample_labels.startswith(labels)]
+    assert buckets == sorted(buckets) and len(buckets) == len(metrics.LATENCY_BUCKETS) + 1
+    count = samples['http_request_duration_seconds_count', labels + '}']
+    assert buckets[-1] == count >= 2
+
+    # Requests and statements are counted as they happen
+    requests = labels + ',status="200"}'
+    before = samples['http_requests_total', requests]
+    statements = samples['sql_statements_total', '{operation="SELECT"}']
+    client.get('/api/books/2', headers=admin)
+    _, samples = scrape(client)
+    assert samples['http_requests_total', requests] == before + 1
+    assert samples['sql_statements_total', '{operation="SELECT"}'] > statements
+
+def test_counters_must_be_named_total():
+    assert 'lonely_total 3' in metrics.render(counters=[('lonely_total', 'A counter', 3)])
+    try:
+        metrics.render(counters=[('lonely', 'A counter', 3)])
+    except ValueError:
+        return
+    raise AssertionError('render() accepted a counter without _total')
+
+def test_label_values_are_escaped():
+    counter = metrics.Counter('escaped_total', 'Escaping', ('value',))
+    counter.inc('a "quoted"\\path\nline')
+    assert list(counter.samples()) == ['escaped_total{value="a \\"quoted\\"\\\\path\\nline"} 1']
+
+def test_slow_statements_are_logged_normalized():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    metrics.logger.addHandler(handler)
+    slow_query_ms = Config.SLOW_QUERY_MS
+    Config.SLOW_QUERY_MS = 0
+    slow = metrics.SLOW_QUERIES._values.get(('SELECT',), 0)
+    try:
+        metrics.record_query("SELECT * FROM books WHERE title = 'Clean Code' AND id IN (?, ?, ?) LIMIT 5", 0.001)
+    finally:
+        Config.SLOW_QUERY_MS = slow_query_ms
+        metrics.logger.removeHandler(handler)
+    assert metrics.SLOW_QUERIES._values[('SELECT',)] == slow + 1
+    assert records[0].getMessage().endswith('SELECT * FROM books WHERE title = ? AND id IN (...) LIMIT ?')
+
+def test_disabled_metrics_answer_404():
+    from app import create_app
+
+    class QuietConfig(Config):
+        METRICS_ENABLED = False
+
+    assert create_app(QuietConfig).test_client().get('/metrics').status_code == 404
+
+if __name__ == '__main__':
+    test_exposition_format()
+    test_counters_must_be_named_total()
+    test_label_values_are_escaped()
+    test_slow_statements_are_logged_normalized()
+    test_disabled_metrics_answer_404()
+    print('Metrics work')
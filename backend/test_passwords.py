@@ -0,0 +1,114 @@
+"""Password hashing and the login paths that use it
+
+Hashes are upgraded on a successful login, a full hashing pool answers
+503 instead of queueing, and unknown emails still pay for one hash.
+Run with ``python -m pytest test_passwords.py`` or ``python test_passwords.py``.
+"""
+import hashlib
+import database
+import passwords
+from config import Config
+from test_storage import fresh_client, use_database
+
+def stored_hash(email):
+    conn = database.get_db()
+    try:
+        return conn.execute('SELECT password FROM users WHERE email = ?', (email,)).fetchone()['password']
+    finally:
+        database.release_db(conn)
+
+def set_hash(email, stored):
+    conn = database.get_db()
+    try:
+        conn.execute('UPDATE users SET password = ? WHERE email = ?', (stored, email))
+        conn.commit()
+    finally:
+        database.release_db(conn)
+
+def login(client, email, password):
+    return client.post('/api/auth/login', json={'email': email, 'password': password})
+
+def test_hashes_round_trip():
+    stored = passwords.hash_password('secret')
+    assert stored.startswith('scrypt$') and stored != passwords.hash_password('secret')
+    assert passwords.verify_password('secret', stored) == (True, False)
+    assert passwords.verify_password('wrong', stored) == (False, False)
+    assert passwords.verify_password('secret', 'bcrypt$not$a$scrypt$hash$here') == (False, False)
+    assert passwords.verify_password('secret', 'garbage') == (False, False)
+    # Cost parameters hashlib refuses fail verification rather than raise
+    algorithm, n, r, p, salt, digest = stored.split('$')
+    for n, r, p in [(3, r, p), (n, 0, p), (-2, r, p), (2 ** 64, r, p)]:
+        assert passwords.verify_password('secret', '$'.join(map(str, [algorithm, n, r, p, salt, digest]))) == (False, False)
+
+def test_login_rehashes_outdated_hashes():
+    client = fresh_client(use_database())
+    email = 'admin@library.com'
+
+    # A legacy unsalted SHA-256 digest is replaced, but only on success
+    legacy = hashlib.sha256(b'admin123').hexdigest()
+    set_hash(email, legacy)
+    assert login(client, email, 'wrong').status_code == 401
+    assert stored_hash(email) == legacy
+    assert login(client, email, 'admin123').status_code == 200
+    upgraded = stored_hash(email)
+    assert upgraded.startswith(f'scrypt${Config.PASSWORD_SCRYPT_N}$')
+
+    # So is a scrypt hash made with another cost
+    cost = Config.PASSWORD_SCRYPT_N
+    Config.PASSWORD_SCRYPT_N = cost // 2
+    try:
+        assert login(client, email, 'admin123').status_code == 200
+        assert stored_hash(email).startswith(f'scrypt${cost // 2}$')
+    finally:
+        Config.PASSWORD_SCRYPT_N = cost
+    assert login(client, email, 'admin123').status_code == 200
+    assert stored_hash(email).startswith(f'scrypt${cost}$')
+
+    # An up-to-date hash is left alone
+    current = stored_hash(email)
+    assert login(client, email, 'admin123').status_code == 200
+    assert stored_hash(email) == current
+
+def test_saturated_hashing_pool_answers_503():
+    client = fresh_client(use_database())
+    held = 0
+    while passwords._slots.acquire(blocking=False):
+        held += 1
+    try:
+        assert held == Config.PASSWORD_HASH_WORKERS + Config.PASSWORD_HASH_QUEUE
+        response = login(client, 'admin@library.com', 'admin123')
+        assert response.status_code == 503
+        response = client.post('/api/auth/register', json={
+            'email': 'busy@library.com', 'password': 'secret', 'full_name': 'Bu Sy'
+        })
+        assert response.status_code == 503
+    finally:
+        for _ in range(held):
+            passwords._slots.release()
+    assert login(client, 'admin@library.com', 'admin123').status_code == 200
+
+def test_unknown_email_is_checked_against_the_dummy_hash():
+    client = fresh_client(use_database())
+    checked = []
+    verify = passwords.verify_password
+
+    def recording_verify(password, stored):
+        checked.append(stored)
+        return verify(password, stored)
+
+    passwords.verify_password = recording_verify
+    try:
+        response = login(client, 'nobody@library.com', 'admin123')
+        assert response.status_code == 401
+        assert response.get_json() == login(client, 'admin@library.com', 'wrong').get_json()
+    finally:
+        passwords.verify_password = verify
+    assert checked == [passwords.dummy_hash(), stored_hash('admin@library.com')]
+    assert passwords.dummy_hash().startswith('scrypt$')
+
+if __name__ == '__main__':
+    test_hashes_round_trip()
+    test_login_rehashes_outdated_hashes()
+    test_saturated_hashing_pool_answers_503()
+    test_unknown_email_is_checked_against_the_dummy_hash()
+    print('Password hashing works')
@@ -0,0 +1,188 @@
+"""EXPLAIN QUERY PLAN regression test for the queries the app issues
+
+Run with ``python -m pytest test_query_plans.py`` or ``python test_query_plans.py``.
+A scenario drives every endpoint (and the overdue scheduler) through the
+test client while the instrumented cursor records each statement with
+its parameters; each recorded statement is then explained. Fails if any
+of them scans a whole table, or sorts in a temp b-tree where an index
+could have provided the order, so a regression in repository.py or
+circulation.py shows up here without a hand-kept copy of the SQL.
+"""
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+import database
+import metrics
+import scheduler
+
+# Steps whose statements may sort in a temp b-tree: ranking by bm25, and
+# by counts for the facets and top lists, needs the matched rows first;
+# a user's own holds are few and sorted by queue date
+SORT_ALLOWED = {'search page', 'search next page', 'facets', 'catalogue facets', 'stats top', 'holds',
+                'overdue summary'}
+
+# Steps that read a whole table by design: the admin overdue report lists
+# every row of overdue_summary, which only holds users with overdue loans
+SCAN_ALLOWED = {'overdue summary'}
+
+# Statements the planner has nothing to say about
+EXPLAINED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+def is_full_scan(step, detail):
+    """True for plan steps that read a whole table or sort in a temp b-tree"""
+    if detail.startswith('USE TEMP B-TREE'):
+        return step not in SORT_ALLOWED
+    if not detail.startswith('SCAN '):
+        return False
+    if step in SCAN_ALLOWED:
+        return False
+    return 'INDEX' not in detail and 'VIRTUAL TABLE' not in detail
+
+@contextmanager
+def recording():
+    """Record (sql, params) of every statement run by an instrumented cursor"""
+    statements = []
+    cursor = metrics.InstrumentedCursor
+    execute, executemany = cursor.execute, cursor.executemany
+
+    def record_execute(self, sql, parameters=()):
+        statements.append((sql, parameters))
+        return execute(self, sql, parameters)
+
+    def record_executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        if seq_of_parameters:
+            statements.append((sql, seq_of_parameters[0]))
+        return executemany(self, sql, seq_of_parameters)
+
+    cursor.execute, cursor.executemany = record_execute, record_executemany
+    try:
+        yield statements
+    finally:
+        cursor.execute, cursor.executemany = execute, executemany
+
+def migrated_connection():
+    """A connection to a fresh database created by init_db()"""
+    database.close_pool()
+    database.DATABASE = os.path.join(tempfile.mkdtemp(), 'library.db')
+    database.init_db()
+    return database.get_db()
+
+def query_plan(conn, sql, params):
+    return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+def scenario():
+    """Yield (step, run) for every query path, with the data they need"""
+    from test_storage import fresh_client, login
+    client = fresh_client(database.DATABASE)
+    admin = login(client, 'admin@library.com', 'admin123')
+    reader_id = client.post('/api/auth/register', json={
+        'email': 'plans@library.com', 'password': 'secret', 'full_name': 'Pla Ns'
+    }).get_json()['user']['id']
+    reader = login(client, 'plans@library.com', 'secret')
+    single = client.post('/api/books', json={'title': 'Single Copy', 'author': 'Ann Author'}, headers=admin)
+    single = single.get_json()['id']
+
+    def next_page(path):
+        cursor = client.get(f'{path}limit=1', headers=admin).get_json()['next_cursor']
+        return client.get(f'{path}limit=1&cursor={cursor}', headers=admin)
+
+    loans = {}
+
+    def borrow():
+        loans['single'] = client.post('/api/loans', json={'book_id': 1}, headers=reader).get_json()['id']
+
+    def borrow_batch():
+        results = client.post('/api/loans/batch', json={'book_ids': [2, 3, single]}, headers=reader).get_json()
+        loans['batch'] = [result['id'] for result in results['results']]
+
+    holds = {}
+
+    def place_hold():
+        holds['id'] = client.post('/api/holds', json={'book_id': single}, headers=admin).get_json()['id']
+
+    yield 'login', lambda: login(client, 'admin@library.com', 'admin123')
+    yield 'me', lambda: client.get('/api/auth/me', headers=reader)
+    yield 'books page', lambda: client.get('/api/books?limit=2', headers=admin)
+    yield 'books next page', lambda: next_page('/api/books?')
+    yield 'books by category', lambda: client.get('/api/books?category=Programming&limit=2', headers=admin)
+    yield 'books available', lambda: client.get('/api/books?available_only=true&limit=2', headers=admin)
+    yield 'search page', lambda: client.get('/api/books?search=clean&limit=1', headers=admin)
+    yield 'search next page', lambda: next_page('/api/books?search=clean&')
+    yield 'search isbn', lambda: client.get('/api/books?search=978-0-13-468599-1', headers=admin)
+    yield 'facets', lambda: client.get('/api/books?search=clean&facets=', headers=admin)
+    yield 'catalogue facets', lambda: client.get('/api/books?facets=&limit=2', headers=admin)
+    yield 'get book', lambda: client.get('/api/books/1', headers=admin)
+    yield 'related books', lambda: client.get('/api/books/1/related', headers=admin)
+    yield 'update book', lambda: client.put('/api/books/4', json={'category': 'Craft'}, headers=admin)
+    yield 'import', lambda: client.post('/api/books/import', data=json.dumps({
+        'isbn': '978-0-00-000020-4', 'title': 'Imported', 'author': 'Bea Author'
+    }), content_type='application/x-ndjson', headers=admin)
+    yield 'borrow', borrow
+    yield 'borrow batch', borrow_batch
+    yield 'place hold', place_hold
+    yield 'holds', lambda: client.get('/api/holds', headers=admin)
+    yield 'loans page', lambda: client.get('/api/loans?limit=2', headers=admin)
+    yield 'loans next page', lambda: next_page('/api/loans?')
+    yield 'own loans page', lambda: client.get('/api/loans?limit=2', headers=reader)
+    yield 'loans export', lambda: client.get('/api/loans?format=ndjson', headers=admin).get_data()
+    yield 'return', lambda: client.post(f"/api/loans/{loans['single']}/return", headers=reader)
+    yield 'return batch', lambda: client.post(
+        '/api/loans/return/batch', json={'loan_ids': loans['batch']}, headers=reader
+    )
+    yield 'borrow ready hold', lambda: client.post('/api/loans', json={'book_id': single}, headers=admin)
+    yield 'cancel hold', lambda: client.delete(f"/api/holds/{holds['id']}", headers=admin)
+    yield 'overdue scheduler', lambda: scheduler.OverdueScheduler().run_once()
+    yield 'overdue summary', lambda: client.get('/api/loans/overdue', headers=admin)
+    yield 'delete book', lambda: client.delete('/api/books/5', headers=admin)
+    yield 'users page', lambda: client.get('/api/users?limit=1', headers=admin)
+    yield 'users next page', lambda: next_page('/api/users?')
+    yield 'users export', lambda: client.get('/api/users?format=csv', headers=admin).get_data()
+    yield 'update user', lambda: client.put(f'/api/users/{reader_id}', json={'role': 'student'}, headers=admin)
+    yield 'stats', lambda: client.get('/api/stats', headers=admin)
+    yield 'stats timeseries', lambda: client.get('/api/stats/timeseries', headers=admin)
+    yield 'stats top', lambda: client.get('/api/stats/top', headers=admin)
+    yield 'events', lambda: client.get('/api/events?limit=5', headers=admin)
+
+def recorded_plans():
+    """[(step, sql, plan)] for every statement the scenario issued"""
+    conn = migrated_connection()
+    plans = []
+    try:
+        for step, run in scenario():
+            with recording() as statements:
+                run()
+            for sql, params in statements:
+                if sql.lstrip().upper().startswith(EXPLAINED):
+                    plans.append((step, ' '.join(sql.split()), query_plan(conn, sql, params)))
+    finally:
+        database.release_db(conn)
+    return plans
+
+def test_migrations_record_schema_version():
+    conn = migrated_connection()
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(database.MIGRATIONS)
+
+def test_migrate_skips_applied_migrations():
+    conn = migrated_connection()
+    schema = conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall()
+    database.migrate(conn)
+    assert conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall() == schema
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(database.MIGRATIONS)
+
+def test_app_queries_do_not_scan():
+    plans = recorded_plans()
+    steps = {step for step, _, _ in plans}
+    assert {'borrow', 'search page', 'overdue scheduler', 'events'} <= steps
+    failures = [
+        f'{step}: {sql}\n    {[detail for detail in plan if is_full_scan(step, detail)]}'
+        for step, sql, plan in plans
+        if any(is_full_scan(step, detail) for detail in plan)
+    ]
+    assert not failures, 'Full scans in app queries:\n' + '\n'.join(failures)
+
+if __name__ == '__main__':
+    for step, sql, plan in recorded_plans():
+        status = 'FAIL' if any(is_full_scan(step, detail) for detail in plan) else 'ok'
+        print(f"[{status}] {step}: {sql[:100]}\n    {' | '.join(plan)}")
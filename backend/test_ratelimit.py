@@ -0,0 +1,139 @@
+"""Token-bucket rate limiting of the auth endpoints
+
+The stores are driven with a fake clock; the endpoint checks use an app
+with tight limits and make sure a rejected login reaches neither the
+database nor the password hasher. Run with
+``python -m pytest test_ratelimit.py`` or ``python test_ratelimit.py``.
+"""
+import os
+import tempfile
+import passwords
+import ratelimit
+import repository
+from config import Config
+from test_storage import use_database
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def buckets(store, clock):
+    minute = ratelimit.parse_limit('3/60')
+    strict = ratelimit.parse_limit('1/60')
+
+    # A burst of 3, then one more token every 20 seconds
+    assert [store.take([('a', minute)]) for _ in range(3)] == [(0, None)] * 3
+    wait, denied = store.take([('a', minute)])
+    assert denied == 0 and abs(wait - 20) < 1e-9
+    clock.now += 20
+    assert store.take([('a', minute)]) == (0, None)
+    assert store.take([('a', minute)])[1] == 0
+
+    # All or nothing: a request refused by one bucket takes no token from
+    # the other
+    assert store.take([('b', minute), ('c', strict)]) == (0, None)
+    assert store.take([('b', minute), ('c', strict)])[1] == 1
+    clock.now += 60
+    for _ in range(3):
+        assert store.take([('b', minute)]) == (0, None)
+
+def test_memory_store():
+    clock = Clock()
+    buckets(ratelimit.MemoryStore(100, clock), clock)
+
+    # Bounded, least recently used evicted first
+    store = ratelimit.MemoryStore(2, clock)
+    limit = ratelimit.parse_limit('1/60')
+    for key in ['a', 'b', 'a', 'c']:
+        store.take([(key, limit)])
+    assert list(store._buckets) == ['a', 'c'] and store.evictions == 1
+
+def test_file_store():
+    clock = Clock()
+    path = os.path.join(tempfile.mkdtemp(), 'rate_limits.db')
+    buckets(ratelimit.FileStore(path, 100, clock), clock)
+
+    # Two processes' stores share buckets through the file
+    first, second = ratelimit.FileStore(path, 100, clock), ratelimit.FileStore(path, 100, clock)
+    first.clear()
+    limit = ratelimit.parse_limit('2/60')
+    assert first.take([('shared', limit)]) == (0, None)
+    assert second.take([('shared', limit)]) == (0, None)
+    assert first.take([('shared', limit)])[1] == 0
+
+    # Pruning drops full buckets, then the oldest beyond max_keys
+    store = ratelimit.FileStore(path, 2, clock)
+    store.clear()
+    store.take([('old', limit)])
+    clock.now += 40
+    for key in ['x', 'y', 'z']:
+        store.take([(key, limit)])
+        clock.now += 1
+    store._prune(store._connect(), clock())
+    keys = [row[0] for row in store._connect().execute('SELECT key FROM rate_limits ORDER BY key')]
+    assert keys == ['y', 'z'] and store.evictions == 1
+
+def test_parse_limit():
+    assert ratelimit.parse_limit('') is None
+    assert ratelimit.parse_limit('5/60') == (5, 60.0)
+    for spec in ['5', 'five/60', '0/60']:
+        try:
+            ratelimit.parse_limit(spec)
+        except ValueError:
+            continue
+        raise AssertionError(spec)
+
+class LimitedConfig(Config):
+    RATE_LIMITS = {
+        'api.login': {'ip': '4/60', 'account': '2/60'},
+        'api.register': {'ip': '1/60'}
+    }
+    RATE_LIMIT_DEFAULT = ''
+    RATE_LIMIT_STORAGE = 'memory'
+
+def test_auth_endpoints_are_throttled():
+    from app import create_app
+    use_database()
+    client = create_app(LimitedConfig).test_client()
+
+    def attempt(email, address='10.0.0.1'):
+        return client.post('/api/auth/login', json={'email': email, 'password': 'wrong'},
+                           environ_base={'REMOTE_ADDR': address})
+
+    assert [attempt('admin@library.com').status_code for _ in range(2)] == [401, 401]
+    response = attempt('Admin@Library.com ')
+    assert response.status_code == 429 and int(response.headers['Retry-After']) == 30
+
+    # The refused attempt left the IP's budget alone; another account from
+    # the same address still gets its own tries until the IP runs out
+    assert [attempt('nobody@library.com').status_code for _ in range(3)] == [401, 401, 429]
+    assert attempt('someone@library.com', '10.0.0.2').status_code == 401
+
+    # Rejections touch neither the database nor the hashing pool
+    def fail(*args):
+        raise AssertionError('rejected request did work')
+
+    saved = repository.find_user_by_email, passwords.offload
+    repository.find_user_by_email = passwords.offload = fail
+    try:
+        assert attempt('admin@library.com').status_code == 429
+    finally:
+        repository.find_user_by_email, passwords.offload = saved
+
+    new_user = {'email': 'reader@library.com', 'password': 'secret', 'full_name': 'Rea Der'}
+    assert client.post('/api/auth/register', json=new_user).status_code == 201
+    assert client.post('/api/auth/register', json=new_user).status_code == 429
+
+    # Unlisted endpoints are not limited without RATE_LIMIT_DEFAULT
+    assert all(client.get('/health').status_code == 200 for _ in range(10))
+    assert client.get('/health').get_json()['rate_limits']['rejected'] == 4
+
+if __name__ == '__main__':
+    test_memory_store()
+    test_file_store()
+    test_parse_limit()
+    test_auth_endpoints_are_throttled()
+    print('Rate limiting works')
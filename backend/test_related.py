@@ -0,0 +1,94 @@
+"""Related books built from the loan history
+
+The blocked sparse build and the incremental refresh are compared with
+co-borrower counts taken pair by pair. Runs against each backend in
+test_storage.backends(). Run with ``python -m pytest test_related.py``
+or ``python test_related.py``.
+"""
+import random
+from collections import Counter
+import database
+import related
+from test_storage import backends, fresh_client, login
+
+def add_loans(conn, loans):
+    conn.executemany('''
+        INSERT INTO loans (user_id, book_id, due_date, return_date, status)
+        VALUES (?, ?, '2024-01-15', '2024-01-10', 'returned')
+    ''', loans)
+    conn.commit()
+
+def expected(conn, k):
+    """{book_id: [(related_id, borrowers), ...]} counted pair by pair"""
+    history = {}
+    for row in conn.execute('SELECT user_id, book_id FROM loans').fetchall():
+        history.setdefault(row['user_id'], set()).add(row['book_id'])
+    counts = {}
+    for books in history.values():
+        for book_id in books:
+            counts.setdefault(book_id, Counter()).update(books - {book_id})
+    return {
+        book_id: sorted(shared.items(), key=lambda item: (-item[1], item[0]))[:k]
+        for book_id, shared in counts.items() if shared
+    }
+
+def stored(conn):
+    table = {}
+    for row in conn.execute('SELECT * FROM related_books ORDER BY book_id, position').fetchall():
+        table.setdefault(row['book_id'], []).append((row['related_id'], row['borrowers']))
+    return table
+
+def related_books(url):
+    if related.sp is None:
+        return
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    conn = database.get_db()
+    conn.executemany('INSERT INTO books (title, author) VALUES (?, ?)', [(f'Book {i}', 'Author') for i in range(40)])
+    conn.executemany(
+        'INSERT INTO users (email, password, full_name) VALUES (?, ?, ?)',
+        [(f'reader{i}@library.com', 'x', f'Reader {i}') for i in range(60)]
+    )
+    conn.commit()
+    user_ids = [row['id'] for row in conn.execute("SELECT id FROM users WHERE role = 'student'").fetchall()]
+    book_ids = [row['id'] for row in conn.execute('SELECT id FROM books').fetchall()]
+
+    rng = random.Random(7)
+    add_loans(conn, [(rng.choice(user_ids), rng.choice(book_ids)) for _ in range(120)])
+    try:
+        # A small pair budget splits the build into several blocks
+        history = related.LoanHistory()
+        assert related.refresh(conn, k=3, max_pairs=50, history=history) > 0
+        assert stored(conn) == expected(conn, 3)
+
+        # Refreshes recompute only the affected rows, from the history
+        # kept in memory or from a fresh read
+        before = stored(conn)
+        add_loans(conn, [(user_ids[0], book_ids[0]), (user_ids[1], book_ids[0])])
+        refreshed = related.refresh(conn, k=3, max_pairs=50, history=history)
+        assert 0 < refreshed < len(before)
+        assert stored(conn) == expected(conn, 3)
+        assert related.refresh(conn, k=3, history=history) == 0
+
+        add_loans(conn, [(user_ids[2], book_ids[1])])
+        assert 0 < related.refresh(conn, k=3, max_pairs=50) < len(before)
+        assert stored(conn) == expected(conn, 3)
+
+        top = expected(conn, 3)[book_ids[0]]
+        response = client.get(f'/api/books/{book_ids[0]}/related', headers=admin)
+        assert response.status_code == 200
+        assert [(book['id'], book['borrowers']) for book in response.get_json()] == top
+        assert 0 < response.get_json()[0]['share'] <= 1
+        assert len(client.get(f'/api/books/{book_ids[0]}/related?limit=1', headers=admin).get_json()) == 1
+        assert client.get(f'/api/books/{book_ids[0]}/related?limit=x', headers=admin).status_code == 400
+        assert client.get('/api/books/999999/related', headers=admin).status_code == 404
+    finally:
+        database.release_db(conn)
+
+def test_related_books():
+    for url in backends():
+        related_books(url)
+
+if __name__ == '__main__':
+    test_related_books()
+    print('Related books work')
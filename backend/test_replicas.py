@@ -0,0 +1,75 @@
+"""Read-replica routing with SQLite snapshot replicas
+
+Reads are spread over two snapshot copies of the primary. A borrower reads
+their own write from the primary while other users see the replica until
+the next snapshot. Run with ``python -m pytest test_replicas.py`` or
+``python test_replicas.py``.
+"""
+import os
+import tempfile
+import database
+import replicas
+from test_storage import fresh_client, login
+
+def use_replicas(count=2):
+    directory = tempfile.mkdtemp()
+    client = fresh_client(os.path.join(directory, 'library.db'))
+    replicas.close_replicas()
+    replicas.REPLICAS = [f'sqlite:///{directory}/replica{i}.db' for i in range(count)]
+    replicas.SnapshotRefresher().run_once()
+    return client
+
+def reset():
+    replicas.close_replicas()
+    replicas.REPLICAS = []
+
+def available(client, headers, book_id):
+    import app as app_module
+    app_module.book_cache.clear()
+    return client.get(f'/api/books/{book_id}', headers=headers).get_json()['available_copies']
+
+def test_reads_round_robin_over_replicas():
+    client = use_replicas()
+    try:
+        admin = login(client, 'admin@library.com', 'admin123')
+        for _ in range(4):
+            assert client.get('/api/stats', headers=admin).status_code == 200
+        stats = replicas.get_replicas().stats()
+        assert [pool['checkouts'] for pool in stats['replicas']] == [2, 2]
+        assert stats['replica_reads'] == 4 and stats['primary_reads'] == 0
+    finally:
+        reset()
+
+def test_borrower_reads_own_write():
+    client = use_replicas()
+    try:
+        admin = login(client, 'admin@library.com', 'admin123')
+        response = client.post('/api/auth/register', json={
+            'email': 'reader@library.com', 'password': 'secret', 'full_name': 'Rea Der'
+        })
+        reader = {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+        replicas.SnapshotRefresher().run_once()
+        before = available(client, admin, 1)
+
+        assert client.post('/api/loans', json={'book_id': 1}, headers=reader).status_code == 201
+        assert available(client, reader, 1) == before - 1
+        assert len(client.get('/api/loans', headers=reader).get_json()) == 1
+        assert available(client, admin, 1) == before
+
+        replicas.SnapshotRefresher().run_once()
+        assert available(client, admin, 1) == before - 1
+    finally:
+        reset()
+
+def test_without_replicas_reads_use_primary():
+    client = fresh_client(os.path.join(tempfile.mkdtemp(), 'library.db'))
+    admin = login(client, 'admin@library.com', 'admin123')
+    checkouts = database.get_pool().stats()['checkouts']
+    assert client.get('/api/stats', headers=admin).status_code == 200
+    assert database.get_pool().stats()['checkouts'] == checkouts + 1
+
+if __name__ == '__main__':
+    test_reads_round_robin_over_replicas()
+    test_borrower_reads_own_write()
+    test_without_replicas_reads_use_primary()
+    print('Replica routing works')
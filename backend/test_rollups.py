@@ -0,0 +1,180 @@
+"""Loan rollups behind /api/stats/timeseries and /api/stats/top
+
+The rollup tables, as kept by the triggers and as rebuilt, are compared
+with counts taken from the loans in Python. Runs against each backend in
+test_storage.backends(). Run with ``python -m pytest test_rollups.py``
+or ``python test_rollups.py``.
+"""
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+import circulation
+import database
+import timeseries
+from test_storage import backends, fresh_client, login
+
+# Borrowed and returned across an hour, a day, a week (2024-01-07 is a
+# Sunday) and a month boundary
+HISTORY = [
+    # (user, book, borrow_date, return_date)
+    (0, 0, '2023-12-31 23:30:00', '2024-01-02 09:00:00'),
+    (0, 1, '2024-01-01 00:15:00', None),
+    (1, 0, '2024-01-01 00:45:00', '2024-01-07 23:59:59'),
+    (1, 2, '2024-01-07 12:00:00', '2024-01-08 00:00:00'),
+    (2, 0, '2024-01-08 08:00:00', None),
+    (2, 1, '2024-01-08 08:30:00', '2024-01-08 10:00:00.250000'),
+    (0, 2, '2024-01-09 10:00:00', None)
+]
+
+def expected(conn):
+    """{table: {key: counts}} counted from the loans"""
+    loans = conn.execute('SELECT user_id, book_id, borrow_date, return_date, status FROM loans').fetchall()
+    volume, books, borrowers, users = Counter(), Counter(), Counter(), {}
+    for loan in loans:
+        borrowed = datetime.fromisoformat(str(loan['borrow_date']))
+        for interval in timeseries.INTERVALS:
+            period = timeseries.period_key(interval, timeseries.period_start(interval, borrowed))
+            volume[interval, period, 'borrows'] += 1
+            if interval in timeseries.TOP_INTERVALS:
+                books[interval, period, loan['book_id']] += 1
+                borrowers[interval, period, loan['user_id']] += 1
+                users.setdefault((interval, period), set()).add(loan['user_id'])
+            if loan['status'] == 'returned' and loan['return_date']:
+                returned = datetime.fromisoformat(str(loan['return_date']))
+                volume[interval, timeseries.period_key(interval, timeseries.period_start(interval, returned)),
+                       'returns'] += 1
+    periods = {(interval, period) for interval, period, _ in volume}
+    return {
+        'loan_rollups': {key: (volume[key + ('borrows',)], volume[key + ('returns',)], len(users.get(key, ())))
+                         for key in periods},
+        'book_rollups': dict(books),
+        'borrower_rollups': dict(borrowers)
+    }
+
+def stored(conn):
+    return {
+        'loan_rollups': {(row['granularity'], row['period']): (row['borrows'], row['returns'], row['borrowers'])
+                         for row in conn.execute('SELECT * FROM loan_rollups').fetchall()},
+        'book_rollups': {(row['granularity'], row['period'], row['book_id']): row['borrows']
+                         for row in conn.execute('SELECT * FROM book_rollups').fetchall()},
+        'borrower_rollups': {(row['granularity'], row['period'], row['user_id']): row['borrows']
+                             for row in conn.execute('SELECT * FROM borrower_rollups').fetchall()}
+    }
+
+def rollups(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    readers = []
+    for i in range(3):
+        response = client.post('/api/auth/register', json={
+            'email': f'rollup{i}@library.com', 'password': 'secret', 'full_name': f'Roll Up {i}'
+        })
+        readers.append(response.get_json()['user']['id'])
+    book_ids = [book['id'] for book in client.get('/api/books', headers=admin).get_json()][:4]
+
+    conn = database.get_db()
+    try:
+        for user, book, borrowed, returned in HISTORY:
+            conn.execute('''
+                INSERT INTO loans (user_id, book_id, borrow_date, due_date, return_date, status)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (readers[user], book_ids[book], borrowed, borrowed, returned, 'returned' if returned else 'active'))
+        conn.commit()
+
+        # Today's borrows and returns go through the API
+        reader = login(client, 'rollup0@library.com', 'secret')
+        loan = client.post('/api/loans', json={'book_id': book_ids[3]}, headers=reader)
+        loan_ids = [row['id'] for row in conn.execute(
+            "SELECT id FROM loans WHERE status = 'active' ORDER BY id"
+        ).fetchall()]
+        conn.commit()
+        assert loan.status_code == 201
+        assert client.post('/api/loans/return/batch', json={'loan_ids': loan_ids[:2]}, headers=admin).status_code == 200
+
+        assert stored(conn) == expected(conn)
+        database.rebuild_rollups(conn)
+        assert stored(conn) == expected(conn)
+    finally:
+        database.release_db(conn)
+
+    series = client.get('/api/stats/timeseries?interval=day&start=2023-12-31&end=2024-01-10', headers=admin).get_json()
+    assert series['start'] == '2023-12-31' and series['end'] == '2024-01-10' and len(series['series']) == 10
+    assert series['series'][1] == {'period': '2024-01-01', 'borrows': 2, 'returns': 0, 'borrowers': 2}
+    assert series['series'][3] == {'period': '2024-01-03', 'borrows': 0, 'returns': 0, 'borrowers': 0}
+    weeks = client.get('/api/stats/timeseries?interval=week&start=2024-01-03&end=2024-01-10', headers=admin).get_json()
+    assert [(point['period'], point['borrows'], point['borrowers']) for point in weeks['series']] == [
+        ('2024-01-01', 3, 2)
+    ]
+    hours = client.get('/api/stats/timeseries?interval=hour&start=2024-01-08&end=2024-01-08T11:00', headers=admin)
+    points = hours.get_json()['series']
+    assert len(points) == 11 and points[8] == {
+        'period': '2024-01-08 08:00:00', 'borrows': 2, 'returns': 0, 'borrowers': None
+    }
+    assert points[10]['returns'] == 1
+    # Offsets are converted to UTC: 10:00+02:00 is the 08:00 period
+    shifted = client.get(
+        '/api/stats/timeseries?interval=hour&start=2024-01-08T10:00%2B02:00&end=2024-01-08T11:00Z', headers=admin
+    ).get_json()
+    assert shifted['start'] == '2024-01-08 08:00:00' and shifted['series'] == points[8:]
+    default = client.get('/api/stats/timeseries', headers=admin).get_json()
+    assert len(default['series']) == timeseries.DEFAULT_POINTS and default['series'][-1]['borrows'] >= 1
+
+    top = client.get('/api/stats/top?interval=month&date=2024-01-20&limit=2', headers=admin).get_json()
+    assert top['period'] == '2024-01-01' and top['end'] == '2024-02-01'
+    assert top['totals'] == {'borrows': 6, 'returns': 4, 'borrowers': 3}
+    # Three books tie on two loans each; ties go by id
+    tied = sorted(book_ids[:3])[:2]
+    assert [(book['id'], book['borrows']) for book in top['books']] == [(book_id, 2) for book_id in tied]
+    assert top['books'][0]['title']
+    assert [(user['id'], user['borrows']) for user in top['borrowers']] == [(readers[0], 2), (readers[1], 2)]
+    empty = client.get('/api/stats/top?interval=day&date=2020-01-01', headers=admin).get_json()
+    assert empty['books'] == [] and empty['totals']['borrows'] == 0
+
+    for path in ['/api/stats/timeseries?interval=year', '/api/stats/timeseries?start=2024-02-01&end=2024-01-01',
+                 '/api/stats/timeseries?start=yesterday', '/api/stats/top?interval=hour',
+                 '/api/stats/top?limit=0', '/api/stats/timeseries?interval=hour&start=2000-01-01',
+                 # Periods that would end or start beyond the years datetime can hold
+                 '/api/stats/top?interval=month&date=9999-12-15', '/api/stats/top?interval=week&date=9999-12-31',
+                 '/api/stats/timeseries?end=0001-01-05']:
+        assert client.get(path, headers=admin).status_code == 400, path
+    last = client.get('/api/stats/timeseries?interval=month&start=9999-11-01&end=9999-12-31', headers=admin)
+    assert [point['period'] for point in last.get_json()['series']] == ['9999-11-01']
+    assert client.get('/api/stats/top', headers=reader).status_code == 403
+
+def test_rollups():
+    for url in backends():
+        rollups(url)
+
+def test_loan_dates_use_the_database_clock():
+    client = fresh_client(backends()[0])
+    admin = login(client, 'admin@library.com', 'admin123')
+    # A local time zone far from UTC, which the loan dates must not pick up
+    zone = os.environ.get('TZ')
+    os.environ['TZ'] = 'Pacific/Kiritimati'
+    time.tzset()
+    try:
+        loan_id = client.post('/api/loans', json={'book_id': 1}, headers=admin).get_json()['id']
+        client.post(f'/api/loans/{loan_id}/return', headers=admin)
+    finally:
+        if zone is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = zone
+        time.tzset()
+
+    conn = database.get_db()
+    try:
+        loan = conn.execute('SELECT borrow_date, due_date, return_date FROM loans WHERE id = ?', (loan_id,)).fetchone()
+    finally:
+        database.release_db(conn)
+    borrowed, due, returned = (
+        datetime.fromisoformat(str(loan[name])) for name in ['borrow_date', 'due_date', 'return_date']
+    )
+    assert timedelta(0) <= returned - borrowed < timedelta(minutes=1)
+    assert abs(due - borrowed - circulation.LOAN_PERIOD) < timedelta(minutes=1)
+
+if __name__ == '__main__':
+    test_rollups()
+    test_loan_dates_use_the_database_clock()
+    print('Loan rollups work')
@@ -0,0 +1,101 @@
+"""Background overdue detection and GET /api/loans/overdue
+
+Loans are given due dates a few days out and passes are run as of later
+times, in small batches; each pass only picks up loans that fell due
+since the last one. Runs against each backend in test_storage.backends().
+Run with ``python -m pytest test_scheduler.py`` or ``python test_scheduler.py``.
+"""
+import time
+from datetime import timedelta
+import database
+import scheduler
+from timeseries import utcnow
+from test_storage import backends, fresh_client, login
+
+def set_due(loan_ids, due_date):
+    conn = database.get_db()
+    try:
+        conn.executemany(
+            'UPDATE loans SET due_date = ? WHERE id = ?', [(due_date, loan_id) for loan_id in loan_ids]
+        )
+        conn.commit()
+    finally:
+        database.release_db(conn)
+
+def mark(**kwargs):
+    conn = database.get_db()
+    try:
+        return scheduler.mark_overdue(conn, **kwargs)
+    finally:
+        database.release_db(conn)
+
+def overdue(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+    reader_ids, readers = [], []
+    for i in range(2):
+        reader_ids.append(client.post('/api/auth/register', json={
+            'email': f'late{i}@library.com', 'password': 'secret', 'full_name': f'La Te {i}'
+        }).get_json()['user']['id'])
+        readers.append(login(client, f'late{i}@library.com', 'secret'))
+    first = client.post('/api/loans/batch', json={'book_ids': [1, 2, 3]}, headers=readers[0]).get_json()
+    second = client.post('/api/loans/batch', json={'book_ids': [4, 5]}, headers=readers[1]).get_json()
+    first = [loan['id'] for loan in first['results']]
+    second = [loan['id'] for loan in second['results']]
+
+    now = utcnow()
+    set_due(first, now + timedelta(days=1))
+    set_due(second[:1], now + timedelta(days=2))
+    set_due(second[1:], now + timedelta(days=5))
+    assert mark(batch_size=2, now=now) == 0
+    assert mark(batch_size=2, now=now + timedelta(days=3)) == 4
+    # Nothing new fell due, so the next pass marks nothing
+    assert mark(batch_size=2, now=now + timedelta(days=3)) == 0
+
+    summary = client.get('/api/loans/overdue', headers=admin).get_json()
+    assert summary['last_run'] is not None
+    assert [(row['user_id'], row['overdue_count']) for row in summary['users']] == [
+        (reader_ids[0], 3), (reader_ids[1], 1)
+    ]
+    own = client.get('/api/loans/overdue', headers=readers[1]).get_json()['users']
+    assert [(row['user_id'], row['overdue_count']) for row in own] == [(reader_ids[1], 1)]
+
+    loans = client.get('/api/loans?fields=id,status,overdue_at', headers=admin).get_json()
+    marked = {loan['id'] for loan in loans if loan['overdue_at']}
+    assert marked == set(first + second[:1])
+    assert {loan['status'] for loan in loans} == {'active'}
+
+    # A loan that falls due later is picked up by a later pass
+    assert mark(now=now + timedelta(days=6)) == 1
+
+    # Returning overdue loans brings the borrower's count down
+    client.post('/api/loans/return/batch', json={'loan_ids': first}, headers=readers[0])
+    summary = client.get('/api/loans/overdue', headers=admin).get_json()
+    assert [(row['user_id'], row['overdue_count']) for row in summary['users']] == [(reader_ids[1], 2)]
+
+    types = [event['type'] for event in client.get('/api/events?limit=1000', headers=admin).get_json()['events']]
+    assert types.count('loan.overdue') == 5
+
+def test_overdue_marking():
+    for url in backends():
+        overdue(url)
+
+def test_scheduler_thread_runs_and_stops():
+    fresh_client(backends()[0])
+    job = scheduler.OverdueScheduler(interval=0.01)
+    job.start()
+    try:
+        deadline = time.monotonic() + 5
+        while job.runs < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        job.stop()
+    assert job.runs >= 2
+    runs = job.runs
+    time.sleep(0.05)
+    assert job.runs == runs
+
+if __name__ == '__main__':
+    test_overdue_marking()
+    test_scheduler_thread_runs_and_stops()
+    print('Overdue scheduler works')
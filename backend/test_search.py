@@ -0,0 +1,54 @@
+"""Full-text book search behind GET /api/books?search=
+
+Prefix matching, relevance order, the exact ISBN shortcut and the index
+staying in step with book writes. Runs against each backend in
+test_storage.backends(). Run with ``python -m pytest test_search.py`` or
+``python test_search.py``.
+"""
+from test_storage import backends, fresh_client, login
+
+def titles(client, headers, query):
+    response = client.get(f'/api/books?{query}', headers=headers)
+    assert response.status_code == 200, response.get_json()
+    return [book['title'] for book in response.get_json()]
+
+def search(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+
+    # Prefixes of every term must match, in any order and any case
+    assert set(titles(client, admin, 'search=clea')) == {'Clean Code', 'Clean Architecture'}
+    assert titles(client, admin, 'search=ARCH clean') == ['Clean Architecture']
+    assert titles(client, admin, 'search=clean python') == []
+
+    # A title match ranks above an author match
+    book_id = client.post('/api/books', json={
+        'title': 'Working Effectively', 'author': 'Michael Clean'
+    }, headers=admin).get_json()['id']
+    found = titles(client, admin, 'search=clean')
+    assert found[-1] == 'Working Effectively' and len(found) == 3
+
+    # Query syntax in the input is matched as plain words
+    for query in ['search="clean', 'search=clean*', 'search=clean OR', 'search=NEAR(clean)', 'search=c%2B%2B']:
+        assert client.get(f'/api/books?{query}', headers=admin).status_code == 200, query
+    assert titles(client, admin, 'search=%22%2A%28%29') == []
+
+    # Exact ISBNs go through the isbn index; substring mode still works
+    assert titles(client, admin, 'search=978-0-13-468599-1') == ['Clean Code']
+    assert titles(client, admin, 'search=ean co&search_mode=substring') == ['Clean Code']
+
+    # The index follows inserts, updates and deletes
+    client.put(f'/api/books/{book_id}', json={'title': 'Refactoring Legacy', 'author': 'Michael Feathers'},
+               headers=admin)
+    assert titles(client, admin, 'search=legacy') == ['Refactoring Legacy']
+    assert 'Refactoring Legacy' not in titles(client, admin, 'search=clean')
+    client.delete(f'/api/books/{book_id}', headers=admin)
+    assert titles(client, admin, 'search=legacy') == []
+
+def test_search():
+    for url in backends():
+        search(url)
+
+if __name__ == '__main__':
+    test_search()
+    print('Book search works')
@@ -0,0 +1,173 @@
+"""Serving entry points: app factory, ASGI adapter and pre-forked server
+
+Run with ``python -m pytest test_serving.py`` or ``python test_serving.py``.
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import database
+from asgi import WsgiToAsgi
+from test_storage import fresh_client
+
+def test_create_app_does_not_touch_the_database():
+    from app import create_app
+    path = os.path.join(tempfile.mkdtemp(), 'library.db')
+    database.close_pool()
+    database.DATABASE = path
+    create_app()
+    assert not os.path.exists(path)
+
+def asgi_request(application, method, path, body=b'', headers=(), received=None):
+    """Drive one request through an ASGI app; returns (status, headers, body chunks)
+
+    ``body`` may be a list of chunks, sent as separate messages; each
+    message the app asks for is appended to ``received``.
+    """
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers],
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 5555), 'scheme': 'http', 'http_version': '1.1'
+    }
+    chunks = body if isinstance(body, list) else [body]
+    messages = [
+        {'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1} for i, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        message = messages.pop(0)
+        if received is not None:
+            received.append(message)
+        return message
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    chunks = [message['body'] for message in sent[1:] if message['body']]
+    return sent[0]['status'], dict(sent[0]['headers']), chunks
+
+def test_asgi_adapter_runs_requests_on_the_executor():
+    fresh_client(os.path.join(tempfile.mkdtemp(), 'library.db'))
+    from app import app
+    application = WsgiToAsgi(app, threads=2)
+
+    status, headers, chunks = asgi_request(
+        application, 'POST', '/api/auth/login',
+        json.dumps({'email': 'admin@library.com', 'password': 'admin123'}).encode(),
+        [('Content-Type', 'application/json')]
+    )
+    assert status == 200
+    token = json.loads(b''.join(chunks))['access_token']
+
+    status, headers, chunks = asgi_request(
+        application, 'GET', '/api/books?limit=2', headers=[('Authorization', f'Bearer {token}')]
+    )
+    assert status == 200 and len(json.loads(b''.join(chunks))['items']) == 2
+
+    status, headers, chunks = asgi_request(
+        application, 'GET', '/api/loans?format=csv', headers=[('Authorization', f'Bearer {token}')]
+    )
+    assert status == 200 and headers[b'content-type'].startswith(b'text/csv')
+    assert b''.join(chunks).startswith(b'id,')
+
+def test_asgi_request_body_is_read_as_the_app_reads_it():
+    fresh_client(os.path.join(tempfile.mkdtemp(), 'library.db'))
+    from app import app
+    application = WsgiToAsgi(app, threads=2)
+    status, _, chunks = asgi_request(
+        application, 'POST', '/api/auth/login',
+        json.dumps({'email': 'admin@library.com', 'password': 'admin123'}).encode(),
+        [('Content-Type', 'application/json')]
+    )
+    auth = ('Authorization', f"Bearer {json.loads(b''.join(chunks))['access_token']}")
+
+    # A chunked upload, without Content-Length, arrives in many messages
+    rows = [json.dumps({'title': f'Streamed {i}', 'author': 'Str Eam'}).encode() + b'\n' for i in range(200)]
+    received = []
+    status, _, chunks = asgi_request(
+        application, 'POST', '/api/books/import', rows,
+        [('Content-Type', 'application/x-ndjson'), ('Transfer-Encoding', 'chunked'), auth], received
+    )
+    assert status == 200, chunks
+    assert json.loads(b''.join(chunks))['imported'] == 200
+    assert len(received) == 200
+
+    # A body the app never reads is never received
+    received = []
+    status, _, _ = asgi_request(application, 'GET', '/health', [b'unread'] * 3, received=received)
+    assert status == 200 and received == []
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_several_workers_need_shared_rate_limits():
+    from app import create_app
+    from config import Config
+    from serve import check_workers
+
+    class SharedConfig(Config):
+        RATE_LIMIT_STORAGE = os.path.join(tempfile.mkdtemp(), 'ratelimit.db')
+
+    class MemoryConfig(Config):
+        RATE_LIMIT_STORAGE = 'memory'
+
+    check_workers(create_app(MemoryConfig), 1)
+    check_workers(create_app(SharedConfig), 4)
+    try:
+        check_workers(create_app(MemoryConfig), 4)
+    except SystemExit as e:
+        assert 'RATE_LIMIT_STORAGE' in str(e)
+    else:
+        raise AssertionError('several workers were allowed with in-memory rate limits')
+
+def test_preforked_server_serves_and_stops():
+    if not hasattr(os, 'fork'):
+        return
+    port = free_port()
+    directory = tempfile.mkdtemp()
+    env = dict(
+        os.environ, DATABASE_URL=os.path.join(directory, 'library.db'), OVERDUE_SCHEDULER_ENABLED='false',
+        RATE_LIMIT_STORAGE=os.path.join(directory, 'ratelimit.db')
+    )
+    server = subprocess.Popen(
+        [sys.executable, 'serve.py', '--host', '127.0.0.1', '--port', str(port), '--workers', '2', '--threads', '2'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = time.monotonic() + 20
+        while True:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=5) as response:
+                    assert response.status == 200
+                    break
+            except OSError:
+                assert time.monotonic() < deadline, 'server did not start'
+                time.sleep(0.2)
+        statuses = set()
+        for _ in range(10):
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=5) as response:
+                statuses.add(response.status)
+        assert statuses == {200}
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=20) == 0
+
+if __name__ == '__main__':
+    test_create_app_does_not_touch_the_database()
+    test_asgi_adapter_runs_requests_on_the_executor()
+    test_asgi_request_body_is_read_as_the_app_reads_it()
+    test_several_workers_need_shared_rate_limits()
+    test_preforked_server_serves_and_stops()
+    print('Serving entry points work')
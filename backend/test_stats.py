@@ -0,0 +1,86 @@
+"""Trigger-maintained counters behind GET /api/stats
+
+After each kind of write the counters served by /api/stats are compared
+with the aggregates they replace; drift is reported by verify_stats()
+and repaired by rebuild_stats(). Runs against each backend in
+test_storage.backends(). Run with ``python -m pytest test_stats.py`` or
+``python test_stats.py``.
+"""
+import json
+import database
+from test_storage import backends, fresh_client, login
+
+def actual():
+    conn = database.get_db()
+    try:
+        return dict(conn.execute(database.STATS_AGGREGATES).fetchone())
+    finally:
+        database.release_db(conn)
+
+def counters(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+
+    def served():
+        response = client.get('/api/stats', headers=admin)
+        assert response.status_code == 200, response.get_json()
+        return response.get_json()
+
+    def check(step):
+        assert served() == actual(), step
+
+    check('seed')
+    client.post('/api/auth/register', json={
+        'email': 'stats@library.com', 'password': 'secret', 'full_name': 'Sta Ts'
+    })
+    reader = login(client, 'stats@library.com', 'secret')
+    check('register')
+    assert client.get('/api/stats', headers=reader).status_code == 403
+
+    book_id = client.post('/api/books', json={
+        'title': 'Counted', 'author': 'Cou Nter', 'total_copies': 3
+    }, headers=admin).get_json()['id']
+    check('add book')
+    client.put(f'/api/books/{book_id}', json={'available_copies': 2}, headers=admin)
+    check('update copies')
+    client.post('/api/books/import', data='\n'.join(json.dumps(row) for row in [
+        {'isbn': '978-0-00-000030-3', 'title': 'Imported', 'author': 'Imp Orter', 'total_copies': 2},
+        {'isbn': '978-0-13-468599-1', 'title': 'Clean Code', 'author': 'Robert C. Martin', 'total_copies': 5}
+    ]), content_type='application/x-ndjson', headers=admin)
+    check('import')
+
+    loan_id = client.post('/api/loans', json={'book_id': book_id}, headers=reader).get_json()['id']
+    check('borrow')
+    results = client.post('/api/loans/batch', json={'book_ids': [1, 2]}, headers=reader).get_json()['results']
+    check('borrow batch')
+    client.post(f'/api/loans/{loan_id}/return', headers=reader)
+    check('return')
+    client.post('/api/loans/return/batch', json={'loan_ids': [result['id'] for result in results]},
+                headers=reader)
+    check('return batch')
+    client.delete('/api/books/5', headers=admin)
+    check('delete book')
+
+    # Drift is reported and repaired
+    conn = database.get_db()
+    try:
+        conn.execute('UPDATE library_stats SET total_books = total_books + 7, active_loans = 9 WHERE id = 1')
+        conn.commit()
+        expected = actual()
+        assert database.verify_stats(conn) == {
+            'total_books': (expected['total_books'] + 7, expected['total_books']),
+            'active_loans': (9, expected['active_loans'])
+        }
+        database.rebuild_stats(conn)
+        assert database.verify_stats(conn) == {}
+    finally:
+        database.release_db(conn)
+    check('rebuild')
+
+def test_counters_match_aggregates():
+    for url in backends():
+        counters(url)
+
+if __name__ == '__main__':
+    test_counters_match_aggregates()
+    print('Stats counters work')
@@ -0,0 +1,205 @@
+"""API round trip against each storage backend
+
+Always runs against a temporary SQLite file. Set TEST_DATABASE_URL to a
+PostgreSQL database (which is wiped) to run against that too:
+
+    TEST_DATABASE_URL=postgresql://postgres@localhost/library_test python -m pytest test_storage.py
+
+Without it, a throwaway PostgreSQL is started with pgserver when that
+and psycopg2 are installed (``pip install pgserver psycopg2-binary``);
+otherwise the PostgreSQL backend is not tested.
+
+Run with ``python -m pytest test_storage.py`` or ``python test_storage.py``.
+"""
+import os
+import tempfile
+from datetime import timedelta
+import database
+import postgres
+import ratelimit
+
+def use_database(url=None):
+    """Point the pool at a fresh, initialized database
+
+    Defaults to TEST_DATABASE_URL, or a new SQLite file when that is unset.
+    """
+    url = url or os.environ.get('TEST_DATABASE_URL') or os.path.join(tempfile.mkdtemp(), 'library.db')
+    database.close_pool()
+    database.DATABASE = url
+    if database.parse_database_url(url)[0] == postgres.DIALECT:
+        conn = postgres.connect(url)
+        conn.executescript('DROP SCHEMA public CASCADE; CREATE SCHEMA public;')
+        conn.commit()
+        conn.close()
+    database.init_db()
+    return url
+
+_local_postgres = []
+
+def local_postgres():
+    """URL of a PostgreSQL database on a pgserver instance started for the
+    test run, or None when pgserver or psycopg2 is not installed"""
+    if not _local_postgres:
+        try:
+            import pgserver
+        except ImportError:
+            pgserver = None
+        if pgserver is None or postgres.psycopg2 is None:
+            _local_postgres.append(None)
+        else:
+            server = pgserver.get_server(tempfile.mkdtemp(), cleanup_mode='stop')
+            server.psql('CREATE DATABASE library_test;')
+            _local_postgres.append(server.get_uri('library_test'))
+    return _local_postgres[0]
+
+def backends():
+    urls = [os.path.join(tempfile.mkdtemp(), 'library.db')]
+    postgres_url = os.environ.get('TEST_DATABASE_URL') or local_postgres()
+    if postgres_url:
+        urls.append(postgres_url)
+    return urls
+
+def fresh_client(url):
+    use_database(url)
+    import app as app_module
+    for cache in [app_module.book_cache, app_module.book_list_cache, app_module.user_cache]:
+        cache.clear()
+    limiter = ratelimit.get_limiter(app_module.app)
+    if limiter:
+        limiter.clear()
+    return app_module.app.test_client()
+
+def login(client, email, password):
+    response = client.post('/api/auth/login', json={'email': email, 'password': password})
+    assert response.status_code == 200, response.get_json()
+    return {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+
+def round_trip(url):
+    client = fresh_client(url)
+    admin = login(client, 'admin@library.com', 'admin123')
+
+    response = client.post('/api/auth/register', json={
+        'email': 'reader@library.com', 'password': 'secret', 'full_name': 'Rea Der'
+    })
+    assert response.status_code == 201
+    reader_id = response.get_json()['user']['id']
+    reader = {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+    assert client.post('/api/auth/register', json={
+        'email': 'reader@library.com', 'password': 'x', 'full_name': 'Again'
+    }).status_code == 409
+    assert client.get('/api/auth/me', headers=reader).get_json()['full_name'] == 'Rea Der'
+
+    # Catalogue: full-text, substring and ISBN search, keyset pages
+    response = client.post('/api/books', json={
+        'isbn': '978-0-00-000001-1', 'title': 'Single Copy', 'author': 'Ann Author', 'total_copies': 1,
+        'available_copies': 1
+    }, headers=admin)
+    assert response.status_code == 201
+    book_id = response.get_json()['id']
+
+    titles = [book['title'] for book in client.get('/api/books?search=clea', headers=reader).get_json()]
+    assert set(titles) == {'Clean Code', 'Clean Architecture'}
+    titles = [book['title'] for book in client.get('/api/books?search=robert clean', headers=reader).get_json()]
+    assert set(titles) == {'Clean Code', 'Clean Architecture'}
+    assert [book['title'] for book in client.get(
+        '/api/books?search=CLEAN COD&search_mode=substring', headers=reader
+    ).get_json()] == ['Clean Code']
+    assert client.get('/api/books?search=978-0-00-000001-1', headers=reader).get_json()[0]['id'] == book_id
+
+    seen = []
+    cursor = None
+    while True:
+        query = '/api/books?search=clean&limit=1&fields=id' + (f'&cursor={cursor}' if cursor else '')
+        page = client.get(query, headers=reader).get_json()
+        seen += [book['id'] for book in page['items']]
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert len(seen) == 2 and len(set(seen)) == 2
+
+    page = client.get('/api/books?limit=2', headers=reader).get_json()
+    rest = client.get(f"/api/books?limit=10&cursor={page['next_cursor']}", headers=reader).get_json()
+    assert len(page['items']) + len(rest['items']) == 6
+
+    # Circulation and the hold queue
+    response = client.post('/api/loans', json={'book_id': book_id}, headers=admin)
+    assert response.status_code == 201
+    admin_loan = response.get_json()['id']
+    assert client.post('/api/loans', json={'book_id': book_id}, headers=reader).get_json() == {
+        'error': 'Book is not available'
+    }
+    response = client.post('/api/holds', json={'book_id': book_id}, headers=reader)
+    assert response.status_code == 201 and response.get_json()['position'] == 1
+    assert client.post('/api/holds', json={'book_id': book_id}, headers=reader).status_code == 400
+
+    assert client.post(f'/api/loans/{admin_loan}/return', headers=admin).status_code == 200
+    assert client.get('/api/holds', headers=reader).get_json()[0]['status'] == 'ready'
+    assert client.get(f'/api/books/{book_id}', headers=reader).get_json()['available_copies'] == 0
+    response = client.post('/api/loans', json={'book_id': book_id}, headers=reader)
+    assert response.status_code == 201
+    assert client.post('/api/loans', json={'book_id': book_id}, headers=reader).status_code == 400
+
+    response = client.post('/api/loans/batch', json={'book_ids': [1, 2, 2, 999]}, headers=reader)
+    assert [result['status_code'] for result in response.get_json()['results']] == [201, 201, 400, 404]
+
+    loans = client.get('/api/loans', headers=reader).get_json()
+    assert len(loans) == 3
+    page = client.get('/api/loans?limit=2', headers=reader).get_json()
+    rest = client.get(f"/api/loans?limit=2&cursor={page['next_cursor']}", headers=reader).get_json()
+    assert [loan['id'] for loan in page['items'] + rest['items']] == [loan['id'] for loan in loans]
+    exported = client.get('/api/loans?format=ndjson', headers=admin).get_data(as_text=True)
+    assert len(exported.splitlines()) == 4
+
+    response = client.post('/api/loans/return/batch', json={'loan_ids': [loan['id'] for loan in loans]}, headers=reader)
+    assert response.get_json()['succeeded'] == 3
+
+    # Overdue detection
+    from scheduler import mark_overdue
+    from timeseries import utcnow
+    conn = database.get_db()
+    try:
+        response = client.post('/api/loans', json={'book_id': 3}, headers=reader)
+        loan_id = response.get_json()['id']
+        assert mark_overdue(conn, now=utcnow() + timedelta(days=30)) == 1
+        summary = client.get('/api/loans/overdue', headers=reader).get_json()['users']
+        assert summary[0]['user_id'] == reader_id and summary[0]['overdue_count'] == 1
+        client.post(f'/api/loans/{loan_id}/return', headers=reader)
+        assert client.get('/api/loans/overdue', headers=reader).get_json()['users'] == []
+
+        # Import with one bad row, then the counters still match the tables
+        response = client.post(
+            '/api/books/import?format=csv',
+            data='isbn,title,author,total_copies\n978-0-00-000002-2,Imported,Some One,2\n,,Nobody,1\n',
+            headers=admin
+        )
+        assert response.get_json()['imported'] == 1 and response.get_json()['failed'] == 1
+
+        assert client.put(f'/api/users/{reader_id}', json={'role': 'admin'}, headers=admin).status_code == 200
+        assert client.get('/api/auth/me', headers=reader).get_json()['role'] == 'admin'
+        assert len(client.get('/api/users', headers=admin).get_json()) == 2
+
+        stats = client.get('/api/stats', headers=admin).get_json()
+        assert stats == {'total_books': 7, 'available_books': 17, 'total_users': 2, 'active_loans': 0}
+        assert database.verify_stats(conn) == {}
+    finally:
+        database.release_db(conn)
+
+def test_round_trip_on_each_backend():
+    for url in backends():
+        round_trip(url)
+
+def test_parse_database_url():
+    assert database.parse_database_url('sqlite:///data/library.db') == ('sqlite', 'data/library.db')
+    assert database.parse_database_url('library.db') == ('sqlite', 'library.db')
+    assert database.parse_database_url('postgresql://u@db/library') == ('postgresql', 'postgresql://u@db/library')
+
+def test_translate_placeholders():
+    assert postgres.translate("SELECT * FROM books WHERE title LIKE ? AND isbn = '?%'") == \
+        "SELECT * FROM books WHERE title LIKE %s AND isbn = '?%%'"
+    assert postgres.translate("SELECT id FROM books WHERE isbn LIKE 'bench-%' LIMIT ?") == \
+        "SELECT id FROM books WHERE isbn LIKE 'bench-%%' LIMIT %s"
+
+if __name__ == '__main__':
+    for url in backends():
+        round_trip(url)
+        print(f"ok: {database.parse_database_url(url)[0]}")
@@ -0,0 +1,140 @@
+"""Periods and date ranges for the loan rollup endpoints
+
+Periods are named by their start, as the rollup tables store them:
+``YYYY-MM-DD HH:00:00`` for hours and ``YYYY-MM-DD`` for days, weeks
+(starting on Monday) and months (the 1st). Times are UTC, like the
+database's CURRENT_TIMESTAMP.
+"""
+from datetime import datetime, timedelta, timezone
+from flask import request
+
+INTERVALS = ['hour', 'day', 'week', 'month']
+TOP_INTERVALS = ['day', 'week', 'month']
+DEFAULT_POINTS = 30
+MAX_POINTS = 2000
+DEFAULT_TOP = 10
+MAX_TOP = 100
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def period_start(interval, moment):
+    """Start of the period of ``interval`` that contains ``moment``"""
+    if interval == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+    return day
+
+def next_period(interval, start):
+    if interval == 'hour':
+        return start + timedelta(hours=1)
+    if interval == 'week':
+        return start + timedelta(weeks=1)
+    if interval == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + timedelta(days=1)
+
+def previous_period(interval, start):
+    if interval == 'month':
+        return start.replace(year=start.year - (start.month == 1), month=(start.month - 2) % 12 + 1)
+    return start - (next_period(interval, start) - start)
+
+def period_key(interval, start):
+    return start.strftime('%Y-%m-%d %H:00:00' if interval == 'hour' else '%Y-%m-%d')
+
+def parse_interval(allowed, default):
+    interval = request.args.get('interval', default)
+    if interval not in allowed:
+        raise ValueError(f"Invalid interval: use one of {', '.join(allowed)}")
+    return interval
+
+def parse_time(name):
+    """An ISO date or date-time argument, or None when absent
+
+    Times with an offset are converted to naive UTC.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Invalid {name}: use YYYY-MM-DD or YYYY-MM-DDTHH:MM')
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def parse_range():
+    """Read ``interval``, ``start`` and ``end``
+
+    Returns (interval, start, end): whole periods from the one holding
+    ``start`` up to, not including, the one holding ``end``. ``end``
+    defaults to the end of the current period and ``start`` to
+    DEFAULT_POINTS periods before it.
+    """
+    interval = parse_interval(INTERVALS, 'day')
+    end = parse_time('end')
+    end = period_start(interval, end) if end else next_period(interval, period_start(interval, utcnow()))
+    start = parse_time('start')
+    if start is None:
+        try:
+            start = end
+            for _ in range(DEFAULT_POINTS):
+                start = previous_period(interval, start)
+        except (OverflowError, ValueError):
+            raise ValueError('Invalid end: out of range')
+    start = period_start(interval, start)
+    if start >= end:
+        raise ValueError('start must be before end')
+    if len(periods(interval, start, end, MAX_POINTS + 1)) > MAX_POINTS:
+        raise ValueError(f'Too many periods: at most {MAX_POINTS}')
+    return interval, start, end
+
+def parse_top():
+    """Read ``interval``, ``date`` and ``limit`` for the top lists
+
+    Returns (interval, start of the period holding ``date``, start of the
+    next period, limit).
+    """
+    interval = parse_interval(TOP_INTERVALS, 'week')
+    start = period_start(interval, parse_time('date') or utcnow())
+    try:
+        end = next_period(interval, start)
+    except (OverflowError, ValueError):
+        raise ValueError('Invalid date: out of range')
+    try:
+        limit = int(request.args.get('limit', DEFAULT_TOP))
+    except ValueError:
+        raise ValueError('Invalid limit')
+    if limit < 1:
+        raise ValueError('Invalid limit')
+    return interval, start, end, min(limit, MAX_TOP)
+
+def periods(interval, start, end, limit=None):
+    """Keys of the periods from ``start`` up to ``end``, at most ``limit``"""
+    keys = []
+    while start < end and (limit is None or len(keys) < limit):
+        keys.append(period_key(interval, start))
+        start = next_period(interval, start)
+    return keys
+
+def fill(interval, start, end, rows):
+    """One point per period, with zeros where the rollups have no row
+
+    Hourly points have no borrower count.
+    """
+    found = {row['period']: row for row in rows}
+    series = []
+    for key in periods(interval, start, end):
+        row = found.get(key)
+        series.append({
+            'period': key,
+            'borrows': row['borrows'] if row else 0,
+            'returns': row['returns'] if row else 0,
+            'borrowers': None if interval == 'hour' else (row['borrowers'] if row else 0)
+        })
+    return series
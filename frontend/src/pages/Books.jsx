@@ -4,25 +4,44 @@ import './Books.css';
 
 function Books({ user }) {
   const [books, setBooks] = useState([]);
+  const [categories, setCategories] = useState([]);
+  const [categoryCounts, setCategoryCounts] = useState({});
   const [loading, setLoading] = useState(true);
   const [searchTerm, setSearchTerm] = useState('');
   const [category, setCategory] = useState('');
   const [availableOnly, setAvailableOnly] = useState(false);
   const [message, setMessage] = useState({ type: '', text: '' });
 
+  useEffect(() => {
+    fetchCategories();
+  }, []);
+
   useEffect(() => {
     fetchBooks();
   }, [searchTerm, category, availableOnly]);
 
+  // Every category for the dropdown; the facets only cover the top ones
+  const fetchCategories = async () => {
+    try {
+      const response = await booksAPI.getCategories();
+      setCategories(response.data.map((cat) => cat.value));
+    } catch (error) {
+      console.error('Error fetching categories:', error);
+    }
+  };
+
   const fetchBooks = async () => {
     try {
-      const params = {};
+      const params = { facets: 'category' };
       if (searchTerm) params.search = searchTerm;
       if (category) params.category = category;
       if (availableOnly) params.available_only = 'true';
 
       const response = await booksAPI.getAll(params);
-      setBooks(response.data);
+      setBooks(response.data.items);
+      setCategoryCounts(Object.fromEntries(
+        response.data.facets.category.map((cat) => [cat.value, cat.count])
+      ));
     } catch (error) {
       console.error('Error fetching books:', error);
       setMessage({ type: 'error', text: 'Failed to load books' });
@@ -44,8 +63,6 @@ function Books({ user }) {
     }
   };
 
-  const categories = [...new Set(books.map(book => book.category).filter(Boolean))];
-
   if (loading) {
     return <div className="container"><div className="loading">Loading books...</div></div>;
   }
@@ -82,7 +99,9 @@ function Books({ user }) {
               >
                 <option value="">All Categories</option>
                 {categories.map((cat) => (
-                  <option key={cat} value={cat}>{cat}</option>
+                  <option key={cat} value={cat}>
+                    {cat in categoryCounts ? `${cat} (${categoryCounts[cat]})` : cat}
+                  </option>
                 ))}
               </select>
             </div>
@@ -54,6 +54,7 @@ export const authAPI = {
 // Books API
 export const booksAPI = {
   getAll: (params) => api.get('/books', { params }),
+  getCategories: () => api.get('/books/categories'),
   getById: (id) => api.get(`/books/${id}`),
   create: (bookData) => api.post('/books', bookData),
   update: (id, bookData) => api.put(`/books/${id}`, bookData),